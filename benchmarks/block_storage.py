@@ -0,0 +1,197 @@
+"""
+Benchmark of the block storage layout against the row layout.
+
+Generates synthetic readings and reports, as JSON:
+ - The encoded block size per reading, next to the row payload size.
+ - The time to encode the blocks and to decode a range read of one device.
+ - When a MySQL database is provided, the on-disk size of both layouts and the
+   latency of the same range read against each of them.
+"""
+
+import argparse
+import json
+import random
+import time
+from typing import Any, Self
+
+import pymysql
+
+from data_retrieval_lambda.data_retrieval_lambda import read_blocks
+from iot_common.blocks import BLOCK_SIZE, encode_block
+
+# Payload of a single row: device_id and timestamp int, two floats and a boolean
+ROW_PAYLOAD_SIZE = 4 + 4 + 4 + 4 + 1
+
+# Start of the generated readings, aligned with the blocks
+START_TIMESTAMP = 1690243200
+
+
+def parse_args() -> argparse.Namespace:
+    """Parse the command line arguments"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--devices", type=int, default=10)
+    parser.add_argument("--hours", type=int, default=24 * 7)
+    parser.add_argument("--interval", type=int, default=10, help="seconds")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--host", help="MySQL host, enables the database benchmark")
+    parser.add_argument("--port", type=int, default=3306)
+    parser.add_argument("--user", default="root")
+    parser.add_argument("--password", default="")
+    parser.add_argument("--database", default="benchmark")
+    return parser.parse_args()
+
+
+def generate_rows(
+    devices: int, hours: int, interval: int, seed: int
+) -> list[tuple[Any, ...]]:
+    """Returns random walk readings of every device, in (device, timestamp) order"""
+    rng = random.Random(seed)
+    rows = []
+    for device_id in range(1, devices + 1):
+        temperature, humidity, hvac_status = 20.0, 50.0, False
+        for timestamp in range(
+            START_TIMESTAMP, START_TIMESTAMP + hours * 3600, interval
+        ):
+            temperature = round(temperature + rng.gauss(0, 0.1), 1)
+            humidity = round(min(max(humidity + rng.gauss(0, 0.2), 0), 100), 1)
+            hvac_status = hvac_status != (rng.random() < 0.01)
+            rows.append((device_id, timestamp, temperature, humidity, hvac_status))
+    return rows
+
+
+def get_blocks(rows: list[tuple[Any, ...]]) -> list[tuple[int, int, int, bytes]]:
+    """Returns the encoded device-hour blocks of the rows"""
+    grouped: dict[tuple[int, int], list[tuple[Any, ...]]] = {}
+    for row in rows:
+        grouped.setdefault((row[0], row[1] - row[1] % BLOCK_SIZE), []).append(row)
+    return [
+        (device_id, start, len(block_rows), encode_block(block_rows))
+        for (device_id, start), block_rows in grouped.items()
+    ]
+
+
+def time_call(repeat: int, function: Any, *args: Any) -> float:
+    """Returns the median duration of the call, in milliseconds"""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        durations.append((time.perf_counter() - start) * 1000)
+    return sorted(durations)[len(durations) // 2]
+
+
+class BlocksCursor:
+    """Cursor serving the encoded blocks from memory, to time decoding alone"""
+
+    def __init__(self, blocks: list[tuple[int, int, bytes]]) -> None:
+        self.blocks = blocks
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *_args: object) -> None:
+        pass
+
+    def execute(self, _statement: str, _variables: tuple[Any, ...]) -> None:
+        pass
+
+    def fetchall(self) -> list[tuple[int, int, bytes]]:
+        return self.blocks
+
+
+class BlocksConnection:
+    """Connection handing out a BlocksCursor"""
+
+    def __init__(self, blocks: list[tuple[int, int, bytes]]) -> None:
+        self.blocks = blocks
+
+    def cursor(self, *_args: Any) -> BlocksCursor:
+        return BlocksCursor(self.blocks)
+
+
+def benchmark_codec(
+    rows: list[tuple[Any, ...]], blocks: list[tuple[int, int, int, bytes]], repeat: int
+) -> dict[str, Any]:
+    """Benchmark the block encoding and the decoding of one device's range"""
+    encoded_size = sum(len(block[3]) for block in blocks)
+    device_blocks = [(d, start, data) for d, start, _, data in blocks if d == 1]
+    connection = BlocksConnection(device_blocks)
+    return {
+        "readings": len(rows),
+        "blocks": len(blocks),
+        "row_payload_bytes_per_reading": ROW_PAYLOAD_SIZE,
+        "block_bytes_per_reading": round(encoded_size / len(rows), 2),
+        "encode_ms": round(time_call(1, get_blocks, rows), 2),
+        "range_read_decode_ms": round(
+            time_call(repeat, read_blocks, connection, "benchmark", 1, None, None), 2
+        ),
+        "range_read_readings": sum(1 for row in rows if row[0] == 1),
+    }
+
+
+def benchmark_database(
+    args: argparse.Namespace,
+    rows: list[tuple[Any, ...]],
+    blocks: list[tuple[int, int, int, bytes]],
+) -> dict[str, Any]:
+    """Benchmark the on-disk size and range read latency of both layouts"""
+    with pymysql.connect(
+        host=args.host,
+        port=args.port,
+        user=args.user,
+        password=args.password,
+        database=args.database,
+    ) as conn:
+        with conn.cursor() as cur:
+            cur.execute("DROP TABLE IF EXISTS benchmark, benchmark_blocks")
+            cur.execute(
+                "CREATE TABLE benchmark (device_id int, timestamp int, "
+                "temperature float, humidity float, hvac_status boolean, "
+                "PRIMARY KEY (device_id, timestamp))"
+            )
+            cur.execute(
+                "CREATE TABLE benchmark_blocks (device_id int, timestamp int, "
+                "sample_count int, data blob, PRIMARY KEY (device_id, timestamp))"
+            )
+            cur.executemany("INSERT INTO benchmark VALUES (%s,%s,%s,%s,%s)", rows)
+            cur.executemany("INSERT INTO benchmark_blocks VALUES (%s,%s,%s,%s)", blocks)
+            conn.commit()
+            cur.execute("ANALYZE TABLE benchmark, benchmark_blocks")
+            cur.fetchall()
+            cur.execute(
+                "SELECT table_name, data_length + index_length "
+                "FROM information_schema.tables "
+                "WHERE table_schema = %s AND table_name LIKE 'benchmark%%'",
+                (args.database,),
+            )
+            sizes = {name: int(size) for name, size in cur.fetchall()}
+
+        def read_rows() -> None:
+            with conn.cursor(pymysql.cursors.DictCursor) as cur:
+                cur.execute("SELECT * FROM benchmark WHERE device_id = %s", (1,))
+                cur.fetchall()
+
+        return {
+            "row_table_bytes": sizes["benchmark"],
+            "block_table_bytes": sizes["benchmark_blocks"],
+            "row_range_read_ms": round(time_call(args.repeat, read_rows), 2),
+            "block_range_read_ms": round(
+                time_call(args.repeat, read_blocks, conn, "benchmark", 1, None, None),
+                2,
+            ),
+        }
+
+
+def main() -> None:
+    args = parse_args()
+    rows = generate_rows(args.devices, args.hours, args.interval, args.seed)
+    blocks = get_blocks(rows)
+    report = {"codec": benchmark_codec(rows, blocks, args.repeat)}
+    if args.host:
+        report["database"] = benchmark_database(args, rows, blocks)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
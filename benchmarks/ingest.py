@@ -0,0 +1,366 @@
+"""
+Benchmark of the file parser's ingest path, across file sizes.
+
+Generates deterministic synthetic Iot csv files and reports, as JSON:
+ - The throughput (rows/sec) of parsing a file from (moto) S3, of validating its
+   rows one by one (with the invalid rows) and of cleaning and writing the parsed
+   data without its duplicate readings, for each file size.
+ - The peak traced Python memory of each stage, and the peak RSS of the process.
+ - The statements sent to the database, when writing to the recording cursor.
+When a MySQL host is provided, the data is written to a freshly migrated schema
+instead of the recording cursor.
+"""
+
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import random
+import resource
+import subprocess
+import time
+import tracemalloc
+from collections.abc import Callable
+from datetime import datetime, timedelta
+from functools import partial
+from typing import Any, Self
+from unittest import mock
+
+import boto3
+import pymysql
+from moto import mock_s3
+from pydantic import ValidationError
+
+from file_parser_lambda.file_parser_lambda import (
+    STORAGE_MODES,
+    IotData,
+    LambdaError,
+    clean_data,
+    get_cleaning_rules,
+    parse_s3_csv_file,
+    write_to_rds,
+)
+from setup_sql.create_mysql_schema import SchemaOptions, migrate
+
+# Header of the generated csv files, as uploaded by the devices
+CSV_HEADER = "device_id,timestamp,temperature,humidity,hvac_status"
+
+# Start of the generated readings, and the interval between a device's readings
+START_DATETIME = datetime(2023, 7, 25)
+READING_INTERVAL = timedelta(seconds=10)
+
+# Maximum distance, in rows, that out-of-order rows are moved back by
+MAX_DISPLACEMENT = 100
+
+# Bucket and table that the benchmark reads from and writes to
+BUCKET = "benchmark"
+TABLE = "benchmark"
+
+
+def parse_args() -> argparse.Namespace:
+    """Parse the command line arguments"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--rows", default="1000,10000,100000", help="comma separated file sizes"
+    )
+    parser.add_argument("--devices", type=int, default=100, help="at most 999")
+    parser.add_argument(
+        "--invalid-fraction",
+        type=float,
+        default=0.0,
+        help="fraction of invalid rows, in the file of the validate stage only",
+    )
+    parser.add_argument("--duplicate-fraction", type=float, default=0.0)
+    parser.add_argument("--out-of-order-fraction", type=float, default=0.05)
+    parser.add_argument("--storage-mode", choices=STORAGE_MODES, default="rows")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file to write the report to")
+    parser.add_argument("--host", help="MySQL host, replaces the recording cursor")
+    parser.add_argument("--user", default="root")
+    parser.add_argument("--password", default="")
+    parser.add_argument("--database", default="benchmark")
+    return parser.parse_args()
+
+
+def generate_csv(
+    rows: int,
+    devices: int,
+    invalid_fraction: float = 0.0,
+    duplicate_fraction: float = 0.0,
+    out_of_order_fraction: float = 0.0,
+    seed: int = 0,
+) -> str:
+    """
+    Returns a csv file of random walk readings, which the devices take in turns.
+
+    The given fractions of the rows are replaced by invalid rows, replaced by
+    duplicates of earlier rows and moved back by up to MAX_DISPLACEMENT rows.
+    The same arguments always generate the same file.
+    """
+    rng = random.Random(seed)
+    state = {d: (20.0, 50.0, False) for d in range(1, devices + 1)}
+    lines = []
+    for i in range(rows):
+        device_id = i % devices + 1
+        temperature, humidity, hvac_status = state[device_id]
+        temperature = round(temperature + rng.gauss(0, 0.1), 1)
+        humidity = round(min(max(humidity + rng.gauss(0, 0.2), 0), 100), 1)
+        hvac_status = hvac_status != (rng.random() < 0.01)
+        state[device_id] = (temperature, humidity, hvac_status)
+        timestamp = START_DATETIME + READING_INTERVAL * (i // devices)
+        lines.append(
+            f"device_{device_id:03d},{timestamp:%Y-%m-%d %H:%M:%S},"
+            f"{temperature},{humidity},{'on' if hvac_status else 'off'}"
+        )
+
+    for i in range(1, rows):
+        if rng.random() < out_of_order_fraction:
+            j = max(0, i - rng.randint(1, MAX_DISPLACEMENT))
+            lines[i], lines[j] = lines[j], lines[i]
+    for i in range(1, rows):
+        if rng.random() < duplicate_fraction:
+            lines[i] = lines[rng.randrange(i)]
+    for i in range(rows):
+        if rng.random() < invalid_fraction:
+            fields = lines[i].split(",")
+            column = rng.randrange(3)
+            fields[column] = ["device_x", "2023-13-45 00:00:00", "warm"][column]
+            lines[i] = ",".join(fields)
+    return "\n".join([CSV_HEADER, *lines])
+
+
+class RecordingCursor:
+    """Cursor that records the statements instead of executing them"""
+
+    def __init__(self, statements: list[tuple[str, int]]) -> None:
+        self.statements = statements
+        self.rowcount = 0
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *_args: object) -> None:
+        pass
+
+    def execute(self, statement: str, _variables: Any = None) -> None:
+        self.statements.append((statement, 1))
+        self.rowcount = 1
+
+    def executemany(self, statement: str, variables: list[Any]) -> None:
+        self.statements.append((statement, len(variables)))
+        self.rowcount = len(variables)
+
+    def fetchall(self) -> list[Any]:
+        return []
+
+    def fetchone(self) -> None:
+        return None
+
+
+class RecordingConnection:
+    """Connection handing out RecordingCursors, which share the recorded statements"""
+
+    def __init__(self) -> None:
+        self.statements: list[tuple[str, int]] = []
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *_args: object) -> None:
+        pass
+
+    def cursor(self, *_args: Any) -> RecordingCursor:
+        return RecordingCursor(self.statements)
+
+    def commit(self) -> None:
+        pass
+
+
+def get_peak_rss() -> int:
+    """Returns the peak resident set size of the process, in bytes (on Linux)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure(
+    rows: int, repeat: int, function: Callable[[], Any], reset: Callable[[], None]
+) -> dict[str, Any]:
+    """
+    Returns the median throughput of the call and its peak memory.
+
+    The call is timed without tracing, then run once more with tracemalloc to find
+    the peak traced memory. reset is called before every call.
+    """
+    durations = []
+    for _ in range(repeat):
+        reset()
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    duration = sorted(durations)[len(durations) // 2]
+
+    reset()
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "seconds": round(duration, 4),
+        "rows_per_second": round(rows / duration) if duration else None,
+        "peak_traced_bytes": peak,
+        "peak_rss_bytes": get_peak_rss(),
+    }
+
+
+def reset_database(args: argparse.Namespace) -> None:
+    """Drops the benchmark tables and migrates a fresh schema"""
+    with pymysql.connect(
+        host=args.host,
+        user=args.user,
+        password=args.password,
+        database=args.database,
+    ) as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT table_name FROM information_schema.tables "
+                "WHERE table_schema = %s AND (table_name LIKE 'benchmark%%' "
+                "OR table_name = 'schema_migrations')",
+                (args.database,),
+            )
+            for (table,) in cur.fetchall():
+                cur.execute(f"DROP TABLE {table}")
+        with contextlib.redirect_stdout(io.StringIO()):
+            migrate(conn, SchemaOptions(TABLE))
+
+
+def validate_rows(csv_rows: list[dict[str, str]]) -> int:
+    """Validates the rows one by one, as the parser does, returning the rejected"""
+    rejected = 0
+    for row in csv_rows:
+        try:
+            IotData(**row)
+        except ValidationError:
+            rejected += 1
+    return rejected
+
+
+def dedupe_rows(data: list[IotData]) -> list[IotData]:
+    """Returns the data without repeated readings, keeping each reading's first row"""
+    unique: dict[tuple[int, datetime], IotData] = {}
+    for row in data:
+        unique.setdefault((row.device_id, row.timestamp), row)
+    return list(unique.values())
+
+
+def benchmark_size(
+    args: argparse.Namespace, s3_client: Any, rows: int
+) -> dict[str, Any]:
+    """Benchmark parsing, validating and writing a generated file with the given rows"""
+    generate = partial(
+        generate_csv,
+        rows,
+        args.devices,
+        duplicate_fraction=args.duplicate_fraction,
+        out_of_order_fraction=args.out_of_order_fraction,
+        seed=args.seed,
+    )
+    content = generate()
+    key = f"benchmark_{rows}.csv"
+    s3_client.put_object(Bucket=BUCKET, Key=key, Body=content.encode("utf-8"))
+    result: dict[str, Any] = {"rows": rows, "file_bytes": len(content)}
+
+    parsed: list[Any] = []
+
+    def parse() -> None:
+        parsed[:] = parse_s3_csv_file(BUCKET, key)
+
+    try:
+        result["parse"] = measure(rows, args.repeat, parse, lambda: None)
+    except LambdaError as e:
+        result["error"] = e.message.splitlines()[0]
+        return result
+
+    # The parser rejects a file with an invalid row as a whole, so the invalid rows
+    # are only part of the file whose rows are validated one by one here
+    csv_rows = list(
+        csv.DictReader(generate(invalid_fraction=args.invalid_fraction).split("\n"))
+    )
+    rejected: list[int] = []
+
+    def validate() -> None:
+        rejected[:] = [validate_rows(csv_rows)]
+
+    result["validate"] = measure(rows, args.repeat, validate, lambda: None)
+    result["validate"]["rows_rejected"] = rejected[0]
+
+    # Duplicate readings would violate the primary key of the data table
+    unique = dedupe_rows(parsed)
+    connection = RecordingConnection()
+    reset = partial(reset_database, args) if args.host else connection.statements.clear
+
+    def write() -> None:
+        with contextlib.ExitStack() as stack:
+            if not args.host:
+                stack.enter_context(
+                    mock.patch.object(pymysql, "connect", return_value=connection)
+                )
+            write_to_rds(
+                clean_data(unique, get_cleaning_rules()),
+                args.host or "host",
+                args.database,
+                args.user,
+                args.password,
+                TABLE,
+                args.storage_mode,
+            )
+
+    # Write errors are raised, as the other stages' results would be misleading
+    result["write"] = measure(len(unique), args.repeat, write, reset)
+    result["write"]["duplicates_dropped"] = len(parsed) - len(unique)
+    if not args.host:
+        result["write"]["statements"] = len(connection.statements)
+        result["write"]["parameter_rows"] = sum(n for _, n in connection.statements)
+    return result
+
+
+def get_commit() -> str | None:
+    """Returns the commit of the working tree, to compare reports between commits"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, check=True, text=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> None:
+    args = parse_args()
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    results = []
+    with mock_s3():
+        s3_client = boto3.client("s3")
+        s3_client.create_bucket(Bucket=BUCKET)
+        for rows in [int(r) for r in args.rows.split(",")]:
+            # The Lambda code logs its progress, which would interleave the report
+            with contextlib.redirect_stdout(io.StringIO()):
+                results.append(benchmark_size(args, s3_client, rows))
+    config = {k: v for k, v in vars(args).items() if k not in ("password", "output")}
+    report = {
+        "commit": get_commit(),
+        "target": "mysql" if args.host else "recording_cursor",
+        "config": config,
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
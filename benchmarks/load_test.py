@@ -0,0 +1,235 @@
+"""
+Load test of the data retrieval Lambda's "GET /data" endpoint.
+
+Seeds a local MySQL database with generated readings, then drives the Lambda
+handler with a mix of API Gateway events at a target rate, and reports as JSON:
+ - The p50, p95 and p99 latency, measured from each request's scheduled start,
+   so requests queued behind slow ones count as slow.
+ - The achieved throughput, the response status counts and the response bytes.
+The RDS endpoint and credential lookups are replaced by the local database.
+"""
+
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from unittest import mock
+
+from benchmarks.ingest import (
+    READING_INTERVAL,
+    START_DATETIME,
+    TABLE,
+    generate_csv,
+    get_commit,
+    reset_database,
+)
+from data_retrieval_lambda import data_retrieval_lambda
+from file_parser_lambda.file_parser_lambda import IotData, write_to_rds
+
+# Widths of the queried time ranges, in seconds, and the resolution they're read at
+RANGE_WIDTHS = {300: None, 3600: None, 21600: "5m", 86400: "1h"}
+
+# Number of distinct events that repeated requests are drawn from
+HOT_EVENTS = 20
+
+# Rows written to the database per transaction while seeding
+SEED_BATCH_SIZE = 10000
+
+
+def parse_args() -> argparse.Namespace:
+    """Parse the command line arguments"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--host", required=True, help="MySQL host")
+    parser.add_argument("--user", default="root")
+    parser.add_argument("--password", default="")
+    parser.add_argument("--database", default="benchmark")
+    parser.add_argument("--devices", type=int, default=50, help="at most 999")
+    parser.add_argument("--rows", type=int, default=100000, help="seeded readings")
+    parser.add_argument("--no-seed", action="store_true", help="reuse the seeded data")
+    parser.add_argument("--rps", type=float, default=20)
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--repeat-fraction", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file to write the report to")
+    return parser.parse_args()
+
+
+def seed_database(args: argparse.Namespace) -> None:
+    """Migrates a fresh schema and writes generated readings to it"""
+    reset_database(args)
+    content = generate_csv(args.rows, args.devices, seed=args.seed)
+    data = [IotData(**row) for row in csv.DictReader(io.StringIO(content))]
+    for i in range(0, len(data), SEED_BATCH_SIZE):
+        write_to_rds(
+            data[i : i + SEED_BATCH_SIZE],
+            args.host,
+            args.database,
+            args.user,
+            args.password,
+            TABLE,
+        )
+
+
+def generate_events(
+    count: int, devices: int, span: tuple[int, int], repeat_fraction: float, seed: int
+) -> list[dict[str, Any]]:
+    """
+    Returns "GET /data" events for time ranges of various widths within the span.
+
+    Lower device IDs are queried more often, like the devices on popular
+    dashboards. The repeat_fraction of the events is drawn from a small set of
+    hot events, which repeat the same query, while the others are unique.
+    """
+    rng = random.Random(seed)
+    weights = [1 / device_id for device_id in range(1, devices + 1)]
+
+    def generate_event() -> dict[str, Any]:
+        device_id = rng.choices(range(1, devices + 1), weights)[0]
+        width, resolution = rng.choice(list(RANGE_WIDTHS.items()))
+        datetime_from = rng.randint(span[0], max(span[0], span[1] - width))
+        parameters = {
+            "device_id": str(device_id),
+            "datetime_from": str(datetime_from),
+            "datetime_to": str(datetime_from + width),
+        }
+        if resolution:
+            parameters["resolution"] = resolution
+        return {
+            "resource": "/data",
+            "httpMethod": "GET",
+            "queryStringParameters": parameters,
+        }
+
+    hot_events = [generate_event() for _ in range(HOT_EVENTS)]
+    return [
+        rng.choice(hot_events) if rng.random() < repeat_fraction else generate_event()
+        for _ in range(count)
+    ]
+
+
+def get_percentile(values: list[float], percentile: float) -> float:
+    """Returns the nearest-rank percentile of the sorted values"""
+    index = max(0, min(len(values) - 1, int(len(values) * percentile / 100 + 0.5) - 1))
+    return values[index]
+
+
+def run_load(
+    events: list[dict[str, Any]], rps: float, concurrency: int
+) -> tuple[list[tuple[float, str, int]], float]:
+    """
+    Sends the events to the handler at the given rate, from a pool of threads.
+
+    Returns the latency (ms), status and response bytes of each request, and the
+    duration of the run in seconds.
+    """
+    results: list[tuple[float, str, int]] = []
+    lock = threading.Lock()
+
+    def send(event: dict[str, Any], scheduled: float) -> None:
+        try:
+            response = data_retrieval_lambda.handler(event, None)
+            status = str(response["statusCode"])
+            size = len(response.get("body", ""))
+        except Exception as e:  # noqa: BLE001  # pylint: disable=broad-exception-caught
+            status, size = type(e).__name__, 0
+        latency = (time.perf_counter() - scheduled) * 1000
+        with lock:
+            results.append((latency, status, size))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for i, event in enumerate(events):
+            scheduled = start + i / rps
+            time.sleep(max(0.0, scheduled - time.perf_counter()))
+            executor.submit(send, event, scheduled)
+    return results, time.perf_counter() - start
+
+
+def get_report(
+    results: list[tuple[float, str, int]], duration: float
+) -> dict[str, Any]:
+    """Summarizes the latencies, statuses and response sizes of the requests"""
+    latencies = sorted(latency for latency, _, _ in results)
+    statuses: dict[str, int] = {}
+    for _, status, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    response_bytes = sum(size for _, _, size in results)
+    return {
+        "requests": len(results),
+        "duration_seconds": round(duration, 2),
+        "throughput_rps": round(len(results) / duration, 2),
+        "latency_ms": {
+            "p50": round(get_percentile(latencies, 50), 2),
+            "p95": round(get_percentile(latencies, 95), 2),
+            "p99": round(get_percentile(latencies, 99), 2),
+            "max": round(latencies[-1], 2),
+        },
+        "statuses": statuses,
+        "response_bytes": {
+            "total": response_bytes,
+            "mean": round(response_bytes / len(results)),
+        },
+    }
+
+
+def main() -> None:
+    args = parse_args()
+    os.environ.update(
+        {
+            "SECRET_MANAGER_ID": "benchmark",
+            "REGION": "local",
+            "MYSQL_ID": "benchmark",
+            "MYSQL_DATABASE": args.database,
+            "MYSQL_TABLE": TABLE,
+        }
+    )
+    start = int(START_DATETIME.timestamp())
+    span = (
+        start,
+        start + args.rows // args.devices * int(READING_INTERVAL.total_seconds()),
+    )
+    events = generate_events(
+        int(args.rps * args.duration),
+        args.devices,
+        span,
+        args.repeat_fraction,
+        args.seed,
+    )
+    with contextlib.ExitStack() as stack:
+        # The Lambda code logs its progress, which would interleave the report
+        stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+        stack.enter_context(
+            mock.patch.object(
+                data_retrieval_lambda,
+                "get_db_credentials",
+                return_value=(args.user, args.password),
+            )
+        )
+        stack.enter_context(
+            mock.patch.object(
+                data_retrieval_lambda, "get_read_hosts", return_value=[args.host]
+            )
+        )
+        if not args.no_seed:
+            seed_database(args)
+        results, duration = run_load(events, args.rps, args.concurrency)
+
+    config = {k: v for k, v in vars(args).items() if k not in ("password", "output")}
+    report = {"commit": get_commit(), "config": config} | get_report(results, duration)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+#!/bin/bash
+
+cd "$(dirname "$0")/.."
+
+poetry --directory data_retrieval_lambda run python -m "benchmarks.$1" "${@:2}"
@@ -2,39 +2,189 @@
 Python script that is called by Lambda function when request is sent to API Gateway.
 
 This script:
- - Gets triggered by "GET /data" endpoint in API Gateway.
- - Reads data from RDS based on provided query parameters.
+ - Gets triggered by the "GET /data", "POST /data/batch", "GET /data/latest",
+   "GET /data/statistics", "POST /data/export" and "GET /data/export/status"
+   endpoints in API Gateway.
+ - Reads data from a healthy read replica of the RDS instance, or from the
+   primary instance when there is none, based on provided query parameters,
+   routing to the shard of the device (or to all shards) when MYSQL_ID lists
+   several instances, for one device or for
+   all devices within a time window.
+ - Accepts external device IDs, which are translated to the surrogate IDs stored
+   in the tables, and adds the external IDs to the rows of multi-device queries.
+ - Computes exact or approximate (sketch based) percentiles of a device's data.
+ - Responds with "304 Not Modified" when the client's ETag is still current.
+ - Decodes the compressed device-hour blocks, when the data is stored as blocks.
+ - Exports the data of a time range to gzip compressed csv files in S3, in an
+   asynchronous export job, and serves presigned URLs of the files when it's done.
+ - Emits per-stage timings and counters in CloudWatch Embedded Metric Format.
+ - Profiles a sampled fraction of the invocations, when enabled.
 """
 
+import csv
+import hashlib
+import heapq
 import json
+import math
 import os
-from typing import Any, Literal
+import random
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from collections.abc import Callable, Hashable, Iterator, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import UTC, datetime, timedelta
+from functools import partial
+from typing import TYPE_CHECKING, Any, Literal, NamedTuple, Self
 
-import boto3
 import pymysql
-from aws_lambda_powertools.utilities.parser import (
+from botocore.exceptions import ClientError
+from pydantic import (
     BaseModel,
     Field,
+    Json,
+    StrictStr,
     ValidationError,
-    parse,
+    errors,
     root_validator,
+    validator,
 )
-from aws_lambda_powertools.utilities.typing import LambdaContext
-from botocore.exceptions import ClientError
+from pydantic.validators import int_validator
+
+from iot_common.aws import MAX_WORKERS, get_client
+from iot_common.blocks import BLOCK_SIZE, decode_block
+from iot_common.devices import (
+    DEVICE_ID_PATTERN,
+    FIRST_DEVICE_ID,
+    get_legacy_device_id,
+    get_shard,
+)
+from iot_common.errors import LambdaError
+from iot_common.metrics import Metrics
+from iot_common.profiling import profile_invocation
+from iot_common.sketch import SKETCH_RANK_ERROR, QuantileSketch
+
+if TYPE_CHECKING:
+    from aws_lambda_powertools.utilities.typing import LambdaContext
+
+# Supported downsampling resolutions and their bucket size in seconds
+RESOLUTIONS = {"1m": 60, "5m": 300, "15m": 900, "1h": 3600, "6h": 21600, "1d": 86400}
+
+# Rollup tables maintained by the file parser, from coarsest to finest
+ROLLUP_SIZES = {"daily": 86400, "hourly": 3600}
+
+# Maximum number of rows returned per page by cross-device time window queries
+MAX_WINDOW_ROWS = 1000
+
+# Number of blocks read per round trip by time window queries with block storage,
+# which stop reading once the page is complete
+WINDOW_BLOCK_BATCH = 100
+
+# Data columns of the table, which can be projected with the "fields" parameter
+DATA_FIELDS = ["temperature", "humidity", "hvac_status"]
+
+# Aggregates returned for each data column's buckets, computed from the raw rows
+BUCKET_COLUMNS = {
+    "temperature": {
+        "temperature_avg": "AVG(temperature)",
+        "temperature_min": "MIN(temperature)",
+        "temperature_max": "MAX(temperature)",
+    },
+    "humidity": {
+        "humidity_avg": "AVG(humidity)",
+        "humidity_min": "MIN(humidity)",
+        "humidity_max": "MAX(humidity)",
+    },
+    "hvac_status": {"hvac_on_ratio": "AVG(hvac_status)"},
+}
+
+# Aggregates returned for each data column's buckets, computed from the rollup rows
+ROLLUP_BUCKET_COLUMNS = {
+    "temperature": {
+        "temperature_avg": "SUM(temperature_sum) / SUM(sample_count)",
+        "temperature_min": "MIN(temperature_min)",
+        "temperature_max": "MAX(temperature_max)",
+    },
+    "humidity": {
+        "humidity_avg": "SUM(humidity_sum) / SUM(sample_count)",
+        "humidity_min": "MIN(humidity_min)",
+        "humidity_max": "MAX(humidity_max)",
+    },
+    "hvac_status": {"hvac_on_ratio": "SUM(hvac_on_count) / SUM(sample_count)"},
+}
 
+# Aggregates of the bucket columns, by alias suffix, for data decoded from blocks
+BLOCK_BUCKET_AGGREGATES: dict[str, Callable[[list[Any]], Any]] = {
+    "avg": lambda values: sum(values) / len(values),
+    "min": min,
+    "max": max,
+    "ratio": lambda values: round(sum(values) / len(values), 4),
+}
 
-class LambdaError(Exception):
-    def __init__(self, message: str) -> None:
-        self.message = message
-        super().__init__(self.message)
+# Data columns that percentiles can be computed for
+STATISTICS_FIELDS = ["temperature", "humidity"]
+
+
+# Storage layouts of the raw data, either one row per reading or device-hour blocks
+STORAGE_MODES = ["rows", "blocks"]
+
+
+# Largest surrogate device ID, the maximum of the int device_id columns
+MAX_DEVICE_ID = 2147483647
+
+# Prefix of the export jobs' objects in EXPORT_BUCKET, each job's status and files
+# are stored under "<prefix>/<job ID>/"
+EXPORT_PREFIX = "exports"
+
+# Compressed bytes uploaded per part of an export file, above the 5 MiB minimum
+# part size of S3 multipart uploads
+EXPORT_PART_SIZE = 8 * 1024 * 1024
+
+# Seconds of a device's data read per statement by exports, which bounds the rows
+# decoded at once with block storage
+EXPORT_WINDOW = 7 * 86400
+
+# Seconds after which a running export job has stopped, as Lambda invocations time
+# out after at most 15 minutes
+EXPORT_STALE_SECONDS = 15 * 60
+
+
+class DeviceNotFoundError(LambdaError):
+    """Raised when a requested external device ID isn't registered"""
 
 
 class QueryParameters(BaseModel):
     """Model to validate query parameters"""
 
-    device_id: int = Field(ge=0, le=999)
+    device_id: int | StrictStr | None
     datetime_from: int | None = Field(ge=0, le=2147483647)
     datetime_to: int | None = Field(ge=0, le=2147483647)
+    resolution: Literal["1m", "5m", "15m", "1h", "6h", "1d"] | None
+    fields: list[Literal["temperature", "humidity", "hvac_status"]] | None
+    limit: int = Field(MAX_WINDOW_ROWS, ge=1, le=MAX_WINDOW_ROWS)
+    page_token: str | None = Field(regex=r"^[0-9]+:[0-9]+$")
+
+    @validator("device_id", pre=True)
+    @classmethod
+    def device_id_validator(cls, value: Any) -> Any:
+        return parse_device_id(value)
+
+    @validator("fields", pre=True)
+    @classmethod
+    def split_fields(cls, value: Any) -> Any:
+        """Split comma separated fields, as sent in query strings"""
+        if isinstance(value, str):
+            return [field.strip() for field in value.split(",")]
+        return value
+
+    @validator("fields")
+    @classmethod
+    def normalize_fields(cls, value: list[str] | None) -> list[str] | None:
+        """Order the fields as in the table and drop duplicates"""
+        return [field for field in DATA_FIELDS if field in value] if value else None
 
     @root_validator
     @classmethod
@@ -45,6 +195,238 @@ class QueryParameters(BaseModel):
             )
         return values
 
+    @root_validator(skip_on_failure=True)
+    @classmethod
+    def validate_device_id(cls, values: dict[str, Any]) -> dict[str, Any]:
+        if values.get("device_id") is not None:
+            return values
+        if not values.get("datetime_from") or not values.get("datetime_to"):
+            raise ValueError(
+                "ensure 'device_id' is present, unless both 'datetime_from' "
+                "and 'datetime_to' are"
+            )
+        if values.get("resolution"):
+            raise ValueError("ensure 'device_id' is present when 'resolution' is")
+        return values
+
+
+class DeviceQuery(NamedTuple):
+    """Query of a single device, with the device's resolved surrogate ID"""
+
+    device_id: int
+    params: QueryParameters
+
+
+class QuerySegment(NamedTuple):
+    """Time range of a query that is read from a single source table"""
+
+    source: str
+    datetime_from: int | None
+    datetime_to: int | None
+
+
+class QueryPlan(NamedTuple):
+    """Source tables that a query is read from"""
+
+    name: str
+    segments: list[QuerySegment]
+
+
+class ResultCache:
+    """
+    Bounded LRU cache of query results, which expire after a TTL.
+
+    The cache lives for as long as the Lambda container is warm. Keys contain the
+    data version of the device, so results are never served after new data for
+    the device has been ingested.
+    """
+
+    def __init__(self, max_entries: int, ttl: float) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Any | None:
+        """Returns the cached value of the key, if present and not expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """Caches the value, evicting the least recently used entries when full"""
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: Hashable) -> None:
+        """Removes the key from the cache, if present"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+RESULT_CACHE = ResultCache(
+    max_entries=int(os.environ.get("CACHE_MAX_ENTRIES", "256")),
+    ttl=float(os.environ.get("CACHE_TTL_SECONDS", "300")),
+)
+
+# Discovered primary and read replica endpoints, so they aren't described per query
+ENDPOINT_CACHE = ResultCache(
+    max_entries=16, ttl=float(os.environ.get("ENDPOINT_CACHE_TTL_SECONDS", "60"))
+)
+
+
+# Per-stage metrics of the invocation, flushed as EMF log lines by the handler
+METRICS = Metrics(
+    namespace=os.environ.get("METRICS_NAMESPACE", "IotData"),
+    function_name=os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "data_retrieval_lambda"),
+)
+
+
+class DeviceDirectory:
+    """
+    Two-way mapping of the external device IDs and their surrogate IDs.
+
+    The devices are registered in the devices table of the first shard by the
+    file parser. Registered IDs never change, so the mapping is kept for as long
+    as the Lambda container is warm and only unseen IDs are looked up. Legacy IDs
+    ("device_NNN") map to their number without a lookup.
+    """
+
+    def __init__(self) -> None:
+        self._device_ids: dict[str, int] = {}
+        self._external_ids: dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    def get_device_ids(
+        self, router: "ShardRouter", table: str, external_ids: set[str]
+    ) -> dict[str, int]:
+        """Returns the surrogate IDs of the registered devices among the external IDs"""
+        with self._lock:
+            unseen = sorted(external_ids - self._device_ids.keys())
+        if unseen:
+            self.add(router, table, "external_id", unseen)
+        with self._lock:
+            return {
+                i: self._device_ids[i] for i in external_ids if i in self._device_ids
+            }
+
+    def get_external_ids(
+        self, router: "ShardRouter", table: str, device_ids: set[int]
+    ) -> dict[int, str]:
+        """Returns the external IDs of the registered devices among the surrogate IDs"""
+        external_ids = {
+            device_id: f"device_{device_id:03d}"
+            for device_id in device_ids
+            if device_id < FIRST_DEVICE_ID
+        }
+        with self._lock:
+            unseen = sorted(
+                device_ids - external_ids.keys() - self._external_ids.keys()
+            )
+        if unseen:
+            self.add(router, table, "device_id", unseen)
+        with self._lock:
+            return external_ids | {
+                i: self._external_ids[i] for i in device_ids if i in self._external_ids
+            }
+
+    def add(
+        self, router: "ShardRouter", table: str, column: str, values: list[Any]
+    ) -> None:
+        """Looks up the devices by the column's values, adding them to the mapping"""
+        rows = router.query(
+            router.rds_ids[0],
+            partial(query_devices, table=table, column=column, values=values),
+        )
+        with self._lock:
+            for row in rows:
+                self._device_ids[row["external_id"]] = row["device_id"]
+                self._external_ids[row["device_id"]] = row["external_id"]
+
+
+# Mapping of the external device IDs, kept across invocations (see DeviceDirectory)
+DEVICE_DIRECTORY = DeviceDirectory()
+
+
+class ShardRouter:
+    """
+    Runs queries on the MySQL shards, which each store the data of their devices.
+
+    Devices are mapped to a shard by hashing their ID (see get_shard). Each shard
+    is read from one of its healthy read replicas when it has any, falling back
+    to the shard's primary instance.
+    """
+
+    def __init__(
+        self,
+        rds_ids: list[str],
+        region: str,
+        max_replica_lag: float,
+        database: str,
+        user: str,
+        password: str,
+    ) -> None:
+        self.rds_ids = rds_ids
+        self.region = region
+        self.max_replica_lag = max_replica_lag
+        self.database = database
+        self.user = user
+        self.password = password
+
+    def get_shard(self, device_id: int) -> str:
+        """Returns the RDS ID of the shard that stores the device's data"""
+        return self.rds_ids[get_shard(device_id, len(self.rds_ids))]
+
+    def query(self, rds_id: str, query: Callable[[Any], Any]) -> Any:
+        """Run the query with a connection to the shard"""
+        return self.query_hosts(rds_id, self.get_hosts(rds_id), query)
+
+    def scatter(self, queries: dict[str, Callable[[Any], Any]]) -> dict[str, Any]:
+        """Run the queries of the shards in parallel, returning the shards' results"""
+        # Endpoints are discovered up front, as creating boto3 clients isn't thread safe
+        hosts = {rds_id: self.get_hosts(rds_id) for rds_id in queries}
+        if len(queries) <= 1:
+            return {
+                rds_id: self.query_hosts(rds_id, hosts[rds_id], query)
+                for rds_id, query in queries.items()
+            }
+        with ThreadPoolExecutor(max_workers=min(len(queries), MAX_WORKERS)) as executor:
+            futures = {
+                rds_id: executor.submit(self.query_hosts, rds_id, hosts[rds_id], query)
+                for rds_id, query in queries.items()
+            }
+            return {rds_id: future.result() for rds_id, future in futures.items()}
+
+    def get_hosts(self, rds_id: str) -> list[str]:
+        """Returns the hosts to read the shard from, in order of preference"""
+        return get_read_hosts(rds_id, self.region, self.max_replica_lag)
+
+    def query_hosts(
+        self, rds_id: str, hosts: list[str], query: Callable[[Any], Any]
+    ) -> Any:
+        """Run the query on the first host that can be connected to"""
+        for host in hosts[:-1]:
+            try:
+                with connect_to_rds(
+                    host, self.database, self.user, self.password
+                ) as conn:
+                    return query(conn)
+            except LambdaError as e:
+                print(f"Falling back to the primary instance: {e.message}")
+                ENDPOINT_CACHE.delete((rds_id, self.region, self.max_replica_lag))
+        with connect_to_rds(hosts[-1], self.database, self.user, self.password) as conn:
+            return query(conn)
+
 
 class ApiGatewayEvent(BaseModel):
     """Model to validate parameters sent by API Gateway"""
@@ -52,34 +434,855 @@ class ApiGatewayEvent(BaseModel):
     resource: Literal["/data"]
     httpMethod: Literal["GET"]
     queryStringParameters: QueryParameters
+    headers: dict[str, str] | None
+
+
+class BatchQuery(BaseModel):
+    """Model to validate the body of a batch query"""
+
+    queries: list[QueryParameters] = Field(min_items=1, max_items=200)
+    # Device IDs of the queries as they were requested, set from the queries
+    requested_ids: list[str] = []
+
+    @root_validator(pre=True)
+    @classmethod
+    def set_requested_ids(cls, values: dict[str, Any]) -> dict[str, Any]:
+        """Keep the requested device IDs, as parsing maps legacy IDs to numbers"""
+        queries = values.get("queries")
+        if isinstance(queries, list):
+            values["requested_ids"] = [
+                str(query.get("device_id")).strip() if isinstance(query, dict) else ""
+                for query in queries
+            ]
+        return values
+
+    @validator("queries")
+    @classmethod
+    def validate_queries(cls, queries: list[QueryParameters]) -> list[QueryParameters]:
+        device_ids = [query.device_id for query in queries]
+        if None in device_ids:
+            raise ValueError("ensure each query has a 'device_id'")
+        if len(set(device_ids)) != len(device_ids):
+            raise ValueError("ensure each device is only queried once")
+        if len({query.resolution for query in queries}) > 1:
+            raise ValueError("ensure all queries use the same resolution")
+        if len({tuple(query.fields or DATA_FIELDS) for query in queries}) > 1:
+            raise ValueError("ensure all queries use the same fields")
+        return queries
+
+
+class BatchApiGatewayEvent(BaseModel):
+    """Model to validate batch queries sent by API Gateway"""
+
+    resource: Literal["/data/batch"]
+    httpMethod: Literal["POST"]
+    body: Json[BatchQuery]
+
+
+class LatestQueryParameters(BaseModel):
+    """Model to validate query parameters of latest reading queries"""
+
+    device_ids: list[int | StrictStr] | None
+
+    @validator("device_ids", pre=True)
+    @classmethod
+    def split_device_ids(cls, value: Any) -> Any:
+        """Split comma separated device IDs, as sent in query strings"""
+        if isinstance(value, str):
+            value = value.split(",")
+        if isinstance(value, list):
+            return [parse_device_id(device_id) for device_id in value]
+        return value
+
+
+class LatestApiGatewayEvent(BaseModel):
+    """Model to validate latest reading queries sent by API Gateway"""
 
+    resource: Literal["/data/latest"]
+    httpMethod: Literal["GET"]
+    queryStringParameters: LatestQueryParameters | None
+
+
+class StatisticsQueryParameters(BaseModel):
+    """Model to validate query parameters of statistics queries"""
+
+    device_id: int | StrictStr
+    datetime_from: int = Field(ge=0, le=2147483647)
+    datetime_to: int = Field(ge=0, le=2147483647)
+    fields: list[Literal["temperature", "humidity"]] | None
+    percentiles: list[float] = Field([50.0], min_items=1, max_items=20)
+    mode: Literal["approximate", "exact"] = "approximate"
+
+    @validator("device_id", pre=True)
+    @classmethod
+    def device_id_validator(cls, value: Any) -> Any:
+        return parse_device_id(value)
+
+    @validator("fields", "percentiles", pre=True)
+    @classmethod
+    def split_values(cls, value: Any) -> Any:
+        """Split comma separated values, as sent in query strings"""
+        if isinstance(value, str):
+            return [item.strip() for item in value.split(",")]
+        return value
+
+    @validator("fields")
+    @classmethod
+    def normalize_fields(cls, value: list[str] | None) -> list[str] | None:
+        """Order the fields as in the table and drop duplicates"""
+        return (
+            [field for field in STATISTICS_FIELDS if field in value] if value else None
+        )
+
+    @validator("percentiles", each_item=True)
+    @classmethod
+    def validate_percentile(cls, value: float) -> float:
+        if not 0 <= value <= 100:
+            raise ValueError("ensure percentiles are between 0 and 100")
+        return value
+
+    @root_validator(skip_on_failure=True)
+    @classmethod
+    def validate_datetimes(cls, values: dict[str, Any]) -> dict[str, Any]:
+        if values["datetime_from"] >= values["datetime_to"]:
+            raise ValueError("ensure 'datetime_from' is before 'datetime_to'")
+        return values
+
+
+class StatisticsApiGatewayEvent(BaseModel):
+    """Model to validate statistics queries sent by API Gateway"""
+
+    resource: Literal["/data/statistics"]
+    httpMethod: Literal["GET"]
+    queryStringParameters: StatisticsQueryParameters
+
+
+class ExportQuery(BaseModel):
+    """Model to validate the body of an export request"""
+
+    device_ids: list[int | StrictStr] | None = Field(min_items=1, max_items=1000)
+    datetime_from: int = Field(ge=0, le=2147483647)
+    datetime_to: int = Field(ge=0, le=2147483647)
+    fields: list[Literal["temperature", "humidity", "hvac_status"]] | None
+    format: Literal["csv"] = "csv"
+
+    @validator("device_ids", pre=True)
+    @classmethod
+    def device_ids_validator(cls, value: Any) -> Any:
+        if isinstance(value, list):
+            return [parse_device_id(device_id) for device_id in value]
+        return value
+
+    @validator("fields")
+    @classmethod
+    def normalize_fields(cls, value: list[str] | None) -> list[str] | None:
+        """Order the fields as in the table and drop duplicates"""
+        return [field for field in DATA_FIELDS if field in value] if value else None
+
+    @root_validator(skip_on_failure=True)
+    @classmethod
+    def validate_datetimes(cls, values: dict[str, Any]) -> dict[str, Any]:
+        if values["datetime_from"] >= values["datetime_to"]:
+            raise ValueError("ensure 'datetime_from' is before 'datetime_to'")
+        return values
+
+
+class ExportApiGatewayEvent(BaseModel):
+    """Model to validate export requests sent by API Gateway"""
+
+    resource: Literal["/data/export"]
+    httpMethod: Literal["POST"]
+    body: Json[ExportQuery]
+
+
+class ExportStatusQueryParameters(BaseModel):
+    """Model to validate query parameters of export status requests"""
+
+    job_id: str = Field(regex=r"^[0-9a-f]{32}$")
+
+
+class ExportStatusApiGatewayEvent(BaseModel):
+    """Model to validate export status requests sent by API Gateway"""
+
+    resource: Literal["/data/export/status"]
+    httpMethod: Literal["GET"]
+    queryStringParameters: ExportStatusQueryParameters
+
+
+# Any of the events sent by API Gateway
+ApiEvent = (
+    ApiGatewayEvent
+    | BatchApiGatewayEvent
+    | LatestApiGatewayEvent
+    | StatisticsApiGatewayEvent
+    | ExportApiGatewayEvent
+    | ExportStatusApiGatewayEvent
+)
+
+
+class GzipMultipartUpload:
+    """
+    Writer that gzip compresses text into an S3 object, as it's being written.
+
+    The compressed stream is uploaded with a multipart upload, a part every
+    EXPORT_PART_SIZE bytes, so the memory used doesn't grow with the object. The
+    upload is completed when the context exits, or aborted on an error.
+    """
 
-def handler(event: Any, _context: LambdaContext) -> dict[str, Any]:
+    def __init__(self, s3_client: Any, bucket: str, key: str) -> None:
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.size = 0
+        self._compressor = zlib.compressobj(wbits=31)
+        self._buffer = bytearray()
+        self._parts: list[dict[str, Any]] = []
+        self._upload_id: str | None = None
+
+    def __enter__(self) -> Self:
+        # Starts over, as a shard retried on another host writes the file again
+        self.size = 0
+        self._compressor = zlib.compressobj(wbits=31)
+        self._buffer.clear()
+        self._parts.clear()
+        response = self.s3_client.create_multipart_upload(
+            Bucket=self.bucket, Key=self.key, ContentEncoding="gzip"
+        )
+        self._upload_id = response["UploadId"]
+        return self
+
+    def __exit__(self, exc_type: type[BaseException] | None, *_args: object) -> None:
+        if exc_type is not None:
+            self.abort()
+            return
+        try:
+            self._buffer += self._compressor.flush()
+            self.upload_part()
+            self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self._upload_id,
+                MultipartUpload={"Parts": self._parts},
+            )
+        except BaseException:
+            self.abort()
+            raise
+
+    def abort(self) -> None:
+        """Aborts the upload, so S3 drops the uploaded parts"""
+        try:
+            self.s3_client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self._upload_id
+            )
+        except ClientError as e:
+            # The original error is more useful, and the bucket's lifecycle rule
+            # drops the parts of incomplete uploads anyway
+            print(f"Failed to abort the upload of '{self.key}': {e}")
+
+    def write(self, text: str) -> None:
+        """Compresses the text, uploading a part once enough is buffered"""
+        self._buffer += self._compressor.compress(text.encode("utf-8"))
+        if len(self._buffer) >= EXPORT_PART_SIZE:
+            self.upload_part()
+
+    def upload_part(self) -> None:
+        """Uploads the buffered bytes as the next part"""
+        part_number = len(self._parts) + 1
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self._upload_id,
+            PartNumber=part_number,
+            Body=bytes(self._buffer),
+        )
+        self._parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+        self.size += len(self._buffer)
+        self._buffer.clear()
+
+
+# Models of the events sent by API Gateway, for resources other than "/data"
+EVENT_MODELS: dict[Any, type[ApiEvent]] = {
+    "/data/batch": BatchApiGatewayEvent,
+    "/data/latest": LatestApiGatewayEvent,
+    "/data/statistics": StatisticsApiGatewayEvent,
+    "/data/export": ExportApiGatewayEvent,
+    "/data/export/status": ExportStatusApiGatewayEvent,
+}
+
+
+def handler(event: Any, _context: "LambdaContext") -> dict[str, Any]:
     """Handler function that is called by AWS Lambda"""
+    with profile_invocation(event, METRICS.function_name):
+        try:
+            # Export jobs are run by asynchronous invocations (see handle_export)
+            export_job: str = (
+                event.get("export_job", "") if isinstance(event, dict) else ""
+            )
+            api_event = None if export_job else validate_event(event)
+            secret_manager_id = get_env_value("SECRET_MANAGER_ID")
+            region = get_env_value("REGION")
+            # A comma separated list of IDs, when the data is sharded across instances
+            rds_ids = [
+                rds_id.strip() for rds_id in get_env_value("MYSQL_ID").split(",")
+            ]
+            database = get_env_value("MYSQL_DATABASE")
+            table = get_env_value("MYSQL_TABLE")
+            storage_mode = os.environ.get("STORAGE_MODE", "rows")
+            if storage_mode not in STORAGE_MODES:
+                raise LambdaError(f"Invalid storage mode: {storage_mode}")
+
+            max_replica_lag = float(os.environ.get("MAX_REPLICA_LAG_SECONDS", "30"))
+            user, password = get_db_credentials(secret_manager_id, region)
+            router = ShardRouter(
+                rds_ids,
+                region,
+                max_replica_lag,
+                database,
+                user,
+                password,
+            )
+            if api_event is None:
+                with METRICS.timer("export"):
+                    return run_export_job(router, table, export_job, storage_mode)
+            with METRICS.timer("query"):
+                return handle_event(router, table, api_event, storage_mode)
+        except ValidationError as e:
+            return {"statusCode": 400, "body": json.dumps({"errors": e.errors()})}
+        except DeviceNotFoundError as e:
+            return {
+                "statusCode": 404,
+                "body": json.dumps({"errors": [{"msg": e.message}]}),
+            }
+        finally:
+            METRICS.flush()
+
+
+def handle_event(
+    router: ShardRouter,
+    table: str,
+    api_event: ApiEvent,
+    storage_mode: str = "rows",
+) -> dict[str, Any]:
+    """
+    Routes the event to the handler of the requested query.
+
+    Single device queries are run on the device's shard, while multi-device
+    queries are scattered across the shards and their results gathered. External
+    device IDs are resolved to their surrogate IDs first.
+    """
+    if isinstance(api_event, ExportStatusApiGatewayEvent):
+        return handle_export_status(api_event)
+    if isinstance(api_event, ExportApiGatewayEvent):
+        return handle_export(router, table, api_event)
+    if isinstance(api_event, BatchApiGatewayEvent):
+        return handle_batch_query(router, table, api_event, storage_mode)
+    if isinstance(api_event, LatestApiGatewayEvent):
+        return handle_latest_query(router, table, api_event)
+    if isinstance(api_event, StatisticsApiGatewayEvent):
+        requested = [api_event.queryStringParameters.device_id]
+        (device_id,) = resolve_device_ids(router, table, requested)
+        return router.query(
+            router.get_shard(device_id),
+            lambda conn: handle_statistics_query(
+                conn, table, api_event, device_id, storage_mode
+            ),
+        )
+    if api_event.queryStringParameters.device_id is None:
+        return handle_time_window_query(router, table, api_event, storage_mode)
+    (device_id,) = resolve_device_ids(
+        router, table, [api_event.queryStringParameters.device_id]
+    )
+    return router.query(
+        router.get_shard(device_id),
+        lambda conn: handle_query(conn, table, api_event, device_id, storage_mode),
+    )
+
+
+def resolve_device_ids(
+    router: ShardRouter, table: str, requested: list[int | str]
+) -> list[int]:
+    """
+    Returns the surrogate IDs of the requested device IDs, in the same order.
+
+    Surrogate IDs are returned as is, while external IDs are looked up in the
+    devices table. Raises a DeviceNotFoundError for unregistered IDs.
+    """
+    external_ids = {i for i in requested if isinstance(i, str)}
+    device_ids = DEVICE_DIRECTORY.get_device_ids(router, table, external_ids)
+    unknown = sorted(external_ids - device_ids.keys())
+    if unknown:
+        raise DeviceNotFoundError(f"Unknown device id(s): {', '.join(unknown)}")
+    return [device_ids[i] if isinstance(i, str) else i for i in requested]
+
+
+def add_external_ids(router: ShardRouter, table: str, rows: list[Any]) -> list[Any]:
+    """Returns the rows with the external device ID next to the surrogate ID"""
+    external_ids = DEVICE_DIRECTORY.get_external_ids(
+        router, table, {row["device_id"] for row in rows}
+    )
+    return [row | {"external_id": external_ids.get(row["device_id"])} for row in rows]
+
+
+def handle_query(
+    conn: Any,
+    table: str,
+    api_event: ApiGatewayEvent,
+    device_id: int,
+    storage_mode: str = "rows",
+) -> dict[str, Any]:
+    """Handles a query for the data of a single device, by its surrogate ID"""
+    params = api_event.queryStringParameters
+    plan = plan_query(params.datetime_from, params.datetime_to, params.resolution)
+    version = get_data_version(conn, table, device_id)
+    etag = get_etag(version, params)
+    if etag_matches(etag, get_header(api_event.headers, "If-None-Match")):
+        return {"statusCode": 304, "headers": {"ETag": etag}}
+    results = query_rds(
+        conn,
+        table,
+        device_id,
+        params.datetime_from,
+        params.datetime_to,
+        resolution=params.resolution,
+        fields=params.fields,
+        plan=plan,
+        cache=RESULT_CACHE,
+        version=version,
+        storage_mode=storage_mode,
+    )
+    METRICS.add("query", "RowsReturned", len(results))
+    return {
+        "statusCode": 200,
+        "headers": {"ETag": etag},
+        "body": json.dumps({"results": results, "plan": plan.name}, default=float),
+    }
+
+
+def handle_time_window_query(
+    router: ShardRouter,
+    table: str,
+    api_event: ApiGatewayEvent,
+    storage_mode: str = "rows",
+) -> dict[str, Any]:
+    """Handles a query for the data of all devices within a time window"""
+    params = api_event.queryStringParameters
+    # QueryParameters requires both datetimes when no device ID is given
+    datetime_from, datetime_to = params.datetime_from or 0, params.datetime_to or 0
+
+    def query(conn: Any) -> tuple[list[Any], str | None]:
+        return query_time_window(
+            conn,
+            table,
+            datetime_from,
+            datetime_to,
+            fields=params.fields,
+            limit=params.limit,
+            page_token=params.page_token,
+            storage_mode=storage_mode,
+        )
+
+    pages = router.scatter({rds_id: query for rds_id in router.rds_ids})
+    results, next_page_token = merge_pages(list(pages.values()), params.limit)
+    results = add_external_ids(router, table, results)
+    METRICS.add("query", "RowsReturned", len(results))
+    return {
+        "statusCode": 200,
+        "body": json.dumps(
+            {"results": results, "next_page_token": next_page_token}, default=float
+        ),
+    }
+
+
+def handle_batch_query(
+    router: ShardRouter,
+    table: str,
+    api_event: BatchApiGatewayEvent,
+    storage_mode: str = "rows",
+) -> dict[str, Any]:
+    """
+    Handles a batch of queries, which are read from each shard in one round trip.
+
+    The results are keyed by the device IDs exactly as requested, either the
+    surrogate IDs or the external IDs (including legacy IDs like "device_002").
+    """
+    # BatchQuery ensures that each query has a device ID
+    requested = [q.device_id for q in api_event.body.queries if q.device_id is not None]
+    queries = [
+        DeviceQuery(device_id, query)
+        for device_id, query in zip(
+            resolve_device_ids(router, table, requested), api_event.body.queries
+        )
+    ]
+    keys = {
+        query.device_id: requested_id
+        for query, requested_id in zip(queries, api_event.body.requested_ids)
+    }
+    shard_queries: dict[str, list[DeviceQuery]] = {}
+    for query in queries:
+        shard_queries.setdefault(router.get_shard(query.device_id), []).append(query)
+    shard_rows = router.scatter(
+        {
+            rds_id: partial(
+                query_batch, table=table, queries=batch, storage_mode=storage_mode
+            )
+            for rds_id, batch in shard_queries.items()
+        }
+    )
+
+    results: dict[str, list[Any]] = {keys[query.device_id]: [] for query in queries}
+    for rows in shard_rows.values():
+        METRICS.add("query", "RowsReturned", len(rows))
+        for row in rows:
+            results[keys[row["device_id"]]].append(row)
+    plans = {
+        keys[device_id]: plan_query(
+            params.datetime_from, params.datetime_to, params.resolution
+        ).name
+        for device_id, params in queries
+    }
+    return {
+        "statusCode": 200,
+        "body": json.dumps({"results": results, "plans": plans}, default=float),
+    }
+
+
+def handle_latest_query(
+    router: ShardRouter, table: str, api_event: LatestApiGatewayEvent
+) -> dict[str, Any]:
+    """Handles a query for the latest reading of the requested (or all) devices"""
+    params = api_event.queryStringParameters
+    shard_device_ids: dict[str, list[int] | None] = {
+        rds_id: None for rds_id in router.rds_ids
+    }
+    if params and params.device_ids:
+        requested: dict[str, list[int]] = {}
+        for device_id in resolve_device_ids(router, table, params.device_ids):
+            requested.setdefault(router.get_shard(device_id), []).append(device_id)
+        shard_device_ids = dict(requested)
+    shard_results = router.scatter(
+        {
+            rds_id: partial(query_latest, table=table, device_ids=device_ids)
+            for rds_id, device_ids in shard_device_ids.items()
+        }
+    )
+    results = sorted(
+        (row for rows in shard_results.values() for row in rows),
+        key=lambda row: row["device_id"],
+    )
+    results = add_external_ids(router, table, results)
+    METRICS.add("query", "RowsReturned", len(results))
+    return {"statusCode": 200, "body": json.dumps({"results": results})}
+
+
+def handle_statistics_query(
+    conn: Any,
+    table: str,
+    api_event: StatisticsApiGatewayEvent,
+    device_id: int,
+    storage_mode: str = "rows",
+) -> dict[str, Any]:
+    """Handles a query for the percentiles of a device's data, by its surrogate ID"""
+    params = api_event.queryStringParameters
+    results, plan = query_statistics(
+        conn,
+        table,
+        device_id,
+        params.datetime_from,
+        params.datetime_to,
+        fields=params.fields,
+        percentiles=params.percentiles,
+        mode=params.mode,
+        storage_mode=storage_mode,
+    )
+    rank_error = SKETCH_RANK_ERROR if params.mode == "approximate" else 0
+    return {
+        "statusCode": 200,
+        "body": json.dumps(
+            {"results": results, "plan": plan.name, "rank_error": rank_error}
+        ),
+    }
+
+
+def handle_export(
+    router: ShardRouter, table: str, api_event: ExportApiGatewayEvent
+) -> dict[str, Any]:
+    """
+    Handles a request to export data to S3, by starting an export job.
+
+    The job is run by an asynchronous invocation of the Lambda function, off the
+    latency-sensitive query path, and its status is polled from the
+    "/data/export/status" endpoint. The job's query stores the surrogate IDs of
+    the requested devices.
+    """
+    query = api_event.body
+    if query.device_ids:
+        query = query.copy(
+            update={"device_ids": resolve_device_ids(router, table, query.device_ids)}
+        )
+    job_id = uuid.uuid4().hex
+    now = int(time.time())
+    job = {
+        "job_id": job_id,
+        "status": "pending",
+        "query": query.dict(),
+        "created_at": now,
+        "updated_at": now,
+    }
+    put_export_job(job)
+    get_client("lambda", os.environ.get("REGION")).invoke(
+        FunctionName=get_env_value("AWS_LAMBDA_FUNCTION_NAME"),
+        InvocationType="Event",
+        Payload=json.dumps({"export_job": job_id}).encode("utf-8"),
+    )
+    print(f"Started export job '{job_id}'")
+    return {
+        "statusCode": 202,
+        "body": json.dumps({"job_id": job_id, "status": "pending"}),
+    }
+
+
+def handle_export_status(api_event: ExportStatusApiGatewayEvent) -> dict[str, Any]:
+    """Handles a request for an export job's status, with its files' URLs when done"""
+    job_id = api_event.queryStringParameters.job_id
+    job = get_export_job(job_id)
+    if job is None:
+        return {
+            "statusCode": 404,
+            "body": json.dumps({"errors": [{"msg": f"Unknown export job: {job_id}"}]}),
+        }
+    if is_stale_export_job(job):
+        # The invocation running the job timed out or crashed, and wasn't retried
+        job |= {"status": "failed", "error": "Export job timed out"}
+        job["updated_at"] = int(time.time())
+        put_export_job(job)
+    if job["status"] == "succeeded":
+        s3_client = get_client("s3", os.environ.get("REGION"))
+        bucket = get_env_value("EXPORT_BUCKET")
+        expires_in = int(os.environ.get("EXPORT_URL_TTL_SECONDS", "3600"))
+        job["files"] = [
+            file
+            | {
+                "url": s3_client.generate_presigned_url(
+                    "get_object",
+                    Params={"Bucket": bucket, "Key": file["key"]},
+                    ExpiresIn=expires_in,
+                )
+            }
+            for file in job["files"]
+        ]
+    return {"statusCode": 200, "body": json.dumps(job)}
+
+
+def run_export_job(
+    router: ShardRouter, table: str, job_id: str, storage_mode: str = "rows"
+) -> dict[str, Any]:
+    """
+    Runs a pending export job, writing a gzip compressed csv file per shard.
+
+    The job's status is updated as it runs. Any error marks the job as failed
+    instead of raising, as Lambda would retry the asynchronous invocation, and
+    retried invocations of a started job do nothing. Only a job left running by
+    an invocation that timed out or crashed is run again, once it's stale.
+    """
+    job = get_export_job(job_id)
+    if job is None:
+        raise LambdaError(f"Unknown export job: {job_id}")
+    if is_stale_export_job(job):
+        print(f"Export job '{job_id}' is stale, running it again")
+    elif job["status"] != "pending":
+        print(f"Export job '{job_id}' is already {job['status']}")
+        return job
+    job |= {"status": "running", "updated_at": int(time.time())}
+    put_export_job(job)
+    print(f"Running export job '{job_id}'")
     try:
-        api_event = validate_event(event)
-        secret_manager_id = get_env_value("SECRET_MANAGER_ID")
-        region = get_env_value("REGION")
-        rds_id = get_env_value("MYSQL_ID")
-        database = get_env_value("MYSQL_DATABASE")
-        table = get_env_value("MYSQL_TABLE")
+        files = export_shards(
+            router, table, job_id, ExportQuery.parse_obj(job["query"]), storage_mode
+        )
+        job |= {"status": "succeeded", "files": files}
+    except Exception as e:  # noqa: BLE001  # pylint: disable=broad-exception-caught
+        # Otherwise the job would be left running, as retries skip started jobs
+        error = str(e) if isinstance(e, LambdaError) else f"{type(e).__name__}: {e}"
+        print(f"Export job '{job_id}' failed: {error}")
+        job |= {"status": "failed", "error": error}
+    job["updated_at"] = int(time.time())
+    put_export_job(job)
+    return job
+
+
+def is_stale_export_job(job: dict[str, Any]) -> bool:
+    """
+    Returns whether the job is left running by an invocation that has stopped.
+
+    The job's updated_at is set when it starts running, and no invocation runs
+    for longer than EXPORT_STALE_SECONDS.
+    """
+    return (
+        job["status"] == "running"
+        and time.time() - job["updated_at"] > EXPORT_STALE_SECONDS
+    )
+
 
-        host = get_rds_endpoint(rds_id, region)
-        user, password = get_db_credentials(secret_manager_id, region)
+def export_shards(
+    router: ShardRouter,
+    table: str,
+    job_id: str,
+    query: ExportQuery,
+    storage_mode: str = "rows",
+) -> list[dict[str, Any]]:
+    """
+    Export the queried data of each shard to a file, reading the shards in parallel.
+
+    Returns the key, rows and size of each file, in the order of the shards.
+    """
+    if query.device_ids:
+        shard_device_ids: dict[str, list[int]] = {}
+        # Surrogate IDs are returned as is, without a lookup
+        for device_id in resolve_device_ids(router, table, query.device_ids):
+            shard_device_ids.setdefault(router.get_shard(device_id), []).append(
+                device_id
+            )
+    else:
+        shard_device_ids = router.scatter(
+            {
+                rds_id: partial(query_stored_device_ids, table=table)
+                for rds_id in router.rds_ids
+            }
+        )
+    external_ids = DEVICE_DIRECTORY.get_external_ids(
+        router,
+        table,
+        {i for device_ids in shard_device_ids.values() for i in device_ids},
+    )
+    # The client is created up front, as creating boto3 clients isn't thread safe
+    s3_client = get_client("s3", os.environ.get("REGION"))
+    bucket = get_env_value("EXPORT_BUCKET")
+    shard_files = router.scatter(
+        {
+            rds_id: partial(
+                export_shard,
+                table=table,
+                device_ids=device_ids,
+                external_ids=external_ids,
+                query=query,
+                storage_mode=storage_mode,
+                upload=GzipMultipartUpload(
+                    s3_client,
+                    bucket,
+                    get_export_key(
+                        job_id, f"part-{router.rds_ids.index(rds_id):04d}.csv.gz"
+                    ),
+                ),
+            )
+            for rds_id, device_ids in shard_device_ids.items()
+            if device_ids
+        }
+    )
+    return [shard_files[rds_id] for rds_id in router.rds_ids if rds_id in shard_files]
+
+
+def export_shard(
+    conn: Any,
+    table: str,
+    device_ids: list[int],
+    external_ids: dict[int, str],
+    query: ExportQuery,
+    upload: GzipMultipartUpload,
+    storage_mode: str = "rows",
+) -> dict[str, Any]:
+    """
+    Export the data of the shard's devices to a gzip compressed csv file.
+
+    The rows are streamed device by device, a window at a time, over an
+    unbuffered cursor into the multipart upload, so neither the rows nor the file
+    are held in memory.
+    """
+    fields = query.fields or DATA_FIELDS
+    rows = 0
+    with upload:
+        writer = csv.writer(upload, lineterminator="\n")
+        writer.writerow(["device_id", "external_id", "timestamp", *fields])
+        for device_id in sorted(device_ids):
+            external_id = external_ids.get(device_id)
+            for start in range(query.datetime_from, query.datetime_to, EXPORT_WINDOW):
+                for values in stream_values(
+                    conn,
+                    table,
+                    device_id,
+                    start,
+                    min(start + EXPORT_WINDOW, query.datetime_to),
+                    ["timestamp", *fields],
+                    storage_mode,
+                ):
+                    writer.writerow((device_id, external_id, *values))
+                    rows += 1
+    METRICS.add("export", "RowsExported", rows)
+    METRICS.add("export", "Bytes", upload.size, "Bytes")
+    return {"key": upload.key, "rows": rows, "bytes": upload.size}
+
+
+def get_export_key(job_id: str, name: str) -> str:
+    """Returns the key of an export job's object in EXPORT_BUCKET"""
+    return f"{EXPORT_PREFIX}/{job_id}/{name}"
 
-        device_id = api_event.queryStringParameters.device_id
-        datetime_from = api_event.queryStringParameters.datetime_from
-        datetime_to = api_event.queryStringParameters.datetime_to
-        results = read_from_rds(
-            host, database, user, password, table, device_id, datetime_from, datetime_to
+
+def put_export_job(job: dict[str, Any]) -> None:
+    """Stores the export job's status in EXPORT_BUCKET"""
+    get_client("s3", os.environ.get("REGION")).put_object(
+        Bucket=get_env_value("EXPORT_BUCKET"),
+        Key=get_export_key(job["job_id"], "status.json"),
+        Body=json.dumps(job).encode("utf-8"),
+        ContentType="application/json",
+    )
+
+
+def get_export_job(job_id: str) -> dict[str, Any] | None:
+    """Returns the stored status of the export job, or None for unknown jobs"""
+    try:
+        response = get_client("s3", os.environ.get("REGION")).get_object(
+            Bucket=get_env_value("EXPORT_BUCKET"),
+            Key=get_export_key(job_id, "status.json"),
         )
-        return {"statusCode": 200, "body": json.dumps({"results": results})}
-    except ValidationError as e:
-        return {"statusCode": 400, "body": json.dumps({"errors": e.errors()})}
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "NoSuchKey":
+            return None
+        raise LambdaError(f"Failed to retrieve export job '{job_id}': {e}") from e
+    return json.loads(response["Body"].read())
+
 
+def validate_event(
+    event: Any,
+) -> ApiEvent:
+    """Validate the event with the model of the requested resource"""
+    resource = event.get("resource") if isinstance(event, dict) else None
+    model = EVENT_MODELS.get(resource, ApiGatewayEvent)
+    return model.parse_obj(event)
 
-def validate_event(event: Any) -> ApiGatewayEvent:
-    return parse(event=event, model=ApiGatewayEvent)
+
+def parse_device_id(value: Any) -> int | str | None:
+    """
+    Parses a requested device ID, which is a surrogate ID or an external ID.
+
+    Numbers are surrogate IDs and legacy IDs ("device_NNN") map to their number,
+    while other external IDs are kept, to be resolved by resolve_device_ids.
+    """
+    if isinstance(value, str):
+        value = value.strip()
+        legacy_device_id = get_legacy_device_id(value)
+        if legacy_device_id is not None:
+            return legacy_device_id
+        if not value.lstrip("-").isdigit():
+            if not DEVICE_ID_PATTERN.match(value):
+                raise ValueError(f"invalid device id format provided: {value}")
+            return value
+    if value is None:
+        return None
+    device_id = int_validator(value)
+    if device_id < 0:
+        raise errors.NumberNotGeError(limit_value=0)
+    if device_id > MAX_DEVICE_ID:
+        raise errors.NumberNotLeError(limit_value=MAX_DEVICE_ID)
+    return device_id
 
 
 def get_env_value(env_var: str) -> str:
@@ -90,27 +1293,119 @@ def get_env_value(env_var: str) -> str:
     return value
 
 
-def get_rds_endpoint(rds_id: str, region: str) -> str:
-    """Retrieves the ARN of the RDS instance"""
-    print("Retrieving RDS ARN")
-    rds_client = boto3.client("rds", region_name=region)
+def get_read_hosts(rds_id: str, region: str, max_replica_lag: float) -> list[str]:
+    """
+    Returns the hosts to read from, in order of preference.
+
+    Reads are spread randomly across the healthy read replicas, with the primary
+    instance as the fallback. The discovered endpoints are cached for
+    ENDPOINT_CACHE_TTL_SECONDS.
+    """
+    key = (rds_id, region, max_replica_lag)
+    endpoints = ENDPOINT_CACHE.get(key)
+    if endpoints is None:
+        endpoints = get_rds_endpoints(rds_id, region, max_replica_lag)
+        ENDPOINT_CACHE.put(key, endpoints)
+    primary, replicas = endpoints
+    return [random.choice(replicas), primary] if replicas else [primary]
+
+
+def get_rds_endpoints(
+    rds_id: str, region: str, max_replica_lag: float
+) -> tuple[str, list[str]]:
+    """
+    Retrieves the endpoints of the RDS instance and of its healthy read replicas.
+
+    A read replica is healthy when it's available, replicating, and its
+    ReplicaLag metric is at most max_replica_lag seconds. Replicas without a
+    recent ReplicaLag datapoint are skipped, as their staleness is unknown.
+    """
+    print("Retrieving RDS endpoints")
+    rds_client = get_client("rds", region)
     try:
         response = rds_client.describe_db_instances(DBInstanceIdentifier=rds_id)
+        instance = response["DBInstances"][0]
+        primary = instance["Endpoint"]["Address"]
     except ClientError as e:
         raise LambdaError(f"Failed to retrieve '{rds_id}' RDS instance: {e}") from e
-    try:
-        endpoint = response["DBInstances"][0]["Endpoint"]["Address"]
     except (KeyError, IndexError) as e:
         raise LambdaError(
             f"Failed to retrieve endpoint for '{rds_id} 'RDS instance: {e}"
         ) from e
-    return endpoint
+
+    replica_ids = instance.get("ReadReplicaDBInstanceIdentifiers", [])
+    if not replica_ids:
+        return primary, []
+    try:
+        response = rds_client.describe_db_instances(
+            Filters=[{"Name": "db-instance-id", "Values": replica_ids}]
+        )
+    except ClientError as e:
+        print(f"Failed to retrieve read replicas of '{rds_id}': {e}")
+        return primary, []
+    candidates = {
+        replica["DBInstanceIdentifier"]: replica["Endpoint"]["Address"]
+        for replica in response["DBInstances"]
+        if replica.get("DBInstanceStatus") == "available"
+        and "Endpoint" in replica
+        and all(
+            info.get("Status") == "replicating"
+            for info in replica.get("StatusInfos", [])
+            if info.get("StatusType") == "read replication"
+        )
+    }
+    lags = get_replica_lags(list(candidates), region)
+    replicas = [
+        address
+        for replica_id, address in sorted(candidates.items())
+        if replica_id in lags and lags[replica_id] <= max_replica_lag
+    ]
+    return primary, replicas
+
+
+def get_replica_lags(replica_ids: list[str], region: str) -> dict[str, float]:
+    """Retrieves the latest ReplicaLag datapoint, in seconds, of the replicas"""
+    if not replica_ids:
+        return {}
+    cloudwatch_client = get_client("cloudwatch", region)
+    now = datetime.now(UTC)
+    try:
+        response = cloudwatch_client.get_metric_data(
+            MetricDataQueries=[
+                {
+                    "Id": f"lag{index}",
+                    "MetricStat": {
+                        "Metric": {
+                            "Namespace": "AWS/RDS",
+                            "MetricName": "ReplicaLag",
+                            "Dimensions": [
+                                {"Name": "DBInstanceIdentifier", "Value": replica_id}
+                            ],
+                        },
+                        "Period": 60,
+                        "Stat": "Maximum",
+                    },
+                }
+                for index, replica_id in enumerate(replica_ids)
+            ],
+            StartTime=now - timedelta(minutes=5),
+            EndTime=now,
+            ScanBy="TimestampDescending",
+        )
+    except ClientError as e:
+        print(f"Failed to retrieve replica lag: {e}")
+        return {}
+    return {
+        replica_ids[int(result["Id"].removeprefix("lag"))]: result["Values"][0]
+        for result in response["MetricDataResults"]
+        if result.get("Values")
+    }
 
 
 def get_db_credentials(secret_manager_id: str, region: str) -> tuple[str, str]:
     """Retrieve the RDS instance username and password from the Secret Manager"""
     print("Retrieving RDS credentials")
-    secret_client = boto3.client("secretsmanager", region_name=region)
+    secret_client = get_client("secretsmanager", region)
     try:
         resp = secret_client.get_secret_value(SecretId=secret_manager_id)
     except ClientError as e:
@@ -122,7 +1417,8 @@ def get_db_credentials(secret_manager_id: str, region: str) -> tuple[str, str]:
         credentials = (secrets["mysql_user"], secrets["mysql_password"])
     except (KeyError, json.JSONDecodeError) as e:
         raise LambdaError(
-            f"Failed to retrieve credentials from secret manager '{secret_manager_id}': {e}"
+            "Failed to retrieve credentials from secret manager "
+            f"'{secret_manager_id}': {e}"
         ) from e
     return credentials
 
@@ -136,25 +1432,760 @@ def read_from_rds(
     device_id: int,
     datetime_from: int | None,
     datetime_to: int | None,
-) -> dict[str, Any]:
-    """Read Iot data from the RDS instance"""
+    resolution: str | None = None,
+    fields: Sequence[str] | None = None,
+    plan: QueryPlan | None = None,
+    cache: ResultCache | None = None,
+    storage_mode: str = "rows",
+) -> list[dict[str, Any]]:
+    """Read Iot data from the RDS instance, stored as rows or as device-hour blocks"""
+    with connect_to_rds(host, database, user, password) as conn:
+        version = (
+            get_data_version(conn, table, device_id) if cache is not None else None
+        )
+        return query_rds(
+            conn,
+            table,
+            device_id,
+            datetime_from,
+            datetime_to,
+            resolution=resolution,
+            fields=fields,
+            plan=plan,
+            cache=cache,
+            version=version,
+            storage_mode=storage_mode,
+        )
+
+
+@contextmanager
+def connect_to_rds(host: str, database: str, user: str, password: str) -> Iterator[Any]:
+    """Connect to the RDS instance, for the duration of the context"""
     print("Connecting to RDS")
     try:
-        with pymysql.connect(
-            host=host, user=user, password=password, database=database
-        ) as conn:
-            statement_variables = [device_id]
-            statement = f"SELECT * FROM {table} WHERE device_id = %s"
-            if datetime_from:
-                statement += " AND timestamp >= %s"
-                statement_variables.append(datetime_from)
-            if datetime_to:
-                statement += " AND timestamp < %s"
-                statement_variables.append(datetime_to)
-
-            with conn.cursor(pymysql.cursors.DictCursor) as curr:
-                print(curr, curr.execute)
-                curr.execute(statement, tuple(statement_variables))
-                return curr.fetchall()
+        with METRICS.timer("connect"):
+            connection = pymysql.connect(
+                host=host, user=user, password=password, database=database
+            )
+        with connection as conn:
+            yield conn
     except pymysql.err.OperationalError as e:
         raise LambdaError(f"Failed to connect to RDS database: {e}") from e
+
+
+def query_rds(
+    conn: Any,
+    table: str,
+    device_id: int,
+    datetime_from: int | None,
+    datetime_to: int | None,
+    resolution: str | None = None,
+    fields: Sequence[str] | None = None,
+    plan: QueryPlan | None = None,
+    cache: ResultCache | None = None,
+    version: int | None = None,
+    storage_mode: str = "rows",
+) -> list[dict[str, Any]]:
+    """
+    Query Iot data from an open RDS connection.
+
+    When a resolution is provided, the rows are downsampled in SQL into
+    fixed-size time buckets and only the per-bucket aggregates are returned.
+    The buckets are read from the sources chosen by the query plan.
+
+    When fields are provided, only those data columns (or their aggregates) are
+    selected, next to the device ID and the timestamp (or bucket).
+
+    When a cache and the device's data version are provided, the results are
+    cached against the data version, so they are invalidated by the next ingest.
+
+    With block storage, the rows are decoded from the device-hour blocks instead.
+    """
+    cache_key = (
+        table,
+        device_id,
+        datetime_from or None,
+        datetime_to or None,
+        resolution,
+        tuple(fields) if fields else None,
+        version,
+    )
+    if cache is not None and version is not None:
+        results = cache.get(cache_key)
+        if results is not None:
+            print("Serving results from cache")
+            return results
+
+    if storage_mode == "blocks":
+        results = query_blocks(
+            conn, table, device_id, datetime_from, datetime_to, resolution, fields, plan
+        )
+        if cache is not None and version is not None:
+            cache.put(cache_key, results)
+        return results
+
+    if resolution:
+        plan = plan or plan_query(datetime_from, datetime_to, resolution)
+        statement, statement_variables = get_bucket_statement(
+            table, device_id, RESOLUTIONS[resolution], plan, fields
+        )
+    else:
+        statement, statement_variables = get_segment_statement(
+            get_raw_columns(fields), table, device_id, datetime_from, datetime_to
+        )
+
+    with conn.cursor(pymysql.cursors.DictCursor) as curr:
+        curr.execute(statement, tuple(statement_variables))
+        results = curr.fetchall()
+    if cache is not None and version is not None:
+        cache.put(cache_key, results)
+    return results
+
+
+def query_batch(
+    conn: Any, table: str, queries: list[DeviceQuery], storage_mode: str = "rows"
+) -> list[Any]:
+    """
+    Query the data of a batch of queries with a single statement.
+
+    Blocks are decoded in Python, so with block storage the queries are read one
+    after the other over the same connection instead.
+    """
+    if storage_mode == "blocks":
+        return [
+            row
+            for device_id, query in queries
+            for row in query_rds(
+                conn,
+                table,
+                device_id,
+                query.datetime_from,
+                query.datetime_to,
+                resolution=query.resolution,
+                fields=query.fields,
+                storage_mode=storage_mode,
+            )
+        ]
+    statement, statement_variables = get_batch_statement(table, queries)
+    with conn.cursor(pymysql.cursors.DictCursor) as curr:
+        curr.execute(statement, tuple(statement_variables))
+        return list(curr.fetchall())
+
+
+def query_time_window(
+    conn: Any,
+    table: str,
+    datetime_from: int,
+    datetime_to: int,
+    fields: Sequence[str] | None = None,
+    limit: int = MAX_WINDOW_ROWS,
+    page_token: str | None = None,
+    storage_mode: str = "rows",
+) -> tuple[list[Any], str | None]:
+    """
+    Query the Iot data of all devices within a time window, a page at a time.
+
+    The rows are read in (timestamp, device_id) order, so the query is served by
+    the secondary index on those columns. The returned page token continues
+    after the last row of the page, and is None when there are no more rows.
+
+    With block storage, the blocks are read from the hour of the page token on,
+    and only until the page is complete (see read_window_blocks).
+    """
+    after = None
+    if page_token:
+        timestamp, device_id = (int(value) for value in page_token.split(":"))
+        after = (timestamp, device_id)
+    if storage_mode == "blocks":
+        rows = read_window_blocks(
+            conn, table, datetime_from, datetime_to, fields, limit, after
+        )
+    else:
+        statement = (
+            f"SELECT {get_raw_columns(fields)} FROM {table} "
+            "WHERE timestamp >= %s AND timestamp < %s"
+        )
+        statement_variables: list[Any] = [datetime_from, datetime_to]
+        if after:
+            statement += " AND (timestamp > %s OR (timestamp = %s AND device_id > %s))"
+            statement_variables.extend([after[0], *after])
+        statement += " ORDER BY timestamp, device_id LIMIT %s"
+        statement_variables.append(limit + 1)
+
+        with conn.cursor(pymysql.cursors.DictCursor) as curr:
+            curr.execute(statement, tuple(statement_variables))
+            rows = list(curr.fetchall())
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, f"{rows[-1]['timestamp']}:{rows[-1]['device_id']}"
+
+
+def merge_pages(
+    pages: list[tuple[list[Any], str | None]], limit: int
+) -> tuple[list[Any], str | None]:
+    """
+    Merge the time window pages of the shards into a single page.
+
+    Each shard's page holds its first rows after the page token, so the first
+    rows of the merged pages are the first rows across all shards.
+    """
+    rows = list(
+        heapq.merge(
+            *(page_rows for page_rows, _ in pages),
+            key=lambda row: (row["timestamp"], row["device_id"]),
+        )
+    )
+    if len(rows) <= limit and all(token is None for _, token in pages):
+        return rows, None
+    rows = rows[:limit]
+    return rows, f"{rows[-1]['timestamp']}:{rows[-1]['device_id']}"
+
+
+def query_devices(conn: Any, table: str, column: str, values: list[Any]) -> list[Any]:
+    """Query the registered devices whose external_id or device_id is in the values"""
+    statement = (
+        f"SELECT device_id, external_id FROM {table}_devices "
+        f"WHERE {column} IN ({','.join(['%s'] * len(values))})"
+    )
+    with conn.cursor(pymysql.cursors.DictCursor) as curr:
+        curr.execute(statement, tuple(values))
+        return list(curr.fetchall())
+
+
+def query_stored_device_ids(conn: Any, table: str) -> list[int]:
+    """Query the IDs of the devices that have data stored on the instance"""
+    with conn.cursor() as curr:
+        curr.execute(f"SELECT device_id FROM {table}_latest ORDER BY device_id")
+        return [row[0] for row in curr.fetchall()]
+
+
+def query_latest(
+    conn: Any, table: str, device_ids: list[int] | None = None
+) -> list[Any]:
+    """Query the latest reading of the provided devices, or of all devices"""
+    statement = f"SELECT * FROM {table}_latest"
+    if device_ids:
+        statement += f" WHERE device_id IN ({','.join(['%s'] * len(device_ids))})"
+    statement += " ORDER BY device_id"
+    with conn.cursor(pymysql.cursors.DictCursor) as curr:
+        curr.execute(statement, tuple(device_ids or []))
+        return list(curr.fetchall())
+
+
+def query_blocks(
+    conn: Any,
+    table: str,
+    device_id: int,
+    datetime_from: int | None,
+    datetime_to: int | None,
+    resolution: str | None = None,
+    fields: Sequence[str] | None = None,
+    plan: QueryPlan | None = None,
+) -> list[Any]:
+    """
+    Query a device's Iot data from the device-hour blocks.
+
+    Rollup segments of the query plan are still aggregated in SQL, while the raw
+    segments are decoded from the blocks and aggregated in Python.
+    """
+    if not resolution:
+        return read_blocks(conn, table, device_id, datetime_from, datetime_to, fields)
+    plan = plan or plan_query(datetime_from, datetime_to, resolution)
+    bucket_size = RESOLUTIONS[resolution]
+    results = []
+    for segment in plan.segments:
+        if segment.source == "raw":
+            rows = read_blocks(
+                conn, table, device_id, segment.datetime_from, segment.datetime_to
+            )
+            results.extend(aggregate_rows(rows, bucket_size, fields))
+            continue
+        statement, statement_variables = get_bucket_statement(
+            table, device_id, bucket_size, QueryPlan(segment.source, [segment]), fields
+        )
+        with conn.cursor(pymysql.cursors.DictCursor) as curr:
+            curr.execute(statement, tuple(statement_variables))
+            results.extend(curr.fetchall())
+    return results
+
+
+def read_blocks(
+    conn: Any,
+    table: str,
+    device_id: int | None,
+    datetime_from: int | None,
+    datetime_to: int | None,
+    fields: Sequence[str] | None = None,
+) -> list[dict[str, Any]]:
+    """
+    Returns the rows of the blocks overlapping the range, of one or all devices.
+
+    Only the rows within the range are returned, in (timestamp, device_id) order.
+    """
+    statement = f"SELECT device_id, timestamp, data FROM {table}_blocks WHERE 1 = 1"
+    statement_variables: list[Any] = []
+    if device_id is not None:
+        statement += " AND device_id = %s"
+        statement_variables.append(device_id)
+    # Unset (or 0) datetimes leave the range open, as with the row layout
+    if datetime_from:
+        statement += " AND timestamp >= %s"
+        statement_variables.append(datetime_from - datetime_from % BLOCK_SIZE)
+    if datetime_to:
+        statement += " AND timestamp < %s"
+        statement_variables.append(datetime_to)
+    with conn.cursor() as curr:
+        curr.execute(statement, tuple(statement_variables))
+        blocks = curr.fetchall()
+
+    columns = ["device_id", "timestamp", *(fields or DATA_FIELDS)]
+    rows = [
+        dict(zip(["device_id", "timestamp"] + DATA_FIELDS, values))
+        for block in blocks
+        for values in decode_block(*block)
+        if (not datetime_from or values[1] >= datetime_from)
+        and (not datetime_to or values[1] < datetime_to)
+    ]
+    rows.sort(key=lambda row: (row["timestamp"], row["device_id"]))
+    return [{column: row[column] for column in columns} for row in rows]
+
+
+def read_window_blocks(
+    conn: Any,
+    table: str,
+    datetime_from: int,
+    datetime_to: int,
+    fields: Sequence[str] | None = None,
+    limit: int = MAX_WINDOW_ROWS,
+    after: tuple[int, int] | None = None,
+) -> list[dict[str, Any]]:
+    """
+    Returns the first limit + 1 rows of all devices within the window, after a row.
+
+    The blocks are read in (timestamp, device_id) order, from the hour of the
+    given (timestamp, device_id) row on, WINDOW_BLOCK_BATCH blocks at a time.
+    Unread blocks only hold rows from the start of the last block read on, so
+    reading stops once more than limit rows come before it.
+    """
+    start = max(datetime_from, after[0]) if after else datetime_from
+    statement = (
+        f"SELECT device_id, timestamp, data FROM {table}_blocks "
+        "WHERE timestamp >= %s AND timestamp < %s"
+    )
+    statement_variables: list[Any] = [start - start % BLOCK_SIZE, datetime_to]
+    decoded: list[tuple[Any, ...]] = []
+    while True:
+        with conn.cursor() as curr:
+            curr.execute(
+                f"{statement} ORDER BY timestamp, device_id LIMIT %s",
+                (*statement_variables, WINDOW_BLOCK_BATCH),
+            )
+            blocks = curr.fetchall()
+        decoded.extend(
+            row
+            for block in blocks
+            for row in decode_block(*block)
+            if datetime_from <= row[1] < datetime_to
+            and (not after or (row[1], row[0]) > after)
+        )
+        if len(blocks) < WINDOW_BLOCK_BATCH:
+            break
+        last_device_id, last_start = blocks[-1][:2]
+        if sum(1 for row in decoded if row[1] < last_start) > limit:
+            break
+        if len(statement_variables) == 2:
+            statement += " AND (timestamp > %s OR (timestamp = %s AND device_id > %s))"
+        statement_variables[2:] = [last_start, last_start, last_device_id]
+
+    decoded.sort(key=lambda row: (row[1], row[0]))
+    columns = ["device_id", "timestamp", *(fields or DATA_FIELDS)]
+    rows = [
+        dict(zip(["device_id", "timestamp"] + DATA_FIELDS, values))
+        for values in decoded[: limit + 1]
+    ]
+    return [{column: row[column] for column in columns} for row in rows]
+
+
+def aggregate_rows(
+    rows: list[dict[str, Any]], bucket_size: int, fields: Sequence[str] | None = None
+) -> list[dict[str, Any]]:
+    """Aggregate decoded rows into buckets, with the columns of the SQL buckets"""
+    buckets: dict[int, list[dict[str, Any]]] = {}
+    for row in rows:
+        bucket = row["timestamp"] // bucket_size * bucket_size
+        buckets.setdefault(bucket, []).append(row)
+    results = []
+    for bucket, bucket_rows in sorted(buckets.items()):
+        result = {
+            "device_id": bucket_rows[0]["device_id"],
+            "bucket": bucket,
+            "count": len(bucket_rows),
+        }
+        for field in fields or DATA_FIELDS:
+            values = [row[field] for row in bucket_rows]
+            for alias in BUCKET_COLUMNS[field]:
+                aggregate = BLOCK_BUCKET_AGGREGATES[alias.rsplit("_", 1)[1]]
+                result[alias] = aggregate(values)
+        results.append(result)
+    return results
+
+
+def query_statistics(
+    conn: Any,
+    table: str,
+    device_id: int,
+    datetime_from: int,
+    datetime_to: int,
+    fields: Sequence[str] | None = None,
+    percentiles: list[float] | None = None,
+    mode: str = "approximate",
+    storage_mode: str = "rows",
+) -> tuple[dict[str, dict[str, Any]], QueryPlan]:
+    """
+    Query the count and percentiles of a device's data within a range.
+
+    In exact mode, all values are read and sorted. In approximate mode, the
+    quantile sketches of the hourly and daily rollups are merged, and only the
+    partial hours at either end of the range (and buckets without a sketch) are
+    streamed from the raw data, over an unbuffered cursor, into the sketches.
+    """
+    fields = fields or STATISTICS_FIELDS
+    percentiles = percentiles or [50.0]
+    ranks = [percentile / 100 for percentile in percentiles]
+
+    if mode == "exact":
+        plan = QueryPlan("raw", [QuerySegment("raw", datetime_from, datetime_to)])
+        columns: list[list[float]] = [[] for _ in fields]
+        for values in stream_values(
+            conn, table, device_id, datetime_from, datetime_to, fields, storage_mode
+        ):
+            for column, value in zip(columns, values):
+                column.append(value)
+        quantiles = []
+        for column in columns:
+            column.sort()
+            quantiles.append(
+                [
+                    column[max(math.ceil(rank * len(column)) - 1, 0)]
+                    if column
+                    else None
+                    for rank in ranks
+                ]
+            )
+        counts = [len(column) for column in columns]
+    else:
+        plan = plan_statistics(datetime_from, datetime_to)
+        sketches = [QuantileSketch() for _ in fields]
+        for segment in plan.segments:
+            if segment.source == "raw":
+                # Unset bounds and 0 both leave the range open, as in stream_values
+                raw_ranges = [(segment.datetime_from or 0, segment.datetime_to or 0)]
+            else:
+                raw_ranges = merge_sketches(
+                    conn, table, device_id, segment, fields, sketches
+                )
+            for start, end in raw_ranges:
+                for values in stream_values(
+                    conn, table, device_id, start, end, fields, storage_mode
+                ):
+                    for sketch, value in zip(sketches, values):
+                        sketch.update(value)
+        quantiles = [sketch.get_quantiles(ranks) for sketch in sketches]
+        counts = [sketch.count for sketch in sketches]
+
+    results = {
+        field: {
+            "count": count,
+            **{
+                f"p{percentile:g}": quantile
+                for percentile, quantile in zip(percentiles, field_quantiles)
+            },
+        }
+        for field, count, field_quantiles in zip(fields, counts, quantiles)
+    }
+    return results, plan
+
+
+def merge_sketches(
+    conn: Any,
+    table: str,
+    device_id: int,
+    segment: QuerySegment,
+    fields: Sequence[str],
+    sketches: list[QuantileSketch],
+) -> list[tuple[int, int]]:
+    """
+    Merge the rollup sketches of the segment into the sketches.
+
+    Returns the ranges of the buckets that have no sketch, to be read from the
+    raw data instead.
+    """
+    statement, statement_variables = get_segment_statement(
+        ", ".join(["timestamp"] + [f"{field}_sketch" for field in fields]),
+        f"{table}_{segment.source}",
+        device_id,
+        segment.datetime_from,
+        segment.datetime_to,
+    )
+    with conn.cursor() as curr:
+        curr.execute(statement, tuple(statement_variables))
+        rows = curr.fetchall()
+    bucket_size = ROLLUP_SIZES[segment.source]
+    raw_ranges = []
+    for timestamp, *encoded in rows:
+        if None in encoded:
+            raw_ranges.append((timestamp, timestamp + bucket_size))
+            continue
+        for sketch, value in zip(sketches, encoded):
+            sketch.merge(QuantileSketch.from_bytes(value))
+    return raw_ranges
+
+
+def stream_values(
+    conn: Any,
+    table: str,
+    device_id: int,
+    datetime_from: int,
+    datetime_to: int,
+    fields: Sequence[str],
+    storage_mode: str = "rows",
+) -> Iterator[tuple[Any, ...]]:
+    """Yields the values of the fields, reading the rows over an unbuffered cursor"""
+    if storage_mode == "blocks":
+        for row in read_blocks(
+            conn, table, device_id, datetime_from, datetime_to, fields
+        ):
+            yield tuple(row[field] for field in fields)
+        return
+    statement, statement_variables = get_segment_statement(
+        ", ".join(fields), table, device_id, datetime_from, datetime_to
+    )
+    with conn.cursor(pymysql.cursors.SSCursor) as curr:
+        curr.execute(statement, tuple(statement_variables))
+        yield from curr
+
+
+def get_data_version(conn: Any, table: str, device_id: int) -> int:
+    """Returns the device's data version, which is bumped on every ingest"""
+    with conn.cursor() as curr:
+        curr.execute(
+            f"SELECT version FROM {table}_versions WHERE device_id = %s", (device_id,)
+        )
+        row = curr.fetchone()
+    return row[0] if row else 0
+
+
+def get_etag(version: int, params: QueryParameters) -> str:
+    """Returns the ETag of a query, derived from its parameters and data version"""
+    digest = hashlib.sha256(
+        json.dumps([version, params.dict()], sort_keys=True).encode("utf-8")
+    ).hexdigest()
+    return f'"{digest[:32]}"'
+
+
+def etag_matches(etag: str, if_none_match: str | None) -> bool:
+    """Checks whether the ETag matches any ETag of an If-None-Match header"""
+    if not if_none_match:
+        return False
+    candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return etag in candidates or "*" in candidates
+
+
+def get_header(headers: dict[str, str] | None, name: str) -> str | None:
+    """Retrieve a request header, ignoring the case of its name"""
+    for key, value in (headers or {}).items():
+        if key.lower() == name.lower():
+            return value
+    return None
+
+
+def plan_query(
+    datetime_from: int | None, datetime_to: int | None, resolution: str | None
+) -> QueryPlan:
+    """
+    Choose the cheapest sources to read the requested range from.
+
+    Buckets that are fully covered by the range are read from the coarsest
+    rollup table that aligns with the resolution, while the partial buckets at
+    either end of the range are aggregated from the raw rows.
+    """
+    raw_plan = QueryPlan("raw", [QuerySegment("raw", datetime_from, datetime_to)])
+    if not resolution:
+        return raw_plan
+    bucket_size = RESOLUTIONS[resolution]
+    source = next(
+        (name for name, size in ROLLUP_SIZES.items() if bucket_size % size == 0),
+        None,
+    )
+    if not source:
+        return raw_plan
+
+    full_from = (
+        -(-datetime_from // bucket_size) * bucket_size if datetime_from else None
+    )
+    full_to = datetime_to // bucket_size * bucket_size if datetime_to else None
+    if full_to is not None and full_to <= (full_from or 0):
+        return raw_plan
+
+    segments = [QuerySegment(source, full_from, full_to)]
+    if datetime_from and full_from != datetime_from:
+        segments.insert(0, QuerySegment("raw", datetime_from, full_from))
+    if datetime_to and full_to != datetime_to:
+        segments.append(QuerySegment("raw", full_to, datetime_to))
+    return QueryPlan(source if len(segments) == 1 else "mixed", segments)
+
+
+def plan_statistics(datetime_from: int, datetime_to: int) -> QueryPlan:
+    """
+    Choose the sketches to merge for the requested range.
+
+    Full days are read from the daily sketches and the remaining full hours from
+    the hourly sketches, while the partial hours at either end of the range are
+    read from the raw data.
+    """
+    hour_from = -(-datetime_from // 3600) * 3600
+    hour_to = datetime_to // 3600 * 3600
+    if hour_to <= hour_from:
+        return QueryPlan("raw", [QuerySegment("raw", datetime_from, datetime_to)])
+    day_from = -(-hour_from // 86400) * 86400
+    day_to = hour_to // 86400 * 86400
+    if day_to <= day_from:
+        day_from = day_to = hour_to
+
+    segments = [
+        QuerySegment(source, start, end)
+        for source, start, end in [
+            ("raw", datetime_from, hour_from),
+            ("hourly", hour_from, day_from),
+            ("daily", day_from, day_to),
+            ("hourly", day_to, hour_to),
+            ("raw", hour_to, datetime_to),
+        ]
+        if start < end
+    ]
+    sources = {segment.source for segment in segments}
+    return QueryPlan(sources.pop() if len(sources) == 1 else "mixed", segments)
+
+
+def get_bucket_statement(
+    table: str,
+    device_id: int,
+    bucket_size: int,
+    plan: QueryPlan,
+    fields: Sequence[str] | None = None,
+) -> tuple[str, list[Any]]:
+    """Returns the statement that aggregates the plan's segments into buckets"""
+    return join_statements(
+        get_bucket_segment_statements(table, device_id, bucket_size, plan, fields),
+        "bucket",
+    )
+
+
+def get_batch_statement(
+    table: str, queries: list[DeviceQuery]
+) -> tuple[str, list[Any]]:
+    """Returns the statement that reads the data of all queries in one round trip"""
+    statements = []
+    for device_id, query in queries:
+        if query.resolution:
+            statements.extend(
+                get_bucket_segment_statements(
+                    table,
+                    device_id,
+                    RESOLUTIONS[query.resolution],
+                    plan_query(
+                        query.datetime_from, query.datetime_to, query.resolution
+                    ),
+                    query.fields,
+                )
+            )
+        else:
+            statements.append(
+                get_segment_statement(
+                    get_raw_columns(query.fields),
+                    table,
+                    device_id,
+                    query.datetime_from,
+                    query.datetime_to,
+                )
+            )
+    order = "bucket" if queries[0].params.resolution else "timestamp"
+    return join_statements(statements, f"device_id, {order}")
+
+
+def get_bucket_segment_statements(
+    table: str,
+    device_id: int,
+    bucket_size: int,
+    plan: QueryPlan,
+    fields: Sequence[str] | None = None,
+) -> list[tuple[str, list[Any]]]:
+    """Returns the statements that aggregate each of the plan's segments"""
+    statements = []
+    for segment in plan.segments:
+        statement, statement_variables = get_segment_statement(
+            get_bucket_columns(bucket_size, segment.source, fields),
+            table if segment.source == "raw" else f"{table}_{segment.source}",
+            device_id,
+            segment.datetime_from,
+            segment.datetime_to,
+        )
+        statements.append(
+            (f"{statement} GROUP BY device_id, bucket", statement_variables)
+        )
+    return statements
+
+
+def join_statements(
+    statements: list[tuple[str, list[Any]]], order: str
+) -> tuple[str, list[Any]]:
+    """Combines the statements with UNION ALL and orders the combined rows"""
+    statement_variables = [v for _, variables in statements for v in variables]
+    if len(statements) == 1:
+        return f"{statements[0][0]} ORDER BY {order}", statement_variables
+    union = ") UNION ALL (".join(statement for statement, _ in statements)
+    return f"({union}) ORDER BY {order}", statement_variables
+
+
+def get_segment_statement(
+    columns: str,
+    table: str,
+    device_id: int,
+    datetime_from: int | None,
+    datetime_to: int | None,
+) -> tuple[str, list[Any]]:
+    """Returns the statement that selects a device's rows within a range"""
+    statement_variables: list[Any] = [device_id]
+    statement = f"SELECT {columns} FROM {table} WHERE device_id = %s"
+    if datetime_from:
+        statement += " AND timestamp >= %s"
+        statement_variables.append(datetime_from)
+    if datetime_to:
+        statement += " AND timestamp < %s"
+        statement_variables.append(datetime_to)
+    return statement, statement_variables
+
+
+def get_raw_columns(fields: Sequence[str] | None = None) -> str:
+    """Returns the columns selected for each raw row"""
+    if not fields:
+        return "*"
+    return ", ".join(["device_id", "timestamp", *fields])
+
+
+def get_bucket_columns(
+    bucket_size: int, source: str = "raw", fields: Sequence[str] | None = None
+) -> str:
+    """Returns the aggregate columns selected for each time bucket"""
+    columns = BUCKET_COLUMNS if source == "raw" else ROLLUP_BUCKET_COLUMNS
+    count = "COUNT(*)" if source == "raw" else "CAST(SUM(sample_count) AS UNSIGNED)"
+    aggregates = [f"{count} AS count"] + [
+        f"{expression} AS {alias}"
+        for field in fields or DATA_FIELDS
+        for alias, expression in columns[field].items()
+    ]
+    return (
+        f"device_id, timestamp DIV {bucket_size} * {bucket_size} AS bucket, "
+        + ", ".join(aggregates)
+    )
@@ -1,21 +1,57 @@
+import gzip
 import json
 import os
+import random
+import struct
+import subprocess
+import sys
+from pathlib import Path
+from typing import Any
 from unittest import mock
 
 import boto3
+import pymysql
 import pytest
-from moto import mock_rds, mock_secretsmanager
+from moto import mock_rds, mock_s3, mock_secretsmanager
 from pydantic import ValidationError
 
 from ..data_retrieval_lambda import (
+    EXPORT_STALE_SECONDS,
+    EXPORT_WINDOW,
+    DeviceDirectory,
+    DeviceQuery,
+    GzipMultipartUpload,
     LambdaError,
+    QueryPlan,
+    QuerySegment,
+    ResultCache,
+    aggregate_rows,
+    etag_matches,
+    get_batch_statement,
     get_db_credentials,
     get_env_value,
-    get_rds_endpoint,
+    get_rds_endpoints,
+    handler,
+    merge_pages,
+    plan_query,
+    plan_statistics,
+    query_blocks,
+    query_latest,
+    query_statistics,
+    query_time_window,
     read_from_rds,
     validate_event,
 )
 
+# Module of the handler, as patched by the tests
+MODULE = "data_retrieval_lambda.data_retrieval_lambda"
+
+# Local MySQL server that the export is tested against end-to-end, when provided
+MYSQL_TEST_HOST = os.environ.get("MYSQL_TEST_HOST")
+
+# Newer botocore versions checksum the uploaded parts in a way moto can't decode
+S3_CHECKSUM_ENV = {"AWS_REQUEST_CHECKSUM_CALCULATION": "when_required"}
+
 
 def test_validate_event__wrong_resource() -> None:
     with pytest.raises(ValidationError) as e:
@@ -65,7 +101,6 @@ def test_validate_event__invalid_device_id() -> None:
         "httpMethod": "GET",
         "queryStringParameters": {
             "datetime_from": 1,
-            "datetime_to": 1,
         },
     }
 
@@ -73,17 +108,18 @@ def test_validate_event__invalid_device_id() -> None:
         validate_event(event)
     assert str(e.value) == (
         "1 validation error for ApiGatewayEvent\n"
-        "queryStringParameters -> device_id\n"
-        "  field required (type=value_error.missing)"
+        "queryStringParameters -> __root__\n"
+        "  ensure 'device_id' is present, unless both 'datetime_from' and "
+        "'datetime_to' are (type=value_error)"
     )
 
-    event["queryStringParameters"]["device_id"] = "string"
+    event["queryStringParameters"]["device_id"] = "bad id"
     with pytest.raises(ValidationError) as e:
         validate_event(event)
     assert str(e.value) == (
         "1 validation error for ApiGatewayEvent\n"
         "queryStringParameters -> device_id\n"
-        "  value is not a valid integer (type=type_error.integer)"
+        "  invalid device id format provided: bad id (type=value_error)"
     )
 
     event["queryStringParameters"]["device_id"] = -1
@@ -96,16 +132,24 @@ def test_validate_event__invalid_device_id() -> None:
         "(type=value_error.number.not_ge; limit_value=0)"
     )
 
-    event["queryStringParameters"]["device_id"] = 1000
+    event["queryStringParameters"]["device_id"] = 2147483648
     with pytest.raises(ValidationError) as e:
         validate_event(event)
     assert str(e.value) == (
         "1 validation error for ApiGatewayEvent\n"
         "queryStringParameters -> device_id\n"
-        "  ensure this value is less than or equal to 999 "
-        "(type=value_error.number.not_le; limit_value=999)"
+        "  ensure this value is less than or equal to 2147483647 "
+        "(type=value_error.number.not_le; limit_value=2147483647)"
     )
 
+    # Legacy IDs map to their number, while other external IDs are kept
+    event["queryStringParameters"]["device_id"] = "device_007"
+    assert validate_event(event).queryStringParameters.device_id == 7
+    event["queryStringParameters"]["device_id"] = "1000"
+    assert validate_event(event).queryStringParameters.device_id == 1000
+    event["queryStringParameters"]["device_id"] = "sensor-a"
+    assert validate_event(event).queryStringParameters.device_id == "sensor-a"
+
 
 def test_validate_event__invalid_datetime_from() -> None:
     event = {
@@ -205,6 +249,209 @@ def test_validate_event__ensure_at_least_one_date_present() -> None:
     )
 
 
+def test_validate_event__invalid_resolution() -> None:
+    event = {
+        "resource": "/data",
+        "httpMethod": "GET",
+        "queryStringParameters": {
+            "device_id": 1,
+            "datetime_from": 1,
+            "resolution": "2h",
+        },
+    }
+
+    with pytest.raises(ValidationError) as e:
+        validate_event(event)
+    assert str(e.value) == (
+        "1 validation error for ApiGatewayEvent\n"
+        "queryStringParameters -> resolution\n"
+        "  unexpected value; permitted: '1m', '5m', '15m', '1h', '6h', '1d' "
+        "(type=value_error.const; given=2h; "
+        "permitted=('1m', '5m', '15m', '1h', '6h', '1d'))"
+    )
+
+    event["queryStringParameters"]["resolution"] = "1h"
+    assert validate_event(event).queryStringParameters.resolution == "1h"
+
+
+def test_validate_event__time_window() -> None:
+    event = {
+        "resource": "/data",
+        "httpMethod": "GET",
+        "queryStringParameters": {
+            "datetime_from": 1,
+            "datetime_to": 2,
+            "resolution": "1h",
+        },
+    }
+
+    with pytest.raises(ValidationError) as e:
+        validate_event(event)
+    assert str(e.value) == (
+        "1 validation error for ApiGatewayEvent\n"
+        "queryStringParameters -> __root__\n"
+        "  ensure 'device_id' is present when 'resolution' is (type=value_error)"
+    )
+
+    del event["queryStringParameters"]["resolution"]
+    event["queryStringParameters"]["page_token"] = "invalid"
+    with pytest.raises(ValidationError) as e:
+        validate_event(event)
+    assert str(e.value) == (
+        "1 validation error for ApiGatewayEvent\n"
+        "queryStringParameters -> page_token\n"
+        '  string does not match regex "^[0-9]+:[0-9]+$" '
+        "(type=value_error.str.regex; pattern=^[0-9]+:[0-9]+$)"
+    )
+
+    event["queryStringParameters"]["page_token"] = "2:10"
+    params = validate_event(event).queryStringParameters
+    assert params.device_id is None
+    assert params.limit == 1000
+
+
+def test_validate_event__fields() -> None:
+    event = {
+        "resource": "/data",
+        "httpMethod": "GET",
+        "queryStringParameters": {
+            "device_id": 1,
+            "datetime_from": 1,
+            "fields": "temperature,pressure",
+        },
+    }
+
+    with pytest.raises(ValidationError) as e:
+        validate_event(event)
+    assert str(e.value) == (
+        "1 validation error for ApiGatewayEvent\n"
+        "queryStringParameters -> fields -> 1\n"
+        "  unexpected value; permitted: 'temperature', 'humidity', 'hvac_status' "
+        "(type=value_error.const; given=pressure; "
+        "permitted=('temperature', 'humidity', 'hvac_status'))"
+    )
+
+    event["queryStringParameters"]["fields"] = "hvac_status, temperature,hvac_status"
+    assert validate_event(event).queryStringParameters.fields == [
+        "temperature",
+        "hvac_status",
+    ]
+
+
+def test_validate_event__batch() -> None:
+    event = {
+        "resource": "/data/batch",
+        "httpMethod": "POST",
+        "body": json.dumps(
+            {
+                "queries": [
+                    {"device_id": 1, "datetime_from": 1},
+                    {"device_id": 1, "datetime_to": 2},
+                ]
+            }
+        ),
+    }
+
+    with pytest.raises(ValidationError) as e:
+        validate_event(event)
+    assert str(e.value) == (
+        "1 validation error for BatchApiGatewayEvent\n"
+        "body -> queries\n"
+        "  ensure each device is only queried once (type=value_error)"
+    )
+
+    event["body"] = json.dumps(
+        {
+            "queries": [
+                {"device_id": 1, "datetime_from": 1, "resolution": "1h"},
+                {"device_id": 2, "datetime_to": 2},
+            ]
+        }
+    )
+    with pytest.raises(ValidationError) as e:
+        validate_event(event)
+    assert str(e.value) == (
+        "1 validation error for BatchApiGatewayEvent\n"
+        "body -> queries\n"
+        "  ensure all queries use the same resolution (type=value_error)"
+    )
+
+    event["body"] = json.dumps(
+        {
+            "queries": [
+                {"device_id": 1, "datetime_from": 1},
+                {"device_id": 2, "datetime_to": 2},
+            ]
+        }
+    )
+    api_event = validate_event(event)
+    assert [query.device_id for query in api_event.body.queries] == [1, 2]
+
+
+def test_validate_event__latest() -> None:
+    event = {
+        "resource": "/data/latest",
+        "httpMethod": "GET",
+        "queryStringParameters": None,
+    }
+    assert validate_event(event).queryStringParameters is None
+
+    event["queryStringParameters"] = {"device_ids": "1, 2"}
+    assert validate_event(event).queryStringParameters.device_ids == [1, 2]
+
+    event["queryStringParameters"] = {"device_ids": "1,device_002,sensor-a"}
+    assert validate_event(event).queryStringParameters.device_ids == [
+        1,
+        2,
+        "sensor-a",
+    ]
+
+    event["queryStringParameters"] = {"device_ids": "1,bad id"}
+    with pytest.raises(ValidationError) as e:
+        validate_event(event)
+    assert str(e.value) == (
+        "1 validation error for LatestApiGatewayEvent\n"
+        "queryStringParameters -> device_ids\n"
+        "  invalid device id format provided: bad id (type=value_error)"
+    )
+
+
+def test_validate_event__statistics() -> None:
+    event = {
+        "resource": "/data/statistics",
+        "httpMethod": "GET",
+        "queryStringParameters": {
+            "device_id": 1,
+            "datetime_from": 10,
+            "datetime_to": 20,
+            "percentiles": "50, 99.9",
+        },
+    }
+    params = validate_event(event).queryStringParameters
+    assert params.percentiles == [50.0, 99.9]
+    assert params.fields is None
+    assert params.mode == "approximate"
+
+    event["queryStringParameters"]["percentiles"] = "101"
+    with pytest.raises(ValidationError) as e:
+        validate_event(event)
+    assert str(e.value) == (
+        "1 validation error for StatisticsApiGatewayEvent\n"
+        "queryStringParameters -> percentiles -> 0\n"
+        "  ensure percentiles are between 0 and 100 (type=value_error)"
+    )
+
+    event["queryStringParameters"]["percentiles"] = "50"
+    event["queryStringParameters"]["datetime_to"] = 10
+    with pytest.raises(ValidationError) as e:
+        validate_event(event)
+    assert str(e.value) == (
+        "1 validation error for StatisticsApiGatewayEvent\n"
+        "queryStringParameters -> __root__\n"
+        "  ensure 'datetime_from' is before 'datetime_to' (type=value_error)"
+    )
+
+
 def test_get_env_value__missing() -> None:
     env_key = "TEST_ENV_KEY"
     os.environ[env_key] = ""
@@ -221,11 +468,11 @@ def test_get_env_value() -> None:
 
 
 @mock_rds
-def test_get_rds_endpoint__missing_rds_instance() -> None:
+def test_get_rds_endpoints__missing_rds_instance() -> None:
     region = "us-west-1"
 
     with pytest.raises(LambdaError) as e:
-        print(get_rds_endpoint("wrong_rds_id", region))
+        print(get_rds_endpoints("wrong_rds_id", region, 30))
     assert str(e.value) == (
         "Failed to retrieve 'wrong_rds_id' RDS instance: An error occurred "
         "(DBInstanceNotFound) when calling the DescribeDBInstances operation: "
@@ -234,7 +481,7 @@ def test_get_rds_endpoint__missing_rds_instance() -> None:
 
 
 @mock_rds
-def test_get_rds_endpoint() -> None:
+def test_get_rds_endpoints() -> None:
     region = "us-west-1"
     rds_id = "test"
     conn = boto3.client("rds", region_name=region)
@@ -245,11 +492,73 @@ def test_get_rds_endpoint() -> None:
         PubliclyAccessible=False,
     )
 
-    assert (
-        get_rds_endpoint(rds_id, region)
-        == "test.aaaaaaaaaa.us-west-1.rds.amazonaws.com"
+    assert get_rds_endpoints(rds_id, region, 30) == (
+        "test.aaaaaaaaaa.us-west-1.rds.amazonaws.com",
+        [],
     )
 
+    for replica_id in ["test-replica-1", "test-replica-2", "test-replica-3"]:
+        conn.create_db_instance_read_replica(
+            DBInstanceIdentifier=replica_id, SourceDBInstanceIdentifier=rds_id
+        )
+    # Replica 2 lags behind too much, and replica 3 has no ReplicaLag datapoints
+    with mock.patch(
+        "data_retrieval_lambda.data_retrieval_lambda.get_replica_lags",
+        return_value={"test-replica-1": 1.0, "test-replica-2": 60.0},
+    ) as mock_get_replica_lags:
+        assert get_rds_endpoints(rds_id, region, 30) == (
+            "test.aaaaaaaaaa.us-west-1.rds.amazonaws.com",
+            ["test-replica-1.aaaaaaaaaa.us-west-1.rds.amazonaws.com"],
+        )
+    assert sorted(mock_get_replica_lags.call_args.args[0]) == [
+        "test-replica-1",
+        "test-replica-2",
+        "test-replica-3",
+    ]
+
+
+def test_handler__replica_fallback() -> None:
+    env = {
+        "SECRET_MANAGER_ID": "secrets",
+        "REGION": "us-west-1",
+        "MYSQL_ID": "mysql",
+        "MYSQL_DATABASE": "database",
+        "MYSQL_TABLE": "table",
+    }
+    event = {
+        "resource": "/data/latest",
+        "httpMethod": "GET",
+        "queryStringParameters": None,
+    }
+    module = "data_retrieval_lambda.data_retrieval_lambda"
+    with mock.patch.dict(os.environ, env), mock.patch(
+        f"{module}.get_read_hosts", return_value=["replica", "primary"]
+    ), mock.patch(
+        f"{module}.get_db_credentials", return_value=("user", "password")
+    ), mock.patch(
+        f"{module}.pymysql.connect"
+    ) as mock_connect:
+        mock_cur = mock.MagicMock(name="cursor")
+        mock_cur.fetchall.return_value = [{"device_id": 1}]
+        mock_conn = mock.MagicMock(name="connection")
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cur
+        mock_connect.side_effect = [
+            pymysql.err.OperationalError(2003, "Can't connect"),
+            mock.MagicMock(**{"__enter__.return_value": mock_conn}),
+        ]
+
+        response = handler(event, None)
+        assert response == {
+            "statusCode": 200,
+            "body": json.dumps(
+                {"results": [{"device_id": 1, "external_id": "device_001"}]}
+            ),
+        }
+        assert [c.kwargs["host"] for c in mock_connect.call_args_list] == [
+            "replica",
+            "primary",
+        ]
+
 
 @mock_secretsmanager
 def test_get_db_credentials__missing_secrets_manager() -> None:
@@ -426,3 +735,1150 @@ def test_read_from_rds() -> None:
             "SELECT * FROM table WHERE device_id = %s AND timestamp >= %s AND timestamp < %s",
             (1, 2, 3),
         )
+
+
+def test_read_from_rds__resolution() -> None:
+    with mock.patch(
+        "data_retrieval_lambda.data_retrieval_lambda.pymysql.connect"
+    ) as mock_connect:
+        output = {"test": "output"}
+        mock_execute = mock.MagicMock(name="execute")
+        mock_cur = mock.MagicMock(name="cursor")
+        mock_cur.execute = mock_execute
+        mock_cur.fetchall.return_value = output
+        mock_conn = mock.MagicMock(name="connection")
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cur
+        mock_connect.return_value.__enter__.return_value = mock_conn
+
+        data = read_from_rds(
+            "host", "database", "user", "password", "table", 1, 2, 3, resolution="1h"
+        )
+        assert data == output
+
+        assert mock_execute.call_args.args == (
+            (
+                "SELECT device_id, timestamp DIV 3600 * 3600 AS bucket, "
+                "COUNT(*) AS count, AVG(temperature) AS temperature_avg, "
+                "MIN(temperature) AS temperature_min, "
+                "MAX(temperature) AS temperature_max, AVG(humidity) AS humidity_avg, "
+                "MIN(humidity) AS humidity_min, MAX(humidity) AS humidity_max, "
+                "AVG(hvac_status) AS hvac_on_ratio FROM table WHERE device_id = %s "
+                "AND timestamp >= %s AND timestamp < %s "
+                "GROUP BY device_id, bucket ORDER BY bucket"
+            ),
+            (1, 2, 3),
+        )
+
+
+def test_read_from_rds__mixed_plan() -> None:
+    with mock.patch(
+        "data_retrieval_lambda.data_retrieval_lambda.pymysql.connect"
+    ) as mock_connect:
+        mock_execute = mock.MagicMock(name="execute")
+        mock_cur = mock.MagicMock(name="cursor")
+        mock_cur.execute = mock_execute
+        mock_conn = mock.MagicMock(name="connection")
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cur
+        mock_connect.return_value.__enter__.return_value = mock_conn
+
+        read_from_rds(
+            "host",
+            "database",
+            "user",
+            "password",
+            "table",
+            1,
+            1800,
+            7300,
+            resolution="1h",
+        )
+
+        raw_columns = (
+            "device_id, timestamp DIV 3600 * 3600 AS bucket, "
+            "COUNT(*) AS count, AVG(temperature) AS temperature_avg, "
+            "MIN(temperature) AS temperature_min, "
+            "MAX(temperature) AS temperature_max, AVG(humidity) AS humidity_avg, "
+            "MIN(humidity) AS humidity_min, MAX(humidity) AS humidity_max, "
+            "AVG(hvac_status) AS hvac_on_ratio"
+        )
+        rollup_columns = (
+            "device_id, timestamp DIV 3600 * 3600 AS bucket, "
+            "CAST(SUM(sample_count) AS UNSIGNED) AS count, "
+            "SUM(temperature_sum) / SUM(sample_count) AS temperature_avg, "
+            "MIN(temperature_min) AS temperature_min, "
+            "MAX(temperature_max) AS temperature_max, "
+            "SUM(humidity_sum) / SUM(sample_count) AS humidity_avg, "
+            "MIN(humidity_min) AS humidity_min, MAX(humidity_max) AS humidity_max, "
+            "SUM(hvac_on_count) / SUM(sample_count) AS hvac_on_ratio"
+        )
+        assert mock_execute.call_args.args == (
+            (
+                f"(SELECT {raw_columns} FROM table WHERE device_id = %s "
+                "AND timestamp >= %s AND timestamp < %s GROUP BY device_id, bucket) "
+                f"UNION ALL (SELECT {rollup_columns} FROM table_hourly "
+                "WHERE device_id = %s AND timestamp >= %s AND timestamp < %s "
+                "GROUP BY device_id, bucket) "
+                f"UNION ALL (SELECT {raw_columns} FROM table WHERE device_id = %s "
+                "AND timestamp >= %s AND timestamp < %s GROUP BY device_id, bucket) "
+                "ORDER BY bucket"
+            ),
+            (1, 1800, 3600, 1, 3600, 7200, 1, 7200, 7300),
+        )
+
+
+def test_plan_query__raw() -> None:
+    assert plan_query(1800, 7300, None) == QueryPlan(
+        "raw", [QuerySegment("raw", 1800, 7300)]
+    )
+    assert plan_query(1800, 7300, "15m") == QueryPlan(
+        "raw", [QuerySegment("raw", 1800, 7300)]
+    )
+    assert plan_query(1800, 7000, "1h") == QueryPlan(
+        "raw", [QuerySegment("raw", 1800, 7000)]
+    )
+    assert plan_query(None, 1800, "1h") == QueryPlan(
+        "raw", [QuerySegment("raw", None, 1800)]
+    )
+
+
+def test_plan_query__rollups() -> None:
+    assert plan_query(3600, 7200, "1h") == QueryPlan(
+        "hourly", [QuerySegment("hourly", 3600, 7200)]
+    )
+    assert plan_query(0, 21600, "6h") == QueryPlan(
+        "hourly", [QuerySegment("hourly", None, 21600)]
+    )
+    assert plan_query(86400, None, "1d") == QueryPlan(
+        "daily", [QuerySegment("daily", 86400, None)]
+    )
+
+
+def test_plan_query__mixed() -> None:
+    assert plan_query(1800, 7300, "1h") == QueryPlan(
+        "mixed",
+        [
+            QuerySegment("raw", 1800, 3600),
+            QuerySegment("hourly", 3600, 7200),
+            QuerySegment("raw", 7200, 7300),
+        ],
+    )
+    assert plan_query(None, 180000, "1d") == QueryPlan(
+        "mixed",
+        [QuerySegment("daily", None, 172800), QuerySegment("raw", 172800, 180000)],
+    )
+
+
+def test_read_from_rds__cache() -> None:
+    with mock.patch(
+        "data_retrieval_lambda.data_retrieval_lambda.pymysql.connect"
+    ) as mock_connect:
+        output = [{"test": "output"}]
+        mock_execute = mock.MagicMock(name="execute")
+        mock_cur = mock.MagicMock(name="cursor")
+        mock_cur.execute = mock_execute
+        mock_cur.fetchone.return_value = (1,)
+        mock_cur.fetchall.return_value = output
+        mock_conn = mock.MagicMock(name="connection")
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cur
+        mock_connect.return_value.__enter__.return_value = mock_conn
+
+        cache = ResultCache(max_entries=10, ttl=60)
+        args = ("host", "database", "user", "password", "table", 1, 2, 3)
+
+        assert read_from_rds(*args, cache=cache) == output
+        assert mock_execute.call_count == 2
+        assert mock_execute.call_args_list[0].args == (
+            "SELECT version FROM table_versions WHERE device_id = %s",
+            (1,),
+        )
+
+        assert read_from_rds(*args, cache=cache) == output
+        assert mock_execute.call_count == 3
+        assert mock_execute.call_args.args == (
+            "SELECT version FROM table_versions WHERE device_id = %s",
+            (1,),
+        )
+
+        mock_cur.fetchone.return_value = (2,)
+        assert read_from_rds(*args, cache=cache) == output
+        assert mock_execute.call_count == 5
+        assert mock_execute.call_args.args == (
+            (
+                "SELECT * FROM table WHERE device_id = %s AND timestamp >= %s "
+                "AND timestamp < %s"
+            ),
+            (1, 2, 3),
+        )
+
+
+def test_result_cache__lru_eviction() -> None:
+    cache = ResultCache(max_entries=2, ttl=60)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+
+    cache.put("c", 3)
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+
+
+def test_result_cache__ttl_expiry() -> None:
+    with mock.patch(
+        "data_retrieval_lambda.data_retrieval_lambda.time.monotonic"
+    ) as mock_monotonic:
+        cache = ResultCache(max_entries=2, ttl=60)
+        mock_monotonic.return_value = 100
+        cache.put("a", 1)
+
+        mock_monotonic.return_value = 159
+        assert cache.get("a") == 1
+
+        mock_monotonic.return_value = 160
+        assert cache.get("a") is None
+
+
+def test_etag_matches() -> None:
+    assert not etag_matches('"abc"', None)
+    assert not etag_matches('"abc"', '"def"')
+    assert etag_matches('"abc"', '"abc"')
+    assert etag_matches('"abc"', '"def", W/"abc"')
+    assert etag_matches('"abc"', "*")
+
+
+def test_handler__etag() -> None:
+    env = {
+        "SECRET_MANAGER_ID": "secrets",
+        "REGION": "us-west-1",
+        "MYSQL_ID": "mysql",
+        "MYSQL_DATABASE": "database",
+        "MYSQL_TABLE": "table",
+    }
+    event = {
+        "resource": "/data",
+        "httpMethod": "GET",
+        "queryStringParameters": {"device_id": 1, "datetime_from": 2},
+    }
+    module = "data_retrieval_lambda.data_retrieval_lambda"
+    with mock.patch.dict(os.environ, env), mock.patch(
+        f"{module}.get_read_hosts", return_value=["host"]
+    ), mock.patch(
+        f"{module}.get_db_credentials", return_value=("user", "password")
+    ), mock.patch(
+        f"{module}.pymysql.connect"
+    ) as mock_connect:
+        mock_cur = mock.MagicMock(name="cursor")
+        mock_cur.fetchone.return_value = (1,)
+        mock_cur.fetchall.return_value = [{"test": "output"}]
+        mock_conn = mock.MagicMock(name="connection")
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cur
+        mock_connect.return_value.__enter__.return_value = mock_conn
+
+        response = handler(event, None)
+        assert response["statusCode"] == 200
+        assert json.loads(response["body"]) == {
+            "results": [{"test": "output"}],
+            "plan": "raw",
+        }
+        etag = response["headers"]["ETag"]
+        assert mock_cur.execute.call_count == 2
+
+        event["headers"] = {"if-none-match": etag}
+        response = handler(event, None)
+        assert response == {"statusCode": 304, "headers": {"ETag": etag}}
+        assert mock_cur.execute.call_count == 3
+
+        mock_cur.fetchone.return_value = (2,)
+        response = handler(event, None)
+        assert response["statusCode"] == 200
+        assert response["headers"]["ETag"] != etag
+        assert mock_cur.execute.call_count == 5
+
+
+def test_get_batch_statement() -> None:
+    event = validate_event(
+        {
+            "resource": "/data/batch",
+            "httpMethod": "POST",
+            "body": json.dumps(
+                {
+                    "queries": [
+                        {"device_id": 1, "datetime_from": 1},
+                        {"device_id": 2, "datetime_from": 2, "datetime_to": 3},
+                    ]
+                }
+            ),
+        }
+    )
+
+    queries = [DeviceQuery(query.device_id, query) for query in event.body.queries]
+    assert get_batch_statement("table", queries) == (
+        (
+            "(SELECT * FROM table WHERE device_id = %s AND timestamp >= %s) "
+            "UNION ALL (SELECT * FROM table WHERE device_id = %s "
+            "AND timestamp >= %s AND timestamp < %s) ORDER BY device_id, timestamp"
+        ),
+        [1, 1, 2, 2, 3],
+    )
+
+
+def test_handler__batch() -> None:
+    env = {
+        "SECRET_MANAGER_ID": "secrets",
+        "REGION": "us-west-1",
+        "MYSQL_ID": "mysql",
+        "MYSQL_DATABASE": "database",
+        "MYSQL_TABLE": "table",
+    }
+    event = {
+        "resource": "/data/batch",
+        "httpMethod": "POST",
+        "body": json.dumps(
+            {
+                "queries": [
+                    {"device_id": 1, "datetime_from": 1},
+                    {"device_id": 2, "datetime_from": 1},
+                    {"device_id": 3, "datetime_from": 1},
+                ]
+            }
+        ),
+    }
+    module = "data_retrieval_lambda.data_retrieval_lambda"
+    with mock.patch.dict(os.environ, env), mock.patch(
+        f"{module}.get_read_hosts", return_value=["host"]
+    ), mock.patch(
+        f"{module}.get_db_credentials", return_value=("user", "password")
+    ), mock.patch(
+        f"{module}.pymysql.connect"
+    ) as mock_connect:
+        mock_cur = mock.MagicMock(name="cursor")
+        mock_cur.fetchall.return_value = [
+            {"device_id": 1, "timestamp": 1},
+            {"device_id": 1, "timestamp": 2},
+            {"device_id": 2, "timestamp": 1},
+        ]
+        mock_conn = mock.MagicMock(name="connection")
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cur
+        mock_connect.return_value.__enter__.return_value = mock_conn
+
+        response = handler(event, None)
+        assert response["statusCode"] == 200
+        assert json.loads(response["body"]) == {
+            "results": {
+                "1": [
+                    {"device_id": 1, "timestamp": 1},
+                    {"device_id": 1, "timestamp": 2},
+                ],
+                "2": [{"device_id": 2, "timestamp": 1}],
+                "3": [],
+            },
+            "plans": {"1": "raw", "2": "raw", "3": "raw"},
+        }
+        assert mock_cur.execute.call_count == 1
+
+
+def test_handler__external_device_ids() -> None:
+    env = {
+        "SECRET_MANAGER_ID": "secrets",
+        "REGION": "us-west-1",
+        "MYSQL_ID": "mysql",
+        "MYSQL_DATABASE": "database",
+        "MYSQL_TABLE": "table",
+    }
+    event = {
+        "resource": "/data/batch",
+        "httpMethod": "POST",
+        "body": json.dumps(
+            {
+                "queries": [
+                    {"device_id": "sensor-a", "datetime_from": 1},
+                    {"device_id": "device_002", "datetime_from": 1},
+                ]
+            }
+        ),
+    }
+    module = "data_retrieval_lambda.data_retrieval_lambda"
+    with mock.patch.dict(os.environ, env), mock.patch(
+        f"{module}.get_read_hosts", return_value=["host"]
+    ), mock.patch(
+        f"{module}.get_db_credentials", return_value=("user", "password")
+    ), mock.patch(
+        f"{module}.DEVICE_DIRECTORY", DeviceDirectory()
+    ), mock.patch(
+        f"{module}.pymysql.connect"
+    ) as mock_connect:
+        mock_cur = mock.MagicMock(name="cursor")
+        mock_cur.fetchall.side_effect = [
+            [{"device_id": 1000, "external_id": "sensor-a"}],
+            [{"device_id": 1000, "timestamp": 1}, {"device_id": 2, "timestamp": 1}],
+            [],
+            [{"device_id": 1000, "timestamp": 1}],
+        ]
+        mock_conn = mock.MagicMock(name="connection")
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cur
+        mock_connect.return_value.__enter__.return_value = mock_conn
+
+        response = handler(event, None)
+        assert response["statusCode"] == 200
+        assert json.loads(response["body"])["results"] == {
+            "sensor-a": [{"device_id": 1000, "timestamp": 1}],
+            "device_002": [{"device_id": 2, "timestamp": 1}],
+        }
+        assert json.loads(response["body"])["plans"] == {
+            "sensor-a": "raw",
+            "device_002": "raw",
+        }
+        assert mock_cur.execute.call_args_list[0] == mock.call(
+            "SELECT device_id, external_id FROM table_devices "
+            "WHERE external_id IN (%s)",
+            ("sensor-a",),
+        )
+
+        event["body"] = json.dumps(
+            {"queries": [{"device_id": "sensor-b", "datetime_from": 1}]}
+        )
+        response = handler(event, None)
+        assert response == {
+            "statusCode": 404,
+            "body": json.dumps({"errors": [{"msg": "Unknown device id(s): sensor-b"}]}),
+        }
+
+        # The registered device is cached, and its external ID added to the rows
+        response = handler(
+            {
+                "resource": "/data/latest",
+                "httpMethod": "GET",
+                "queryStringParameters": {"device_ids": "sensor-a"},
+            },
+            None,
+        )
+        assert json.loads(response["body"]) == {
+            "results": [{"device_id": 1000, "timestamp": 1, "external_id": "sensor-a"}]
+        }
+        assert mock_cur.execute.call_args_list[-1] == mock.call(
+            "SELECT * FROM table_latest WHERE device_id IN (%s) ORDER BY device_id",
+            (1000,),
+        )
+
+
+def test_read_from_rds__fields() -> None:
+    with mock.patch(
+        "data_retrieval_lambda.data_retrieval_lambda.pymysql.connect"
+    ) as mock_connect:
+        mock_execute = mock.MagicMock(name="execute")
+        mock_cur = mock.MagicMock(name="cursor")
+        mock_cur.execute = mock_execute
+        mock_conn = mock.MagicMock(name="connection")
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cur
+        mock_connect.return_value.__enter__.return_value = mock_conn
+
+        args = ("host", "database", "user", "password", "table", 1, 2, 3)
+        read_from_rds(*args, fields=["temperature"])
+        assert mock_execute.call_args.args == (
+            (
+                "SELECT device_id, timestamp, temperature FROM table "
+                "WHERE device_id = %s AND timestamp >= %s AND timestamp < %s"
+            ),
+            (1, 2, 3),
+        )
+
+        read_from_rds(*args, resolution="1m", fields=["humidity", "hvac_status"])
+        assert mock_execute.call_args.args == (
+            (
+                "SELECT device_id, timestamp DIV 60 * 60 AS bucket, COUNT(*) AS count, "
+                "AVG(humidity) AS humidity_avg, MIN(humidity) AS humidity_min, "
+                "MAX(humidity) AS humidity_max, AVG(hvac_status) AS hvac_on_ratio "
+                "FROM table WHERE device_id = %s AND timestamp >= %s "
+                "AND timestamp < %s GROUP BY device_id, bucket ORDER BY bucket"
+            ),
+            (1, 2, 3),
+        )
+
+
+def test_query_time_window() -> None:
+    mock_cur = mock.MagicMock(name="cursor")
+    mock_cur.fetchall.return_value = [
+        {"device_id": 2, "timestamp": 10},
+        {"device_id": 1, "timestamp": 11},
+        {"device_id": 2, "timestamp": 11},
+    ]
+    mock_conn = mock.MagicMock(name="connection")
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cur
+
+    rows, next_page_token = query_time_window(mock_conn, "table", 1, 20, limit=2)
+    assert rows == [
+        {"device_id": 2, "timestamp": 10},
+        {"device_id": 1, "timestamp": 11},
+    ]
+    assert next_page_token == "11:1"
+    assert mock_cur.execute.call_args.args == (
+        (
+            "SELECT * FROM table WHERE timestamp >= %s AND timestamp < %s "
+            "ORDER BY timestamp, device_id LIMIT %s"
+        ),
+        (1, 20, 3),
+    )
+
+    mock_cur.fetchall.return_value = [{"device_id": 2, "timestamp": 11}]
+    rows, next_page_token = query_time_window(
+        mock_conn, "table", 1, 20, ["temperature"], limit=2, page_token="11:1"
+    )
+    assert rows == [{"device_id": 2, "timestamp": 11}]
+    assert next_page_token is None
+    assert mock_cur.execute.call_args.args == (
+        (
+            "SELECT device_id, timestamp, temperature FROM table "
+            "WHERE timestamp >= %s AND timestamp < %s "
+            "AND (timestamp > %s OR (timestamp = %s AND device_id > %s)) "
+            "ORDER BY timestamp, device_id LIMIT %s"
+        ),
+        (1, 20, 11, 11, 1, 3),
+    )
+
+
+def test_query_latest() -> None:
+    mock_cur = mock.MagicMock(name="cursor")
+    mock_cur.fetchall.return_value = [{"device_id": 1}, {"device_id": 2}]
+    mock_conn = mock.MagicMock(name="connection")
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cur
+
+    assert query_latest(mock_conn, "table") == [{"device_id": 1}, {"device_id": 2}]
+    assert mock_cur.execute.call_args.args == (
+        "SELECT * FROM table_latest ORDER BY device_id",
+        (),
+    )
+
+    query_latest(mock_conn, "table", [1, 2])
+    assert mock_cur.execute.call_args.args == (
+        "SELECT * FROM table_latest WHERE device_id IN (%s,%s) ORDER BY device_id",
+        (1, 2),
+    )
+
+
+# Blocks of device 1 (3 readings from 1690326000) and device 2 (1 from 1690329600)
+BLOCKS = [
+    (1, 1690326000, b"\x01\x03\x00x\x00\x01\x90\x03\n\n\x01\xf2\x07\x00\n\x06"),
+    (2, 1690329600, b"\x01\x01\x00\x01\xc2\x03\x00P\x00"),
+]
+
+
+def test_query_blocks() -> None:
+    mock_cur = mock.MagicMock(name="cursor")
+    mock_cur.fetchall.return_value = BLOCKS[:1]
+    mock_conn = mock.MagicMock(name="connection")
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cur
+
+    results = query_blocks(mock_conn, "table", 1, 1690326030, 1690329600)
+    assert results == [
+        {
+            "device_id": 1,
+            "timestamp": 1690326060,
+            "temperature": 20.5,
+            "humidity": 50.5,
+            "hvac_status": 1,
+        },
+        {
+            "device_id": 1,
+            "timestamp": 1690326120,
+            "temperature": 21.0,
+            "humidity": 51.0,
+            "hvac_status": 1,
+        },
+    ]
+    assert mock_cur.execute.call_args.args == (
+        (
+            "SELECT device_id, timestamp, data FROM table_blocks WHERE 1 = 1 "
+            "AND device_id = %s AND timestamp >= %s AND timestamp < %s"
+        ),
+        (1, 1690326000, 1690329600),
+    )
+
+    results = query_blocks(mock_conn, "table", 1, None, None, "1m", ["temperature"])
+    assert results == [
+        {
+            "device_id": 1,
+            "bucket": bucket,
+            "count": 1,
+            "temperature_avg": temperature,
+            "temperature_min": temperature,
+            "temperature_max": temperature,
+        }
+        for bucket, temperature in [
+            (1690326000, 20.0),
+            (1690326060, 20.5),
+            (1690326120, 21.0),
+        ]
+    ]
+
+
+def test_query_blocks__open_range() -> None:
+    mock_cur = mock.MagicMock(name="cursor")
+    mock_cur.fetchall.return_value = BLOCKS[:1]
+    mock_conn = mock.MagicMock(name="connection")
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cur
+
+    results = query_blocks(mock_conn, "table", 1, 0, 0)
+    assert [row["timestamp"] for row in results] == [
+        1690326000,
+        1690326060,
+        1690326120,
+    ]
+    assert mock_cur.execute.call_args.args == (
+        (
+            "SELECT device_id, timestamp, data FROM table_blocks WHERE 1 = 1 "
+            "AND device_id = %s"
+        ),
+        (1,),
+    )
+
+
+def test_query_time_window__blocks() -> None:
+    mock_cur = mock.MagicMock(name="cursor")
+    mock_cur.fetchall.return_value = BLOCKS
+    mock_conn = mock.MagicMock(name="connection")
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cur
+
+    rows, next_page_token = query_time_window(
+        mock_conn,
+        "table",
+        1690326000,
+        1690333200,
+        ["hvac_status"],
+        limit=2,
+        page_token="1690326000:1",
+        storage_mode="blocks",
+    )
+    assert rows == [
+        {"device_id": 1, "timestamp": 1690326060, "hvac_status": 1},
+        {"device_id": 1, "timestamp": 1690326120, "hvac_status": 1},
+    ]
+    assert next_page_token == "1690326120:1"
+    assert mock_cur.execute.call_args.args == (
+        (
+            "SELECT device_id, timestamp, data FROM table_blocks "
+            "WHERE timestamp >= %s AND timestamp < %s "
+            "ORDER BY timestamp, device_id LIMIT %s"
+        ),
+        (1690326000, 1690333200, 100),
+    )
+
+
+@mock.patch("data_retrieval_lambda.data_retrieval_lambda.WINDOW_BLOCK_BATCH", 1)
+def test_query_time_window__blocks_batches() -> None:
+    mock_cur = mock.MagicMock(name="cursor")
+    mock_cur.fetchall.side_effect = [BLOCKS[:1], BLOCKS[1:], []]
+    mock_conn = mock.MagicMock(name="connection")
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cur
+
+    rows, next_page_token = query_time_window(
+        mock_conn, "table", 1690326030, 1690333200, limit=1, storage_mode="blocks"
+    )
+    assert [(row["device_id"], row["timestamp"]) for row in rows] == [(1, 1690326060)]
+    assert next_page_token == "1690326060:1"
+    # Reading stops after the second batch, as 2 rows come before its block
+    assert [call.args for call in mock_cur.execute.call_args_list] == [
+        (
+            (
+                "SELECT device_id, timestamp, data FROM table_blocks "
+                "WHERE timestamp >= %s AND timestamp < %s "
+                "ORDER BY timestamp, device_id LIMIT %s"
+            ),
+            (1690326000, 1690333200, 1),
+        ),
+        (
+            (
+                "SELECT device_id, timestamp, data FROM table_blocks "
+                "WHERE timestamp >= %s AND timestamp < %s "
+                "AND (timestamp > %s OR (timestamp = %s AND device_id > %s)) "
+                "ORDER BY timestamp, device_id LIMIT %s"
+            ),
+            (1690326000, 1690333200, 1690326000, 1690326000, 1, 1),
+        ),
+    ]
+
+
+def test_aggregate_rows() -> None:
+    rows = [
+        {"device_id": 1, "timestamp": 0, "humidity": 50.0, "hvac_status": 1},
+        {"device_id": 1, "timestamp": 30, "humidity": 40.0, "hvac_status": 0},
+        {"device_id": 1, "timestamp": 60, "humidity": 45.0, "hvac_status": 0},
+    ]
+
+    assert aggregate_rows(rows, 60, ["humidity", "hvac_status"]) == [
+        {
+            "device_id": 1,
+            "bucket": 0,
+            "count": 2,
+            "humidity_avg": 45.0,
+            "humidity_min": 40.0,
+            "humidity_max": 50.0,
+            "hvac_on_ratio": 0.5,
+        },
+        {
+            "device_id": 1,
+            "bucket": 60,
+            "count": 1,
+            "humidity_avg": 45.0,
+            "humidity_min": 45.0,
+            "humidity_max": 45.0,
+            "hvac_on_ratio": 0.0,
+        },
+    ]
+
+
+def test_plan_statistics() -> None:
+    assert plan_statistics(1690326030, 1690329630) == QueryPlan(
+        "raw", [QuerySegment("raw", 1690326030, 1690329630)]
+    )
+    assert plan_statistics(1690326000, 1690416000) == QueryPlan(
+        "mixed",
+        [
+            QuerySegment("hourly", 1690326000, 1690329600),
+            QuerySegment("daily", 1690329600, 1690416000),
+        ],
+    )
+    assert plan_statistics(1690326030, 1690333230) == QueryPlan(
+        "mixed",
+        [
+            QuerySegment("raw", 1690326030, 1690329600),
+            QuerySegment("hourly", 1690329600, 1690333200),
+            QuerySegment("raw", 1690333200, 1690333230),
+        ],
+    )
+
+
+def test_query_statistics() -> None:
+    mock_cur = mock.MagicMock(name="cursor")
+    mock_cur.__iter__.side_effect = lambda: iter([(20.0,), (22.0,)])
+    mock_cur.fetchall.return_value = [
+        (1690329600, struct.pack("<HQBI3f", 200, 3, 1, 3, 21.0, 21.5, 23.0)),
+        (1690333200, None),
+    ]
+    mock_conn = mock.MagicMock(name="connection")
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cur
+
+    results, plan = query_statistics(
+        mock_conn, "table", 1, 1690326030, 1690336830, ["temperature"], [0, 50, 100]
+    )
+    assert plan.name == "mixed"
+    # Two raw segments and the hour without a sketch each stream two values
+    assert results == {
+        "temperature": {"count": 9, "p0": 20.0, "p50": 21.5, "p100": 23.0}
+    }
+    assert mock_cur.execute.call_args_list[1].args == (
+        (
+            "SELECT timestamp, temperature_sketch FROM table_hourly "
+            "WHERE device_id = %s AND timestamp >= %s AND timestamp < %s"
+        ),
+        (1, 1690329600, 1690336800),
+    )
+    assert mock_cur.execute.call_args_list[2].args == (
+        (
+            "SELECT temperature FROM table "
+            "WHERE device_id = %s AND timestamp >= %s AND timestamp < %s"
+        ),
+        (1, 1690333200, 1690336800),
+    )
+
+    mock_cur.__iter__.side_effect = lambda: iter([(20.0, 50.0), (22.0, 40.0)])
+    results, plan = query_statistics(
+        mock_conn, "table", 1, 1690326030, 1690336830, mode="exact"
+    )
+    assert plan.name == "raw"
+    assert results == {
+        "temperature": {"count": 2, "p50": 20.0},
+        "humidity": {"count": 2, "p50": 40.0},
+    }
+
+
+def test_merge_pages() -> None:
+    pages = [
+        ([{"timestamp": 1, "device_id": 2}, {"timestamp": 3, "device_id": 2}], "3:2"),
+        ([{"timestamp": 1, "device_id": 1}], None),
+    ]
+    assert merge_pages(pages, 2) == (
+        [{"timestamp": 1, "device_id": 1}, {"timestamp": 1, "device_id": 2}],
+        "1:2",
+    )
+    assert merge_pages(pages[1:], 2) == ([{"timestamp": 1, "device_id": 1}], None)
+
+
+def test_handler__shards() -> None:
+    env = {
+        "SECRET_MANAGER_ID": "secrets",
+        "REGION": "us-west-1",
+        "MYSQL_ID": "shard-0, shard-1",
+        "MYSQL_DATABASE": "database",
+        "MYSQL_TABLE": "table",
+    }
+    # Fake connection layer, with a connection per shard that serves its rows
+    shard_rows = {
+        "shard-0": [{"device_id": 2, "timestamp": 10}],
+        "shard-1": [
+            {"device_id": 1, "timestamp": 10},
+            {"device_id": 3, "timestamp": 11},
+        ],
+    }
+    cursors = {}
+
+    def connect(host: str, **_kwargs: Any) -> mock.MagicMock:
+        mock_cur = cursors.setdefault(host, mock.MagicMock(name=host))
+        mock_cur.fetchall.return_value = shard_rows[host]
+        mock_conn = mock.MagicMock(name="connection")
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cur
+        return mock.MagicMock(**{"__enter__.return_value": mock_conn})
+
+    module = "data_retrieval_lambda.data_retrieval_lambda"
+    with mock.patch.dict(os.environ, env), mock.patch(
+        f"{module}.get_read_hosts", side_effect=lambda rds_id, *_: [rds_id]
+    ), mock.patch(
+        f"{module}.get_db_credentials", return_value=("user", "password")
+    ), mock.patch(
+        f"{module}.pymysql.connect", side_effect=connect
+    ):
+        response = handler(
+            {
+                "resource": "/data",
+                "httpMethod": "GET",
+                "queryStringParameters": {
+                    "datetime_from": 1,
+                    "datetime_to": 20,
+                    "limit": 2,
+                },
+            },
+            None,
+        )
+        assert json.loads(response["body"]) == {
+            "results": [
+                {"device_id": 1, "timestamp": 10, "external_id": "device_001"},
+                {"device_id": 2, "timestamp": 10, "external_id": "device_002"},
+            ],
+            "next_page_token": "10:2",
+        }
+        assert set(cursors) == {"shard-0", "shard-1"}
+
+        cursors.clear()
+        response = handler(
+            {
+                "resource": "/data/batch",
+                "httpMethod": "POST",
+                "body": json.dumps(
+                    {
+                        "queries": [
+                            {"device_id": 1, "datetime_from": 1},
+                            {"device_id": 3, "datetime_from": 1},
+                        ]
+                    }
+                ),
+            },
+            None,
+        )
+        # Both devices are stored on the second shard, so only it is queried
+        assert set(cursors) == {"shard-1"}
+        assert json.loads(response["body"])["results"] == {
+            "1": [{"device_id": 1, "timestamp": 10}],
+            "3": [{"device_id": 3, "timestamp": 11}],
+        }
+
+
+@mock_s3
+@mock.patch.dict(os.environ, S3_CHECKSUM_ENV)
+def test_gzip_multipart_upload() -> None:
+    s3_client = boto3.client("s3", region_name="us-east-1")
+    s3_client.create_bucket(Bucket="exports")
+    rng = random.Random(0)
+    lines = [f"{rng.random()},{rng.random()}\n" for _ in range(2000)]
+
+    # Small parts, so the random lines span several of them
+    with mock.patch(f"{MODULE}.EXPORT_PART_SIZE", 8192), mock.patch(
+        "moto.s3.models.S3_UPLOAD_PART_MIN_SIZE", 1024
+    ), GzipMultipartUpload(s3_client, "exports", "data.csv.gz") as upload:
+        for line in lines:
+            upload.write(line)
+
+    response = s3_client.get_object(Bucket="exports", Key="data.csv.gz")
+    assert int(response["ETag"].strip('"').rsplit("-", 1)[1]) > 1
+    assert response["ContentEncoding"] == "gzip"
+    assert gzip.decompress(response["Body"].read()).decode() == "".join(lines)
+
+    with pytest.raises(ValueError), GzipMultipartUpload(
+        s3_client, "exports", "failed.csv.gz"
+    ) as upload:
+        upload.write("device_id\n")
+        raise ValueError("failed")
+    assert "Uploads" not in s3_client.list_multipart_uploads(Bucket="exports")
+    assert s3_client.list_objects_v2(Bucket="exports")["KeyCount"] == 1
+
+    # Failing to complete the upload aborts it too
+    upload = GzipMultipartUpload(s3_client, "exports", "failed.csv.gz")
+    with mock.patch.object(
+        s3_client, "complete_multipart_upload", side_effect=ValueError("failed")
+    ), pytest.raises(ValueError), upload:
+        upload.write("device_id\n")
+    assert "Uploads" not in s3_client.list_multipart_uploads(Bucket="exports")
+
+    # Entering the upload again starts it over, as when a shard is retried
+    with upload:
+        upload.write("device_id\n")
+    response = s3_client.get_object(Bucket="exports", Key="failed.csv.gz")
+    assert gzip.decompress(response["Body"].read()) == b"device_id\n"
+
+
+@mock_s3
+@mock.patch.dict(os.environ, S3_CHECKSUM_ENV)
+def test_handler__export() -> None:
+    env = {
+        "SECRET_MANAGER_ID": "secrets",
+        "REGION": "us-west-1",
+        "MYSQL_ID": "mysql",
+        "MYSQL_DATABASE": "database",
+        "MYSQL_TABLE": "table",
+        "EXPORT_BUCKET": "exports",
+        "AWS_LAMBDA_FUNCTION_NAME": "data_retrieval_lambda",
+    }
+    s3_client = boto3.client("s3", region_name="us-west-1")
+    s3_client.create_bucket(
+        Bucket="exports",
+        CreateBucketConfiguration={"LocationConstraint": "us-west-1"},
+    )
+    mock_lambda = mock.MagicMock(name="lambda")
+    datetime_from = 1690000000
+    with mock.patch.dict(os.environ, env), mock.patch(
+        f"{MODULE}.get_read_hosts", return_value=["host"]
+    ), mock.patch(
+        f"{MODULE}.get_db_credentials", return_value=("user", "password")
+    ), mock.patch.dict(
+        "iot_common.aws.BOTO3_CLIENTS", {("lambda", "us-west-1"): mock_lambda}
+    ), mock.patch(
+        f"{MODULE}.pymysql.connect"
+    ) as mock_connect:
+        mock_cur = mock.MagicMock(name="cursor")
+        # Each device is read in two windows, over an unbuffered cursor
+        mock_cur.__iter__.side_effect = [
+            iter([(datetime_from, 20.5, 50.0)]),
+            iter([]),
+            iter([(datetime_from, 21.0, 51.5)]),
+            iter([(datetime_from + EXPORT_WINDOW, 21.5, 52.0)]),
+        ]
+        mock_conn = mock.MagicMock(name="connection")
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cur
+        mock_connect.return_value.__enter__.return_value = mock_conn
+
+        response = handler(
+            {
+                "resource": "/data/export",
+                "httpMethod": "POST",
+                "body": json.dumps(
+                    {
+                        "device_ids": ["device_002", 1],
+                        "datetime_from": datetime_from,
+                        "datetime_to": datetime_from + EXPORT_WINDOW + 10,
+                        "fields": ["humidity", "temperature"],
+                    }
+                ),
+            },
+            None,
+        )
+        assert response["statusCode"] == 202
+        job_id = json.loads(response["body"])["job_id"]
+        mock_lambda.invoke.assert_called_once_with(
+            FunctionName="data_retrieval_lambda",
+            InvocationType="Event",
+            Payload=json.dumps({"export_job": job_id}).encode("utf-8"),
+        )
+
+        status_event = {
+            "resource": "/data/export/status",
+            "httpMethod": "GET",
+            "queryStringParameters": {"job_id": job_id},
+        }
+        response = handler(status_event, None)
+        assert json.loads(response["body"])["status"] == "pending"
+
+        job = handler({"export_job": job_id}, None)
+        key = f"exports/{job_id}/part-0000.csv.gz"
+        assert job["status"] == "succeeded"
+        assert [(f["key"], f["rows"]) for f in job["files"]] == [(key, 3)]
+        assert mock_cur.execute.call_args_list[0] == mock.call(
+            "SELECT timestamp, temperature, humidity FROM table "
+            "WHERE device_id = %s AND timestamp >= %s AND timestamp < %s",
+            (1, datetime_from, datetime_from + EXPORT_WINDOW),
+        )
+        body = s3_client.get_object(Bucket="exports", Key=key)["Body"].read()
+        assert gzip.decompress(body).decode() == (
+            "device_id,external_id,timestamp,temperature,humidity\n"
+            f"1,device_001,{datetime_from},20.5,50.0\n"
+            f"2,device_002,{datetime_from},21.0,51.5\n"
+            f"2,device_002,{datetime_from + EXPORT_WINDOW},21.5,52.0\n"
+        )
+
+        response = handler(status_event, None)
+        status = json.loads(response["body"])
+        assert status["status"] == "succeeded"
+        assert status["files"][0]["url"].startswith(
+            f"https://exports.s3.amazonaws.com/{key}?"
+        )
+
+        # Retried invocations of a finished job don't export it again
+        mock_connect.reset_mock()
+        assert handler({"export_job": job_id}, None)["status"] == "succeeded"
+        mock_connect.assert_not_called()
+
+        status_event["queryStringParameters"]["job_id"] = "0" * 32
+        response = handler(status_event, None)
+        assert response["statusCode"] == 404
+
+        # Unexpected errors fail the job as well, instead of leaving it running
+        mock_cur.__iter__.side_effect = KeyError("timestamp")
+        response = handler(
+            {
+                "resource": "/data/export",
+                "httpMethod": "POST",
+                "body": json.dumps(
+                    {
+                        "device_ids": [1],
+                        "datetime_from": datetime_from,
+                        "datetime_to": datetime_from + 10,
+                    }
+                ),
+            },
+            None,
+        )
+        job_id = json.loads(response["body"])["job_id"]
+        job = handler({"export_job": job_id}, None)
+        assert (job["status"], job["error"]) == ("failed", "KeyError: 'timestamp'")
+        assert "Uploads" not in s3_client.list_multipart_uploads(Bucket="exports")
+        status_event["queryStringParameters"]["job_id"] = job_id
+        response = handler(status_event, None)
+        assert json.loads(response["body"])["status"] == "failed"
+
+        # Jobs left running by an invocation that stopped are run again once stale
+        mock_cur.__iter__.side_effect = [iter([(datetime_from, 20.5, 50.0)])]
+        status_key = f"exports/{job_id}/status.json"
+        del job["error"]
+        job["status"] = "running"
+        s3_client.put_object(Bucket="exports", Key=status_key, Body=json.dumps(job))
+        assert handler({"export_job": job_id}, None)["status"] == "running"
+        job["updated_at"] -= EXPORT_STALE_SECONDS + 1
+        s3_client.put_object(Bucket="exports", Key=status_key, Body=json.dumps(job))
+        job = handler({"export_job": job_id}, None)
+        assert job["status"] == "succeeded"
+        assert job["files"][0]["rows"] == 1
+
+        # Or reported as failed, when the invocation wasn't retried
+        job |= {"status": "running", "updated_at": 0}
+        s3_client.put_object(Bucket="exports", Key=status_key, Body=json.dumps(job))
+        response = handler(status_event, None)
+        status = json.loads(response["body"])
+        assert (status["status"], status["error"]) == ("failed", "Export job timed out")
+        assert handler({"export_job": job_id}, None)["status"] == "failed"
+
+
+@pytest.mark.skipif(not MYSQL_TEST_HOST, reason="MYSQL_TEST_HOST is not set")
+@mock_s3
+@mock.patch.dict(os.environ, S3_CHECKSUM_ENV)
+def test_handler__export_local_mysql() -> None:
+    settings = {
+        "host": MYSQL_TEST_HOST,
+        "user": os.environ.get("MYSQL_TEST_USER", "root"),
+        "password": os.environ.get("MYSQL_TEST_PASSWORD", ""),
+    }
+    database = "ignite_test_exports"
+    with pymysql.connect(**settings) as conn, conn.cursor() as cur:
+        cur.execute(f"DROP DATABASE IF EXISTS {database}")
+        cur.execute(f"CREATE DATABASE {database}")
+        cur.execute(
+            f"CREATE TABLE {database}.IotData (device_id int, timestamp int, "
+            "temperature float, humidity float, hvac_status boolean, "
+            "PRIMARY KEY (device_id, timestamp))"
+        )
+        cur.execute(
+            f"CREATE TABLE {database}.IotData_latest (device_id int, timestamp int, "
+            "temperature float, humidity float, hvac_status boolean, "
+            "PRIMARY KEY (device_id))"
+        )
+        cur.execute(
+            f"CREATE TABLE {database}.IotData_devices (device_id int, "
+            "external_id varchar(64), PRIMARY KEY (device_id))"
+        )
+        rows = [
+            (device_id, 1690000000 + i * 600, 20 + i % 7, 50 + i % 11, i % 2)
+            for device_id in (1, 1000)
+            for i in range(2000)
+        ]
+        cur.executemany(
+            f"INSERT INTO {database}.IotData VALUES (%s, %s, %s, %s, %s)", rows
+        )
+        cur.executemany(
+            f"INSERT INTO {database}.IotData_latest VALUES (%s, %s, %s, %s, %s)",
+            [rows[1999], rows[-1]],
+        )
+        cur.execute(f"INSERT INTO {database}.IotData_devices VALUES (1000, 'sensor-a')")
+        conn.commit()
+
+    env = {
+        "SECRET_MANAGER_ID": "secrets",
+        "REGION": "us-east-1",
+        "MYSQL_ID": "mysql",
+        "MYSQL_DATABASE": database,
+        "MYSQL_TABLE": "IotData",
+        "EXPORT_BUCKET": "exports",
+        "AWS_LAMBDA_FUNCTION_NAME": "data_retrieval_lambda",
+    }
+    s3_client = boto3.client("s3", region_name="us-east-1")
+    s3_client.create_bucket(Bucket="exports")
+    try:
+        with mock.patch.dict(os.environ, env), mock.patch(
+            f"{MODULE}.get_read_hosts", return_value=[MYSQL_TEST_HOST]
+        ), mock.patch(
+            f"{MODULE}.get_db_credentials",
+            return_value=(settings["user"], settings["password"]),
+        ), mock.patch(
+            f"{MODULE}.DEVICE_DIRECTORY", DeviceDirectory()
+        ), mock.patch.dict(
+            "iot_common.aws.BOTO3_CLIENTS", {("lambda", "us-east-1"): mock.MagicMock()}
+        ):
+            response = handler(
+                {
+                    "resource": "/data/export",
+                    "httpMethod": "POST",
+                    "body": json.dumps(
+                        {"datetime_from": 1690000000, "datetime_to": 1700000000}
+                    ),
+                },
+                None,
+            )
+            job = handler({"export_job": json.loads(response["body"])["job_id"]}, None)
+
+        assert job["status"] == "succeeded"
+        assert job["files"][0]["rows"] == len(rows)
+        body = s3_client.get_object(Bucket="exports", Key=job["files"][0]["key"])
+        lines = gzip.decompress(body["Body"].read()).decode().splitlines()
+        assert len(lines) == len(rows) + 1
+        assert lines[1] == "1,device_001,1690000000,20.0,50.0,0"
+        assert lines[-1].startswith("1000,sensor-a,")
+    finally:
+        with pymysql.connect(**settings) as conn, conn.cursor() as cur:
+            cur.execute(f"DROP DATABASE IF EXISTS {database}")
+
+
+def test_import_is_lazy() -> None:
+    # Modules loaded when importing the handler module, on every cold start
+    module = "data_retrieval_lambda.data_retrieval_lambda"
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            (
+                f"import sys, {module}; "
+                "print(sorted({'boto3', 'aws_lambda_powertools'} & set(sys.modules)))"
+            ),
+        ],
+        cwd=Path(__file__).parents[2],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    # Heavy modules are only imported on the code paths that need them
+    assert result.stdout.strip() == "[]"
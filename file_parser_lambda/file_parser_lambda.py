@@ -5,26 +5,139 @@ This script:
  - Gets triggered by a new .txt object added to the configured S3 bucket.
  - Reads the content of the new object.
  - Parser the csv and validates the content.
- - Writes the data to a configures MySQL RDS instance.
+ - Maps the device IDs to compact surrogate IDs, registering new devices in the
+   devices dimension table.
+ - Cleans the data: converts units, and flags, drops or interpolates bad values.
+ - Writes the data to a configures MySQL RDS instance, or in parallel to the
+   shards that store each device when MYSQL_ID lists several instances.
+ - Maintains the hourly and daily rollup tables of the written data, including
+   mergeable quantile sketches of the temperature and humidity.
+ - Bumps the data version of the written devices to invalidate cached queries.
+ - Keeps the latest reading of each device up to date.
+ - Optionally packs the data into compressed device-hour blocks instead of rows.
+ - Emits per-stage timings and counters in CloudWatch Embedded Metric Format.
+ - Profiles a sampled fraction of the invocations, when enabled.
 """
 
 import csv
+import hashlib
 import json
+import math
 import os
-import re
+import random
+import threading
+import time
+from collections import deque
+from collections.abc import Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Any
+from functools import lru_cache, partial
+from operator import attrgetter
+from statistics import median
+from typing import Any, NamedTuple
 
-import boto3
 import pymysql
-from aws_lambda_powertools.utilities.parser import BaseModel, ValidationError, validator
 from botocore.exceptions import ClientError
+from pydantic import BaseModel, ValidationError, validator
+from pydantic.error_wrappers import ErrorWrapper
 
+from iot_common.aws import MAX_WORKERS, get_client
+from iot_common.blocks import BLOCK_SIZE, decode_block, encode_block
+from iot_common.devices import DEVICE_ID_PATTERN, get_legacy_device_id, get_shard
+from iot_common.errors import LambdaError
+from iot_common.metrics import Metrics
+from iot_common.profiling import profile_invocation
+from iot_common.sketch import QuantileSketch
 
-class LambdaError(Exception):
-    def __init__(self, message: str) -> None:
-        self.message = message
-        super().__init__(self.message)
+# Rollup tables maintained next to the raw table, as (suffix, bucket size, source)
+ROLLUPS = (("hourly", 3600, ""), ("daily", 86400, "_hourly"))
+
+# Aggregates stored in the rollup tables, computed from the raw and rollup rows
+ROLLUP_AGGREGATES = {
+    "sample_count": ("COUNT(*)", "SUM(sample_count)"),
+    "temperature_sum": ("SUM(temperature)", "SUM(temperature_sum)"),
+    "temperature_min": ("MIN(temperature)", "MIN(temperature_min)"),
+    "temperature_max": ("MAX(temperature)", "MAX(temperature_max)"),
+    "temperature_sum_sq": (
+        "SUM(temperature * temperature)",
+        "SUM(temperature_sum_sq)",
+    ),
+    "humidity_sum": ("SUM(humidity)", "SUM(humidity_sum)"),
+    "humidity_min": ("MIN(humidity)", "MIN(humidity_min)"),
+    "humidity_max": ("MAX(humidity)", "MAX(humidity_max)"),
+    "humidity_sum_sq": ("SUM(humidity * humidity)", "SUM(humidity_sum_sq)"),
+    "hvac_on_count": ("SUM(hvac_status)", "SUM(hvac_on_count)"),
+}
+
+# Columns that are summarized by a quantile sketch in the rollup tables
+SKETCH_FIELDS = ["temperature", "humidity"]
+
+
+# Storage layouts of the raw data, either one row per reading or device-hour blocks
+STORAGE_MODES = ["rows", "blocks"]
+
+
+# Bounds of the insert batch size, which adapts to the batch latency (see BatchSizer)
+MIN_BATCH_SIZE = 100
+MAX_BATCH_SIZE = 10000
+
+# MySQL errors of statements that timed out waiting for, or deadlocked on, locks
+LOCK_ERRORS = {1205: "lock wait timeout", 1213: "deadlock"}
+
+# Seconds a statement waits for a row lock, well within the Lambda timeout, so
+# contended writes fail fast and back off instead of piling up
+LOCK_WAIT_TIMEOUT = 5
+
+# Attempts of a write transaction that is rolled back by a lock error
+WRITE_ATTEMPTS = 3
+
+# Seconds a writer waits for a free writer slot (see writer_slot)
+WRITER_SLOT_TIMEOUT = 10
+
+# What the cleaning stage does with bad values: nothing (off), count and log them
+# (flag), drop their rows (drop) or interpolate them from good neighbours
+CLEANING_ACTIONS = ["off", "flag", "drop", "interpolate"]
+
+# Default physical bounds of the cleaned data columns, see CLEANING_BOUNDS
+CLEANING_BOUNDS = {"temperature": (-40.0, 85.0), "humidity": (0.0, 100.0)}
+
+# Smallest deviation from the rolling mean that is a spike, for flat series
+MIN_SPIKES = {"temperature": 2.0, "humidity": 5.0}
+
+# Unit conversions of a device's column, as (low, high, scale, offset), applied
+# when the median of the file's values lies within [low, high]: Kelvin
+# temperatures and humidity fractions
+UNIT_CONVERSIONS = {
+    "temperature": (200.0, 400.0, 1.0, -273.15),
+    "humidity": (0.0, 1.0, 100.0, 0.0),
+}
+
+# Longest run of consecutive spikes, longer runs are taken as a level shift
+MAX_SPIKE_RUN = 3
+
+# Preceding values needed before a value is checked for a spike
+MIN_SPIKE_WINDOW = 2
+
+
+# Maximum number of external device IDs looked up per statement
+DEVICE_LOOKUP_BATCH_SIZE = 1000
+
+
+class IotCsvRow(BaseModel):
+    """Pydantic model for validating the rows of IoT data files, as they're sent"""
+
+    device_id: str
+    timestamp: datetime
+    temperature: float
+    humidity: float
+    hvac_status: bool
+
+    @validator("device_id", pre=True)
+    @classmethod
+    def device_id_validator(cls, value: str) -> str:
+        """Custom validator for device_id, which checks its format"""
+        return check_device_id(value)
 
 
 class IotData(BaseModel):
@@ -39,13 +152,10 @@ class IotData(BaseModel):
     @validator("device_id", pre=True)
     @classmethod
     def device_id_validator(cls, value: str) -> int:
-        """Custom validator for device_id"""
-        match_obj = re.match(r"^device_([0-9]{3})$", value)
-        if not match_obj:
-            raise ValueError(f"invalid device id format provided: {value}")
-        return int(match_obj.group(1))
+        """Custom validator for device_id, which maps it to its surrogate ID"""
+        return map_device_id(check_device_id(value))
 
-    def get_values(self) -> tuple[Any]:
+    def get_values(self) -> tuple[Any, ...]:
         """Returns the values of the object in fixed order"""
         values = []
         for field_name in IotData.__fields__:
@@ -56,23 +166,108 @@ class IotData(BaseModel):
         return tuple(values)
 
 
+class CleaningRules(NamedTuple):
+    """Configuration of the cleaning stage, see clean_data"""
+
+    action: str
+    bounds: dict[str, tuple[float, float]]
+    spike_window: int = 10
+    spike_threshold: float = 4.0
+
+
+class BatchSizer:
+    """
+    Sizes the insert batches of an RDS instance from their latency, AIMD style.
+
+    The size grows by MIN_BATCH_SIZE rows after every batch written within the
+    target latency, and is halved after a slower batch or a lock error. Writers
+    back off quickly while the instance is contended, and grow their batches
+    back gradually once it recovers.
+    """
+
+    def __init__(self, target_latency: float, size: int = 1000) -> None:
+        self.target_latency = target_latency
+        self.size = size
+        self._lock = threading.Lock()
+
+    def record(self, latency: float) -> None:
+        """Adapts the batch size to the latency of a written batch, in seconds"""
+        with self._lock:
+            if latency > self.target_latency:
+                self.size = max(MIN_BATCH_SIZE, self.size // 2)
+            else:
+                self.size = min(MAX_BATCH_SIZE, self.size + MIN_BATCH_SIZE)
+
+    def back_off(self) -> None:
+        """Halves the batch size, after a lock error"""
+        with self._lock:
+            self.size = max(MIN_BATCH_SIZE, self.size // 2)
+
+
+# Batch sizers by RDS host, kept across invocations (see get_batch_sizer)
+BATCH_SIZERS: dict[str, BatchSizer] = {}
+BATCH_SIZERS_LOCK = threading.Lock()
+
+# Surrogate IDs of the external device IDs, which never change once registered, so
+# they're kept across invocations (see register_device_ids)
+DEVICE_IDS: dict[str, int] = {}
+DEVICE_IDS_LOCK = threading.Lock()
+
+# Per-stage metrics of the invocation, flushed as EMF log lines by the handler
+METRICS = Metrics(
+    namespace=os.environ.get("METRICS_NAMESPACE", "IotData"),
+    function_name=os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "file_parser_lambda"),
+)
+
+
 def handler(events: Any, _context: Any) -> None:
     """Handler function that is called by AWS Lambda"""
-    secret_manager_id = get_env_value("SECRET_MANAGER_ID")
-    region = get_env_value("REGION")
-    rds_id = get_env_value("MYSQL_ID")
-    database = get_env_value("MYSQL_DATABASE")
-    table = get_env_value("MYSQL_TABLE")
+    with profile_invocation(events, METRICS.function_name):
+        secret_manager_id = get_env_value("SECRET_MANAGER_ID")
+        region = get_env_value("REGION")
+        rds_ids = [rds_id.strip() for rds_id in get_env_value("MYSQL_ID").split(",")]
+        database = get_env_value("MYSQL_DATABASE")
+        table = get_env_value("MYSQL_TABLE")
+        storage_mode = os.environ.get("STORAGE_MODE", "rows")
+        if storage_mode not in STORAGE_MODES:
+            raise LambdaError(f"Invalid storage mode: {storage_mode}")
+        # Caps the simultaneous writers per RDS instance, when greater than 0
+        writer_slots = int(os.environ.get("WRITER_SLOTS", "0"))
 
-    for event in filter_events(events):
-        s3_bucket = event["s3"]["bucket"]["name"]
-        s3_object_key = event["s3"]["object"]["key"]
+        try:
+            for event in filter_events(events):
+                s3_bucket = event["s3"]["bucket"]["name"]
+                s3_object_key = event["s3"]["object"]["key"]
 
-        data = parse_s3_csv_file(s3_bucket, s3_object_key)
-        host = get_rds_endpoint(rds_id, region)
-        user, password = get_db_credentials(secret_manager_id, region)
+                hosts = [get_rds_endpoint(rds_id, region) for rds_id in rds_ids]
+                user, password = get_db_credentials(secret_manager_id, region)
+                # The devices are registered on the first instance, so their
+                # surrogate IDs are unique across the shards
+                register_devices = partial(
+                    register_device_ids,
+                    host=hosts[0],
+                    database=database,
+                    user=user,
+                    password=password,
+                    table=table,
+                )
+                data = clean_data(
+                    parse_s3_csv_file(s3_bucket, s3_object_key, register_devices),
+                    get_cleaning_rules(),
+                )
 
-        write_to_rds(data, host, database, user, password, table)
+                write_to_shards(
+                    data,
+                    hosts,
+                    database,
+                    user,
+                    password,
+                    table,
+                    storage_mode,
+                    writer_slots,
+                )
+        finally:
+            METRICS.flush()
 
 
 def filter_events(events: Any) -> list[dict[str, Any]]:
@@ -89,30 +284,286 @@ def filter_events(events: Any) -> list[dict[str, Any]]:
     ]
 
 
-def parse_s3_csv_file(s3_bucket: str, s3_object_key: str) -> list[IotData]:
-    """Read csv content from S3 object then parse and validate the values"""
+def parse_s3_csv_file(
+    s3_bucket: str,
+    s3_object_key: str,
+    register_devices: Callable[[set[str]], None] | None = None,
+) -> list[IotData]:
+    """
+    Read csv content from S3 object then parse and validate the values.
+
+    Legacy device IDs map to their number. Other device IDs must be registered,
+    by register_devices when it's provided, before they're mapped. Devices are
+    only registered once every row of the file is valid.
+    """
     print(f"Reading '{s3_object_key}' object from '{s3_bucket}'")
-    s3_client = boto3.client("s3")
+    s3_client = get_client("s3")
+    with METRICS.timer("s3_get"):
+        try:
+            s3_object = s3_client.get_object(Bucket=s3_bucket, Key=s3_object_key)
+        except ClientError as e:
+            raise LambdaError(
+                f"Failed to retrieve '{s3_object_key}' object "
+                f"from '{s3_bucket}' bucket: {e}"
+            ) from e
+        body = s3_object["Body"].read()
+    METRICS.add("s3_get", "Bytes", len(body), "Bytes")
+    with METRICS.timer("decode"):
+        content = body.decode("utf-8")
+        if not content.strip():
+            raise LambdaError(
+                f"The '{s3_object_key}' object from '{s3_bucket}' bucket is empty"
+            )
+        csv_reader = csv.DictReader(content.strip().split("\n"))
+        csv_data = list(csv_reader)
+        if any(None in d for d in csv_data):
+            raise LambdaError("Data parsed without a header")
+    METRICS.add("decode", "RowsParsed", len(csv_data))
+    with METRICS.timer("validate"):
+        try:
+            rows = [IotCsvRow.parse_obj(d) for d in csv_data]
+        except ValidationError as e:
+            # A single invalid row rejects the whole file, with the errors reported
+            # for the model of the parsed data
+            METRICS.add("validate", "RowsRejected", len(csv_data))
+            errors = ValidationError(e.raw_errors, IotData)
+            raise LambdaError(f"Failed to parse data: {errors}") from e
+    # The devices of rejected files are never registered
+    if register_devices is not None:
+        register_devices({row.device_id for row in rows})
+    with METRICS.timer("validate"):
+        try:
+            # The rows are valid, so only their device IDs are mapped
+            data = [
+                IotData.construct(
+                    **{**row.__dict__, "device_id": map_device_id(row.device_id)}
+                )
+                for row in rows
+            ]
+        except ValueError as e:
+            METRICS.add("validate", "RowsRejected", len(csv_data))
+            errors = ValidationError([ErrorWrapper(e, loc="device_id")], IotData)
+            raise LambdaError(f"Failed to parse data: {errors}") from e
+    return data
+
+
+@lru_cache(maxsize=1)
+def get_cleaning_rules() -> CleaningRules:
+    """
+    Returns the cleaning rules, configured by the environment.
+
+    CLEANING_ACTION picks the action (default "flag"), CLEANING_BOUNDS overrides
+    column bounds as JSON (e.g. {"temperature": [-20, 60]}), and
+    CLEANING_SPIKE_WINDOW and CLEANING_SPIKE_THRESHOLD tune the spike detection.
+    The rules are compiled once per container.
+    """
+    action = os.environ.get("CLEANING_ACTION", "flag")
+    if action not in CLEANING_ACTIONS:
+        raise LambdaError(f"Invalid cleaning action: {action}")
+    bounds = dict(CLEANING_BOUNDS)
     try:
-        s3_object = s3_client.get_object(Bucket=s3_bucket, Key=s3_object_key)
-    except ClientError as e:
-        raise LambdaError(
-            f"Failed to retrieve '{s3_object_key}' object from '{s3_bucket}' bucket: {e}"
-        ) from e
-    content = s3_object["Body"].read().decode("utf-8")
-    if not content.strip():
-        raise LambdaError(
-            f"The '{s3_object_key}' object from '{s3_bucket}' bucket is empty"
+        overrides = json.loads(os.environ.get("CLEANING_BOUNDS", "{}"))
+        bounds.update(
+            {name: (float(low), float(high)) for name, (low, high) in overrides.items()}
         )
-    csv_reader = csv.DictReader(content.strip().split("\n"))
-    csv_data = list(csv_reader)
-    if any(None in d for d in csv_data):
-        raise LambdaError("Data parsed without a header")
-    try:
-        data = [IotData(**d) for d in csv_data]
-    except ValidationError as e:
-        raise LambdaError(f"Failed to parse data: {str(e)}") from e
-    return data
+    except (TypeError, ValueError) as e:
+        raise LambdaError(f"Invalid cleaning bounds: {e}") from e
+    return CleaningRules(
+        action,
+        {name: bounds[name] for name in CLEANING_BOUNDS},
+        int(os.environ.get("CLEANING_SPIKE_WINDOW", "10")),
+        float(os.environ.get("CLEANING_SPIKE_THRESHOLD", "4")),
+    )
+
+
+def clean_data(data: list[IotData], rules: CleaningRules) -> list[IotData]:
+    """
+    Clean the data column by column, per device in timestamp order.
+
+    Values outside of their bounds, and spikes away from the rolling mean of the
+    device's preceding values, are bad values, which are handled as set by the
+    rules' action. The data is only changed by the "drop" and "interpolate"
+    actions, which also convert the temperature and humidity to Celsius and
+    percent when they were sent in other units. "flag" only counts them, checking
+    the values as they were sent, which are the values that are stored.
+    """
+    if rules.action == "off" or not data:
+        return data
+    with METRICS.timer("clean"):
+        timestamps = [row.timestamp.timestamp() for row in data]
+        columns = {name: list(map(attrgetter(name), data)) for name in CLEANING_BOUNDS}
+        devices: dict[int, list[int]] = {}
+        for i, row in enumerate(data):
+            devices.setdefault(row.device_id, []).append(i)
+        for indices in devices.values():
+            indices.sort(key=timestamps.__getitem__)
+
+        updates: dict[int, dict[str, float]] = {}
+        dropped: set[int] = set()
+        counts = {"UnitConversions": 0, "OutOfRange": 0, "Spikes": 0}
+        for indices in devices.values():
+            device_timestamps = [timestamps[i] for i in indices]
+            for name in CLEANING_BOUNDS:
+                values = [columns[name][i] for i in indices]
+                converted = values
+                if rules.action != "flag":
+                    converted = convert_units(values, *UNIT_CONVERSIONS[name])
+                if converted is not values:
+                    counts["UnitConversions"] += len(values)
+                reasons = find_bad_values(
+                    converted,
+                    rules.bounds[name],
+                    MIN_SPIKES[name],
+                    rules.spike_window,
+                    rules.spike_threshold,
+                )
+                counts["OutOfRange"] += reasons.count("range")
+                counts["Spikes"] += reasons.count("spike")
+                if rules.action == "flag":
+                    continue
+                repaired: list[float | None] = list(converted)
+                if rules.action == "interpolate":
+                    repaired = interpolate(device_timestamps, converted, reasons)
+                for i, value, original, reason in zip(
+                    indices, repaired, values, reasons
+                ):
+                    if value is None or (reason and rules.action == "drop"):
+                        dropped.add(i)
+                    elif value != original:
+                        updates.setdefault(i, {})[name] = value
+
+        cleaned = [
+            row.copy(update=updates[i]) if i in updates else row
+            for i, row in enumerate(data)
+            if i not in dropped
+        ]
+    for name, total in counts.items():
+        METRICS.add("clean", name, total)
+    METRICS.add("clean", "RowsDropped", len(dropped))
+    if counts["OutOfRange"] or counts["Spikes"]:
+        print(
+            f"Found {counts['OutOfRange']} out of range and {counts['Spikes']} spike "
+            f"value(s), action: {rules.action}"
+        )
+    return cleaned
+
+
+def convert_units(
+    values: list[float], low: float, high: float, scale: float, offset: float
+) -> list[float]:
+    """Converts the values when their median lies within [low, high]"""
+    if not low <= median(values) <= high:
+        return values
+    return [round(value * scale + offset, 2) for value in values]
+
+
+def find_bad_values(
+    values: list[float],
+    bounds: tuple[float, float],
+    min_spike: float,
+    window_size: int,
+    threshold: float,
+) -> list[str | None]:
+    """
+    Returns why each of a device's values is bad ("range" or "spike"), or None.
+
+    A value is a spike when it's more than threshold standard deviations (and
+    min_spike) away from the mean of the preceding window_size values, once at
+    least MIN_SPIKE_WINDOW values precede it. The window holds the repaired
+    series, in which bad values are replaced by the median of the values in
+    range (out of range values) or by the window's mean (spikes), so they don't
+    skew the following windows. Runs of more than MAX_SPIKE_RUN spikes are a
+    level shift instead, after which the window restarts from the new level.
+    """
+    low, high = bounds
+    # NaN values fail the bounds check as well
+    reasons: list[str | None] = [
+        None if low <= value <= high else "range" for value in values
+    ]
+    in_range = [value for value, reason in zip(values, reasons) if reason is None]
+    if not in_range:
+        return reasons
+    fill = median(in_range)
+
+    # The window's sum and sum of squares are updated as values enter and leave it
+    window: deque[float] = deque()
+    total = squares = 0.0
+
+    def add(value: float) -> None:
+        nonlocal total, squares
+        if len(window) == window_size:
+            removed = window.popleft()
+            total -= removed
+            squares -= removed * removed
+        window.append(value)
+        total += value
+        squares += value * value
+
+    run: list[int] = []
+    for k, (value, reason) in enumerate(zip(values, reasons)):
+        if reason is not None:
+            add(fill)
+            continue
+        if len(window) >= MIN_SPIKE_WINDOW:
+            mean = total / len(window)
+            deviation = math.sqrt(max(0.0, squares / len(window) - mean * mean))
+            if abs(value - mean) > max(min_spike, threshold * deviation):
+                run.append(k)
+                if len(run) <= MAX_SPIKE_RUN:
+                    add(mean)
+                    continue
+                # A level shift, so the window restarts from the run's values
+                window.clear()
+                total = squares = 0.0
+                for j in run:
+                    add(values[j])
+                run = []
+                continue
+        for j in run:
+            reasons[j] = "spike"
+        run = []
+        add(value)
+    # A run at the end of the series is taken as spikes, as nothing follows it
+    for j in run:
+        reasons[j] = "spike"
+    return reasons
+
+
+def interpolate(
+    timestamps: list[float], values: list[float], reasons: list[str | None]
+) -> list[float | None]:
+    """
+    Replaces the bad values by linear interpolation between the good neighbours.
+
+    Bad values at the edges take the nearest good value, and are None when the
+    device has no good values at all.
+    """
+    previous: list[int | None] = []
+    last = None
+    for k, reason in enumerate(reasons):
+        previous.append(last)
+        if reason is None:
+            last = k
+    repaired: list[float | None] = list(values)
+    following = None
+    for k in range(len(values) - 1, -1, -1):
+        if reasons[k] is None:
+            following = k
+            continue
+        before = previous[k]
+        if before is not None and following is not None:
+            span = timestamps[following] - timestamps[before]
+            ratio = (timestamps[k] - timestamps[before]) / span if span else 0.0
+            repaired[k] = round(
+                values[before] + ratio * (values[following] - values[before]), 2
+            )
+        elif before is not None:
+            repaired[k] = values[before]
+        elif following is not None:
+            repaired[k] = values[following]
+        else:
+            repaired[k] = None
+    return repaired
 
 
 def get_env_value(env_var: str) -> str:
@@ -126,7 +577,7 @@ def get_env_value(env_var: str) -> str:
 def get_rds_endpoint(rds_id: str, region: str) -> str:
     """Retrieves the ARN of the RDS instance"""
     print("Retrieving RDS ARN")
-    rds_client = boto3.client("rds", region_name=region)
+    rds_client = get_client("rds", region)
     try:
         response = rds_client.describe_db_instances(DBInstanceIdentifier=rds_id)
     except ClientError as e:
@@ -143,7 +594,7 @@ def get_rds_endpoint(rds_id: str, region: str) -> str:
 def get_db_credentials(secret_manager_id: str, region: str) -> tuple[str, str]:
     """Retrieve the RDS instance username and password from the Secret Manager"""
     print("Retrieving RDS credentials")
-    secret_client = boto3.client("secretsmanager", region_name=region)
+    secret_client = get_client("secretsmanager", region)
     try:
         resp = secret_client.get_secret_value(SecretId=secret_manager_id)
     except ClientError as e:
@@ -155,32 +606,534 @@ def get_db_credentials(secret_manager_id: str, region: str) -> tuple[str, str]:
         credentials = (secrets["mysql_user"], secrets["mysql_password"])
     except (KeyError, json.JSONDecodeError) as e:
         raise LambdaError(
-            f"Failed to retrieve credentials from secret manager '{secret_manager_id}': {e}"
+            "Failed to retrieve credentials from secret manager "
+            f"'{secret_manager_id}': {e}"
         ) from e
     return credentials
 
 
+def check_device_id(value: str) -> str:
+    """Checks the format of a device ID, either a legacy ID or an external ID"""
+    if get_legacy_device_id(value) is None and not DEVICE_ID_PATTERN.match(value):
+        raise ValueError(f"invalid device id format provided: {value}")
+    return value
+
+
+def map_device_id(value: str) -> int:
+    """Maps a device ID to its surrogate ID, legacy IDs map to their number"""
+    legacy_device_id = get_legacy_device_id(value)
+    if legacy_device_id is not None:
+        return legacy_device_id
+    if value not in DEVICE_IDS:
+        raise ValueError(f"unregistered device id provided: {value}")
+    return DEVICE_IDS[value]
+
+
+def register_device_ids(
+    external_ids: set[str],
+    host: str,
+    database: str,
+    user: str,
+    password: str,
+    table: str,
+) -> None:
+    """
+    Resolve the surrogate IDs of the external device IDs, registering new devices.
+
+    Only the IDs that aren't cached yet are looked up, in bulk. New devices are
+    inserted, with their number for legacy IDs, and then read back, so parsers
+    registering the same device at the same time agree on its surrogate ID.
+    """
+    with DEVICE_IDS_LOCK:
+        unseen = sorted(
+            external_id
+            for external_id in external_ids
+            if external_id not in DEVICE_IDS and DEVICE_ID_PATTERN.match(external_id)
+        )
+    if not unseen:
+        return
+    print(f"Resolving {len(unseen)} device ID(s)")
+    try:
+        with METRICS.timer("devices"), pymysql.connect(
+            host=host, user=user, password=password, database=database
+        ) as conn, conn.cursor() as cur:
+            device_ids = query_device_ids(cur, table, unseen)
+            new = [i for i in unseen if i not in device_ids]
+            if new:
+                cur.executemany(
+                    f"INSERT IGNORE INTO {table}_devices "
+                    "(device_id,external_id) VALUES (%s,%s)",
+                    [(get_legacy_device_id(i), i) for i in new],
+                )
+                conn.commit()
+                device_ids |= query_device_ids(cur, table, new)
+    except pymysql.err.OperationalError as e:
+        raise LambdaError(f"Failed to connect to RDS database: {e}") from e
+    METRICS.add("devices", "DevicesRegistered", len(new))
+    with DEVICE_IDS_LOCK:
+        DEVICE_IDS.update(device_ids)
+
+
+def query_device_ids(cur: Any, table: str, external_ids: list[str]) -> dict[str, int]:
+    """Returns the surrogate IDs of the registered devices among the external IDs"""
+    device_ids = {}
+    for i in range(0, len(external_ids), DEVICE_LOOKUP_BATCH_SIZE):
+        batch = external_ids[i : i + DEVICE_LOOKUP_BATCH_SIZE]
+        cur.execute(
+            f"SELECT external_id, device_id FROM {table}_devices "
+            f"WHERE external_id IN ({','.join(['%s'] * len(batch))})",
+            tuple(batch),
+        )
+        device_ids.update(dict(cur.fetchall()))
+    return device_ids
+
+
+def write_to_shards(
+    data: list[IotData],
+    hosts: list[str],
+    database: str,
+    user: str,
+    password: str,
+    table: str,
+    storage_mode: str = "rows",
+    writer_slots: int = 0,
+) -> None:
+    """
+    Write Iot data to the shards that store each device, in parallel.
+
+    Each shard is written in its own transaction, so a failure leaves the data of
+    the other shards written.
+    """
+    shard_data: dict[str, list[IotData]] = {}
+    for iot_data in data:
+        host = hosts[get_shard(iot_data.device_id, len(hosts))]
+        shard_data.setdefault(host, []).append(iot_data)
+    if len(shard_data) <= 1:
+        for host, rows in shard_data.items():
+            write_to_rds(
+                rows, host, database, user, password, table, storage_mode, writer_slots
+            )
+        return
+    with ThreadPoolExecutor(max_workers=min(len(shard_data), MAX_WORKERS)) as executor:
+        futures = [
+            executor.submit(
+                write_to_rds,
+                rows,
+                host,
+                database,
+                user,
+                password,
+                table,
+                storage_mode,
+                writer_slots,
+            )
+            for host, rows in shard_data.items()
+        ]
+        for future in futures:
+            future.result()
+
+
 def write_to_rds(
-    data: list[IotData], host: str, database: str, user: str, password: str, table: str
+    data: list[IotData],
+    host: str,
+    database: str,
+    user: str,
+    password: str,
+    table: str,
+    storage_mode: str = "rows",
+    writer_slots: int = 0,
 ):
-    """Write Iot data to the RDS instance"""
+    """
+    Write Iot data to the RDS instance, as rows or as device-hour blocks.
+
+    The data is written in a single transaction, which is retried with smaller
+    batches when it's rolled back by a lock error. With writer slots, the write
+    first waits for one of the instance's slots to be free.
+    """
     print("Connecting to RDS")
     if not data:
         print("No data to write")
         return
+    sizer = get_batch_sizer(host)
     try:
-        with pymysql.connect(
-            host=host, user=user, password=password, database=database
-        ) as conn:
-            fields_to_insert = list(IotData.__fields__.keys())
-            select_statement = (
-                f"INSERT INTO {table} ({','.join(fields_to_insert)}) "
-                f"VALUES ({','.join(['%s'] * len(fields_to_insert))});"
+        with METRICS.timer("connect"):
+            connection = pymysql.connect(
+                host=host, user=user, password=password, database=database
             )
-            print("Inserting data")
-            with conn.cursor() as cur:
-                cur.executemany(select_statement, [d.get_values() for d in data])
-                conn.commit()
-                print(f"Successfully inserted {cur.rowcount} row(s) of data")
+        with connection as conn, conn.cursor() as cur:
+            cur.execute(f"SET SESSION innodb_lock_wait_timeout = {LOCK_WAIT_TIMEOUT}")
+            with writer_slot(cur, f"{database}.{table}", writer_slots):
+                for attempt in range(1, WRITE_ATTEMPTS + 1):
+                    try:
+                        inserted_rows = write_transaction(
+                            conn, cur, data, table, storage_mode, sizer
+                        )
+                        break
+                    except pymysql.err.OperationalError as e:
+                        if e.args[0] not in LOCK_ERRORS:
+                            raise
+                        conn.rollback()
+                        sizer.back_off()
+                        METRICS.add("insert", "LockErrors", 1)
+                        error = LOCK_ERRORS[e.args[0]]
+                        if attempt == WRITE_ATTEMPTS:
+                            raise LambdaError(
+                                f"Failed to write data, after {attempt} {error}s"
+                            ) from e
+                        print(f"Retrying the write after a {error}")
+                        time.sleep(random.uniform(0, 0.1 * 2**attempt))
+            print(f"Successfully inserted {inserted_rows} row(s) of data")
     except pymysql.err.OperationalError as e:
         raise LambdaError(f"Failed to connect to RDS database: {e}") from e
+
+
+def write_transaction(
+    conn: Any,
+    cur: Any,
+    data: list[IotData],
+    table: str,
+    storage_mode: str,
+    sizer: BatchSizer,
+) -> int:
+    """Write the data and its rollups in a transaction, returning the inserted rows"""
+    fields_to_insert = list(IotData.__fields__.keys())
+    select_statement = (
+        f"INSERT INTO {table} ({','.join(fields_to_insert)}) "
+        f"VALUES ({','.join(['%s'] * len(fields_to_insert))});"
+    )
+    print("Inserting data")
+    with METRICS.timer("insert"):
+        if storage_mode == "blocks":
+            inserted_rows = write_blocks(cur, data, table)
+        else:
+            values = [d.get_values() for d in data]
+            inserted_rows = insert_batches(cur, select_statement, values, sizer)
+    METRICS.add("insert", "RowsInserted", inserted_rows)
+    with METRICS.timer("rollups"):
+        # With blocks, the hourly rollups are written with the blocks
+        update_rollups(
+            cur,
+            data,
+            table,
+            ROLLUPS[1:] if storage_mode == "blocks" else ROLLUPS,
+        )
+        update_rollup_sketches(cur, data, table, storage_mode)
+        update_latest_readings(cur, data, table)
+        bump_data_versions(cur, data, table)
+    with METRICS.timer("commit"):
+        conn.commit()
+    return inserted_rows
+
+
+def get_batch_sizer(host: str) -> BatchSizer:
+    """Returns the batch sizer of the RDS instance, creating it on first use"""
+    with BATCH_SIZERS_LOCK:
+        if host not in BATCH_SIZERS:
+            BATCH_SIZERS[host] = BatchSizer(
+                float(os.environ.get("WRITE_BATCH_TARGET_SECONDS", "0.5"))
+            )
+        return BATCH_SIZERS[host]
+
+
+def insert_batches(
+    cur: Any, statement: str, values: list[tuple[Any]], sizer: BatchSizer
+) -> int:
+    """Insert the values in batches sized by the batch sizer, returning the rows"""
+    inserted_rows = 0
+    start = 0
+    while start < len(values):
+        batch = values[start : start + sizer.size]
+        batch_start = time.perf_counter()
+        cur.executemany(statement, batch)
+        sizer.record(time.perf_counter() - batch_start)
+        inserted_rows += cur.rowcount
+        start += len(batch)
+    return inserted_rows
+
+
+@contextmanager
+def writer_slot(cur: Any, name: str, slots: int) -> Iterator[None]:
+    """
+    Holds one of the named writer slots for the duration of the context.
+
+    The slots are MySQL named locks, which cap the writers that write to the
+    instance at the same time. Waits up to WRITER_SLOT_TIMEOUT seconds for a
+    free slot. The locks are released with the connection, if the Lambda fails.
+    """
+    if slots <= 0:
+        yield
+        return
+    with METRICS.timer("admission"):
+        lock_name = acquire_writer_slot(cur, name, slots)
+    try:
+        yield
+    finally:
+        cur.execute("SELECT RELEASE_LOCK(%s)", (lock_name,))
+        cur.fetchone()
+
+
+def acquire_writer_slot(cur: Any, name: str, slots: int) -> str:
+    """
+    Takes the named lock of a free writer slot, returning the lock's name.
+
+    The name is hashed into the lock names, as MySQL limits them to 64 characters.
+    """
+    prefix = hashlib.sha1(name.encode("utf-8")).hexdigest()[:40]
+    deadline = time.monotonic() + WRITER_SLOT_TIMEOUT
+    while True:
+        for slot in random.sample(range(slots), slots):
+            lock_name = f"{prefix}.writer.{slot}"
+            cur.execute("SELECT GET_LOCK(%s, 0)", (lock_name,))
+            if cur.fetchone()[0] == 1:
+                return lock_name
+        if time.monotonic() >= deadline:
+            raise LambdaError(
+                f"No writer slot of '{name}' was free within "
+                f"{WRITER_SLOT_TIMEOUT} seconds"
+            )
+        time.sleep(random.uniform(0.05, 0.25))
+
+
+def update_rollups(
+    cur: Any,
+    data: list[IotData],
+    table: str,
+    rollups: tuple[tuple[str, int, str], ...] = ROLLUPS,
+) -> None:
+    """
+    Recompute the rollup buckets touched by the provided data.
+
+    The buckets are recomputed from their source table, instead of incremented,
+    so that the rollups stay exact when late or re-uploaded data arrives.
+    """
+    print("Updating rollups")
+    for suffix, bucket_size, source_suffix in rollups:
+        aggregates = [
+            rollup if source_suffix else raw
+            for raw, rollup in ROLLUP_AGGREGATES.values()
+        ]
+        bucket = f"timestamp DIV {bucket_size} * {bucket_size}"
+        updates = [f"{column} = VALUES({column})" for column in ROLLUP_AGGREGATES]
+        statement = (
+            f"INSERT INTO {table}_{suffix} "
+            f"(device_id,timestamp,{','.join(ROLLUP_AGGREGATES)}) "
+            f"SELECT device_id, {bucket}, {', '.join(aggregates)} "
+            f"FROM {table}{source_suffix} "
+            "WHERE device_id = %s AND timestamp >= %s AND timestamp < %s "
+            f"GROUP BY device_id, {bucket} "
+            f"ON DUPLICATE KEY UPDATE {', '.join(updates)}"
+        )
+        for device_id, (start, end) in get_bucket_ranges(data, bucket_size).items():
+            cur.execute(statement, (device_id, start, end))
+
+
+def update_rollup_sketches(
+    cur: Any, data: list[IotData], table: str, storage_mode: str = "rows"
+) -> None:
+    """
+    Recompute the quantile sketches of the rollup buckets touched by the data.
+
+    The hourly sketches are built from the stored readings of each hour, and the
+    daily sketches are merged from the hourly sketches. A daily sketch is left
+    empty when one of its hours has no sketch, such as hours ingested before the
+    sketches were introduced, so readers fall back to the raw data of the day.
+    """
+    print("Updating rollup sketches")
+    sketch_updates = ", ".join(f"{field}_sketch = %s" for field in SKETCH_FIELDS)
+    hourly_values: list[tuple[Any, ...]] = []
+    for device_id, (start, end) in get_bucket_ranges(data, 3600).items():
+        sketches: dict[int, list[QuantileSketch]] = {}
+        for timestamp, *values in get_readings(
+            cur, table, device_id, start, end, storage_mode
+        ):
+            bucket = sketches.setdefault(
+                timestamp - timestamp % 3600, [QuantileSketch() for _ in values]
+            )
+            for sketch, value in zip(bucket, values):
+                sketch.update(value)
+        hourly_values.extend(
+            (*(sketch.to_bytes() for sketch in bucket), device_id, timestamp)
+            for timestamp, bucket in sorted(sketches.items())
+        )
+    if hourly_values:
+        cur.executemany(
+            f"UPDATE {table}_hourly SET {sketch_updates} "
+            "WHERE device_id = %s AND timestamp = %s",
+            hourly_values,
+        )
+
+    daily_values = []
+    for device_id, (start, end) in get_bucket_ranges(data, 86400).items():
+        cur.execute(
+            f"SELECT timestamp, {', '.join(f'{f}_sketch' for f in SKETCH_FIELDS)} "
+            f"FROM {table}_hourly WHERE device_id = %s "
+            "AND timestamp >= %s AND timestamp < %s",
+            (device_id, start, end),
+        )
+        merged: dict[int, list[QuantileSketch] | None] = {}
+        for timestamp, *encoded in cur.fetchall():
+            day = timestamp - timestamp % 86400
+            if day not in merged:
+                merged[day] = [QuantileSketch() for _ in SKETCH_FIELDS]
+            day_sketches = merged[day]
+            if day_sketches is None:
+                continue
+            if None in encoded:
+                merged[day] = None
+                continue
+            for sketch, value in zip(day_sketches, encoded):
+                sketch.merge(QuantileSketch.from_bytes(value))
+        for day, day_sketches in sorted(merged.items()):
+            daily_encoded: list[bytes | None] = [None] * len(SKETCH_FIELDS)
+            if day_sketches is not None:
+                daily_encoded = [sketch.to_bytes() for sketch in day_sketches]
+            daily_values.append((*daily_encoded, device_id, day))
+
+    if daily_values:
+        cur.executemany(
+            f"UPDATE {table}_daily SET {sketch_updates} "
+            "WHERE device_id = %s AND timestamp = %s",
+            daily_values,
+        )
+
+
+def get_readings(
+    cur: Any, table: str, device_id: int, start: int, end: int, storage_mode: str
+) -> list[tuple[Any, ...]]:
+    """Returns the timestamp and sketched values of a device's stored readings"""
+    if storage_mode == "blocks":
+        cur.execute(
+            f"SELECT timestamp, data FROM {table}_blocks WHERE device_id = %s "
+            "AND timestamp >= %s AND timestamp < %s",
+            (device_id, start, end),
+        )
+        return [
+            (row[1], row[2], row[3])
+            for block_start, encoded in cur.fetchall()
+            for row in decode_block(device_id, block_start, encoded)
+        ]
+    cur.execute(
+        f"SELECT timestamp, {', '.join(SKETCH_FIELDS)} FROM {table} "
+        "WHERE device_id = %s AND timestamp >= %s AND timestamp < %s",
+        (device_id, start, end),
+    )
+    return list(cur.fetchall())
+
+
+def get_bucket_ranges(
+    data: list[IotData], bucket_size: int
+) -> dict[int, tuple[int, int]]:
+    """Returns the bucket aligned timestamp range covered by each device"""
+    ranges: dict[int, tuple[int, int]] = {}
+    for values in (d.get_values() for d in data):
+        device_id, timestamp = values[0], values[1]
+        start = timestamp - timestamp % bucket_size
+        end = start + bucket_size
+        if device_id in ranges:
+            start = min(start, ranges[device_id][0])
+            end = max(end, ranges[device_id][1])
+        ranges[device_id] = (start, end)
+    return ranges
+
+
+def update_latest_readings(cur: Any, data: list[IotData], table: str) -> None:
+    """Upsert the latest reading of each device, unless a newer one is stored"""
+    latest: dict[int, tuple[Any, ...]] = {}
+    for values in (d.get_values() for d in data):
+        device_id, timestamp = values[0], values[1]
+        if device_id not in latest or timestamp > latest[device_id][1]:
+            latest[device_id] = values
+    fields = list(IotData.__fields__.keys())
+    # The timestamp is updated last, as the other columns compare against it
+    updated_fields = [f for f in fields if f not in ("device_id", "timestamp")]
+    updates = [
+        f"{field} = IF(VALUES(timestamp) > timestamp, VALUES({field}), {field})"
+        for field in updated_fields + ["timestamp"]
+    ]
+    cur.execute(
+        f"INSERT INTO {table}_latest ({','.join(fields)}) VALUES "
+        + ",".join([f"({','.join(['%s'] * len(fields))})"] * len(latest))
+        + f" ON DUPLICATE KEY UPDATE {', '.join(updates)}",
+        tuple(v for device_id in sorted(latest) for v in latest[device_id]),
+    )
+
+
+def bump_data_versions(cur: Any, data: list[IotData], table: str) -> None:
+    """Bump the data version of each written device, as part of the transaction"""
+    device_ids = sorted({d.device_id for d in data})
+    cur.execute(
+        f"INSERT INTO {table}_versions (device_id,version) "
+        f"VALUES {','.join(['(%s,1)'] * len(device_ids))} "
+        "ON DUPLICATE KEY UPDATE version = version + 1",
+        tuple(device_ids),
+    )
+
+
+def write_blocks(cur: Any, data: list[IotData], table: str) -> int:
+    """
+    Merge the data into the compressed device-hour blocks of the devices.
+
+    Touched blocks are locked, decoded and merged with the new readings, which
+    replace stored readings with the same timestamp. The hourly rollup of every
+    touched block is recomputed from the merged readings, since a block covers
+    exactly one hourly bucket. Returns the number of written readings.
+    """
+    print("Writing blocks")
+    blocks: dict[tuple[int, int], dict[int, tuple[Any, ...]]] = {}
+    for values in (d.get_values() for d in data):
+        device_id, timestamp = values[0], values[1]
+        block = blocks.setdefault((device_id, timestamp - timestamp % BLOCK_SIZE), {})
+        block[timestamp] = values
+
+    for device_id in sorted({device_id for device_id, _ in blocks}):
+        starts = sorted(
+            start for block_device, start in blocks if block_device == device_id
+        )
+        cur.execute(
+            f"SELECT timestamp, data FROM {table}_blocks WHERE device_id = %s "
+            f"AND timestamp IN ({','.join(['%s'] * len(starts))}) FOR UPDATE",
+            (device_id, *starts),
+        )
+        for start, encoded in cur.fetchall():
+            stored = {row[1]: row for row in decode_block(device_id, start, encoded)}
+            blocks[(device_id, start)] = stored | blocks[(device_id, start)]
+
+    block_values = []
+    rollup_values = []
+    for (device_id, start), block in sorted(blocks.items()):
+        rows = [block[timestamp] for timestamp in sorted(block)]
+        block_values.append((device_id, start, len(rows), encode_block(rows)))
+        rollup_values.append((device_id, start, *get_rollup_values(rows)))
+    cur.executemany(
+        f"INSERT INTO {table}_blocks (device_id,timestamp,sample_count,data) "
+        "VALUES (%s,%s,%s,%s) ON DUPLICATE KEY UPDATE "
+        "sample_count = VALUES(sample_count), data = VALUES(data)",
+        block_values,
+    )
+    updates = [f"{column} = VALUES({column})" for column in ROLLUP_AGGREGATES]
+    cur.executemany(
+        f"INSERT INTO {table}_hourly "
+        f"(device_id,timestamp,{','.join(ROLLUP_AGGREGATES)}) "
+        f"VALUES ({','.join(['%s'] * (len(ROLLUP_AGGREGATES) + 2))}) "
+        f"ON DUPLICATE KEY UPDATE {', '.join(updates)}",
+        rollup_values,
+    )
+    return len(data)
+
+
+def get_rollup_values(rows: list[tuple[Any, ...]]) -> tuple[Any, ...]:
+    """Returns the rollup aggregates of the rows, in ROLLUP_AGGREGATES order"""
+    temperatures = [row[2] for row in rows]
+    humidities = [row[3] for row in rows]
+    return (
+        len(rows),
+        sum(temperatures),
+        min(temperatures),
+        max(temperatures),
+        sum(value * value for value in temperatures),
+        sum(humidities),
+        min(humidities),
+        max(humidities),
+        sum(value * value for value in humidities),
+        sum(1 for row in rows if row[4]),
+    )
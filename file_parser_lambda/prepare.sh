@@ -6,3 +6,6 @@ cd "$(dirname "$0")"
 
 rm -rf package
 pip install -q -t package .
+# Code shared by the Lambdas, which is imported as the top-level iot_common package
+mkdir package/iot_common
+cp ../iot_common/*.py package/iot_common/
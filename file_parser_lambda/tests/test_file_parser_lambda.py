@@ -1,23 +1,46 @@
 import json
 import os
+import subprocess
+import sys
 from datetime import datetime
+from pathlib import Path
 from unittest import mock
 
 import boto3
+import pymysql
 import pytest
 from moto import mock_rds, mock_s3, mock_secretsmanager
 
+from iot_common.blocks import decode_block, encode_block
+from iot_common.sketch import QuantileSketch
+
 from ..file_parser_lambda import (
+    BATCH_SIZERS,
+    DEVICE_IDS,
+    MIN_BATCH_SIZE,
+    BatchSizer,
+    CleaningRules,
     IotData,
     LambdaError,
+    bump_data_versions,
+    clean_data,
     filter_events,
+    find_bad_values,
+    get_bucket_ranges,
+    get_cleaning_rules,
     get_db_credentials,
     get_env_value,
     get_rds_endpoint,
     parse_s3_csv_file,
+    register_device_ids,
+    update_latest_readings,
+    update_rollup_sketches,
+    write_blocks,
     write_to_rds,
+    write_to_shards,
 )
 
+
 def create_s3_bucket_with_object(body: str) -> tuple[str, str]:
     bucket_name = "test-bucket"
     bucket_object_key = "new_object_key"
@@ -28,7 +51,6 @@ def create_s3_bucket_with_object(body: str) -> tuple[str, str]:
     return bucket_name, bucket_object_key
 
 
-
 def test_filter_events__missing_event_details() -> None:
     valid_event = {"eventSource": "aws:s3", "eventName": "ObjectCreated:Put"}
     no_event_source = {"No": "eventSource", "eventName": "ObjectCreated:Put"}
@@ -108,7 +130,7 @@ def test_parse_s3_csv_file__invalid_content() -> None:
 def test_parse_s3_csv_file__invalid_device_id() -> None:
     bucket, object_key = create_s3_bucket_with_object(
         "device_id,timestamp,temperature,humidity,hvac_status\n"
-        "device_err,2023-07-26 00:00:00,22.5,55.0,on"
+        "device#err,2023-07-26 00:00:00,22.5,55.0,on"
     )
 
     with pytest.raises(LambdaError) as e:
@@ -116,10 +138,55 @@ def test_parse_s3_csv_file__invalid_device_id() -> None:
     assert str(e.value) == (
         "Failed to parse data: 1 validation error for IotData\n"
         "device_id\n"
-        "  invalid device id format provided: device_err (type=value_error)"
+        "  invalid device id format provided: device#err (type=value_error)"
     )
 
 
+@mock_s3
+def test_parse_s3_csv_file__registered_device_ids() -> None:
+    bucket, object_key = create_s3_bucket_with_object(
+        "device_id,timestamp,temperature,humidity,hvac_status\n"
+        "sensor-a,2023-07-26 00:00:00,22.5,55.0,on\n"
+        "device_002,2023-07-26 00:00:00,23.0,52.0,off"
+    )
+
+    with pytest.raises(LambdaError) as e:
+        parse_s3_csv_file(bucket, object_key)
+    assert str(e.value) == (
+        "Failed to parse data: 1 validation error for IotData\n"
+        "device_id\n"
+        "  unregistered device id provided: sensor-a (type=value_error)"
+    )
+
+    def register_devices(external_ids: set[str]) -> None:
+        assert external_ids == {"sensor-a", "device_002"}
+        DEVICE_IDS["sensor-a"] = 1000
+
+    with mock.patch.dict(DEVICE_IDS, clear=True):
+        data = parse_s3_csv_file(bucket, object_key, register_devices)
+    assert [d.device_id for d in data] == [1000, 2]
+
+
+@mock_s3
+def test_parse_s3_csv_file__rejected_device_ids() -> None:
+    bucket, object_key = create_s3_bucket_with_object(
+        "device_id,timestamp,temperature,humidity,hvac_status\n"
+        "sensor-a,2023-07-26 00:00:00,22.5,55.0,on\n"
+        "sensor-b,2023-07-26 00:00:00,warm,52.0,off"
+    )
+    register_devices = mock.MagicMock(name="register_devices")
+
+    # The devices of a rejected file aren't registered
+    with pytest.raises(LambdaError) as e:
+        parse_s3_csv_file(bucket, object_key, register_devices)
+    assert str(e.value) == (
+        "Failed to parse data: 1 validation error for IotData\n"
+        "temperature\n"
+        "  value is not a valid float (type=type_error.float)"
+    )
+    register_devices.assert_not_called()
+
+
 @mock_s3
 def test_parse_s3_csv_file__invalid_timestamp() -> None:
     bucket, object_key = create_s3_bucket_with_object(
@@ -253,6 +320,101 @@ def test_get_env_value() -> None:
     assert get_env_value(env_key) == env_val
 
 
+def test_find_bad_values() -> None:
+    def find(values: list[float]) -> dict[int, str]:
+        reasons = find_bad_values(values, (-40.0, 85.0), 2.0, 10, 4.0)
+        return {k: reason for k, reason in enumerate(reasons) if reason}
+
+    flat = [22.0, 22.1, 22.2, 22.1, 22.0, 22.1, 22.2, 22.1, 22.0, 22.1, 22.2, 22.1]
+
+    values = [*flat[:6], 35.0, *flat[6:9], 200.0, float("nan"), *flat[9:]]
+    assert find(values) == {6: "spike", 10: "range", 11: "range"}
+
+    # A level shift, without a spike before it, isn't a spike
+    assert find([*flat, 28.0, 28.1, 28.2, 28.1, 28.0, 28.1]) == {}
+
+    # Runs of up to MAX_SPIKE_RUN spikes are spikes, which don't skew the window
+    assert find([*flat, 35.0, 35.1, *flat]) == {12: "spike", 13: "spike"}
+    assert find([*flat, 35.0, 35.1, 35.2, *flat]) == {
+        12: "spike",
+        13: "spike",
+        14: "spike",
+    }
+
+    # The values of the first window are checked as well
+    assert find([22.0, 22.1, 35.0, *flat]) == {2: "spike"}
+
+
+def test_clean_data(capsys: pytest.CaptureFixture[str]) -> None:
+    def get_data(
+        device_id: str, values: list[tuple[int, float, float]]
+    ) -> list[IotData]:
+        return [
+            IotData(
+                device_id=device_id,
+                timestamp=datetime.fromtimestamp(1690326000 + offset),
+                temperature=temperature,
+                humidity=humidity,
+                hvac_status=False,
+            )
+            for offset, temperature, humidity in values
+        ]
+
+    # Device 1 sends Kelvin and a humidity fraction, device 2 an impossible value
+    data = get_data(
+        "device_001", [(0, 293.15, 0.5), (10, 293.25, 0.51), (20, 293.35, 0.52)]
+    )
+    data += get_data("device_002", [(20, 21.0, 50.0), (0, 20.0, 50.0)])
+    data += get_data("device_002", [(10, 120.0, 50.0)])
+    rules = CleaningRules(
+        "interpolate", {"temperature": (-40, 85), "humidity": (0, 100)}
+    )
+
+    cleaned = clean_data(data, rules)
+    assert [(d.device_id, d.temperature, d.humidity) for d in cleaned] == [
+        (1, 20.0, 50.0),
+        (1, 20.1, 51.0),
+        (1, 20.2, 52.0),
+        (2, 21.0, 50.0),
+        (2, 20.0, 50.0),
+        (2, 20.5, 50.0),
+    ]
+
+    cleaned = clean_data(data, rules._replace(action="drop"))
+    assert [(d.device_id, d.temperature) for d in cleaned] == [
+        (1, 20.0),
+        (1, 20.1),
+        (1, 20.2),
+        (2, 21.0),
+        (2, 20.0),
+    ]
+
+    # Flagging only counts, checking the values as they are stored, in Kelvin
+    capsys.readouterr()
+    cleaned = clean_data(data, rules._replace(action="flag"))
+    assert cleaned == data
+    assert "Found 4 out of range and 0 spike value(s)" in capsys.readouterr().out
+
+    assert clean_data(data, rules._replace(action="off")) is data
+
+
+def test_get_cleaning_rules() -> None:
+    get_cleaning_rules.cache_clear()
+    with mock.patch.dict(
+        os.environ,
+        {"CLEANING_ACTION": "drop", "CLEANING_BOUNDS": '{"temperature": [-20, 60]}'},
+    ):
+        assert get_cleaning_rules() == CleaningRules(
+            "drop", {"temperature": (-20.0, 60.0), "humidity": (0.0, 100.0)}
+        )
+    get_cleaning_rules.cache_clear()
+    with mock.patch.dict(os.environ, {"CLEANING_ACTION": "fix"}):
+        with pytest.raises(LambdaError) as e:
+            get_cleaning_rules()
+        assert str(e.value) == "Invalid cleaning action: fix"
+    get_cleaning_rules.cache_clear()
+
+
 @mock_rds
 def test_get_rds_endpoint__missing_rds_instance() -> None:
     region = "us-west-1"
@@ -391,10 +553,12 @@ def test_write_to_rds() -> None:
         "file_parser_lambda.file_parser_lambda.pymysql.connect"
     ) as mock_connect:
         mock_executemany = mock.MagicMock(name="executemany")
+        mock_execute = mock.MagicMock(name="execute")
 
         mock_cur = mock.MagicMock(name="cursor")
         mock_cur.rowcount = 1
         mock_cur.executemany = mock_executemany
+        mock_cur.execute = mock_execute
 
         mock_conn = mock.MagicMock(name="connection")
         mock_conn.cursor.return_value.__enter__.return_value = mock_cur
@@ -403,7 +567,7 @@ def test_write_to_rds() -> None:
 
         iot_data = IotData(
             device_id="device_001",
-            timestamp=datetime.now(),
+            timestamp=datetime.fromtimestamp(1690326000),
             temperature=20.1,
             humidity=50.5,
             hvac_status=True,
@@ -429,4 +593,467 @@ def test_write_to_rds() -> None:
             [iot_data.get_values()],
         )
 
+        assert mock_execute.call_args_list == [
+            mock.call("SET SESSION innodb_lock_wait_timeout = 5"),
+            mock.call(
+                "INSERT INTO table_hourly (device_id,timestamp,sample_count,"
+                "temperature_sum,temperature_min,temperature_max,temperature_sum_sq,"
+                "humidity_sum,humidity_min,humidity_max,humidity_sum_sq,"
+                "hvac_on_count) SELECT device_id, timestamp DIV 3600 * 3600, "
+                "COUNT(*), SUM(temperature), MIN(temperature), MAX(temperature), "
+                "SUM(temperature * temperature), SUM(humidity), MIN(humidity), "
+                "MAX(humidity), SUM(humidity * humidity), SUM(hvac_status) "
+                "FROM table WHERE device_id = %s AND timestamp >= %s "
+                "AND timestamp < %s GROUP BY device_id, timestamp DIV 3600 * 3600 "
+                "ON DUPLICATE KEY UPDATE sample_count = VALUES(sample_count), "
+                "temperature_sum = VALUES(temperature_sum), "
+                "temperature_min = VALUES(temperature_min), "
+                "temperature_max = VALUES(temperature_max), "
+                "temperature_sum_sq = VALUES(temperature_sum_sq), "
+                "humidity_sum = VALUES(humidity_sum), "
+                "humidity_min = VALUES(humidity_min), "
+                "humidity_max = VALUES(humidity_max), "
+                "humidity_sum_sq = VALUES(humidity_sum_sq), "
+                "hvac_on_count = VALUES(hvac_on_count)",
+                (1, 1690326000, 1690329600),
+            ),
+            mock.call(
+                "INSERT INTO table_daily (device_id,timestamp,sample_count,"
+                "temperature_sum,temperature_min,temperature_max,temperature_sum_sq,"
+                "humidity_sum,humidity_min,humidity_max,humidity_sum_sq,"
+                "hvac_on_count) SELECT device_id, timestamp DIV 86400 * 86400, "
+                "SUM(sample_count), SUM(temperature_sum), MIN(temperature_min), "
+                "MAX(temperature_max), SUM(temperature_sum_sq), SUM(humidity_sum), "
+                "MIN(humidity_min), MAX(humidity_max), SUM(humidity_sum_sq), "
+                "SUM(hvac_on_count) FROM table_hourly WHERE device_id = %s "
+                "AND timestamp >= %s AND timestamp < %s "
+                "GROUP BY device_id, timestamp DIV 86400 * 86400 "
+                "ON DUPLICATE KEY UPDATE sample_count = VALUES(sample_count), "
+                "temperature_sum = VALUES(temperature_sum), "
+                "temperature_min = VALUES(temperature_min), "
+                "temperature_max = VALUES(temperature_max), "
+                "temperature_sum_sq = VALUES(temperature_sum_sq), "
+                "humidity_sum = VALUES(humidity_sum), "
+                "humidity_min = VALUES(humidity_min), "
+                "humidity_max = VALUES(humidity_max), "
+                "humidity_sum_sq = VALUES(humidity_sum_sq), "
+                "hvac_on_count = VALUES(hvac_on_count)",
+                (1, 1690243200, 1690329600),
+            ),
+            mock.call(
+                "SELECT timestamp, temperature, humidity FROM table "
+                "WHERE device_id = %s AND timestamp >= %s AND timestamp < %s",
+                (1, 1690326000, 1690329600),
+            ),
+            mock.call(
+                "SELECT timestamp, temperature_sketch, humidity_sketch "
+                "FROM table_hourly WHERE device_id = %s "
+                "AND timestamp >= %s AND timestamp < %s",
+                (1, 1690243200, 1690329600),
+            ),
+            mock.call(
+                "INSERT INTO table_latest "
+                "(device_id,timestamp,temperature,humidity,hvac_status) "
+                "VALUES (%s,%s,%s,%s,%s) ON DUPLICATE KEY UPDATE "
+                "temperature = IF(VALUES(timestamp) > timestamp, "
+                "VALUES(temperature), temperature), "
+                "humidity = IF(VALUES(timestamp) > timestamp, "
+                "VALUES(humidity), humidity), "
+                "hvac_status = IF(VALUES(timestamp) > timestamp, "
+                "VALUES(hvac_status), hvac_status), "
+                "timestamp = IF(VALUES(timestamp) > timestamp, "
+                "VALUES(timestamp), timestamp)",
+                iot_data.get_values(),
+            ),
+            mock.call(
+                "INSERT INTO table_versions (device_id,version) VALUES (%s,1) "
+                "ON DUPLICATE KEY UPDATE version = version + 1",
+                (1,),
+            ),
+        ]
+        assert mock_conn.commit.call_count == 1
+
+
+def test_batch_sizer() -> None:
+    sizer = BatchSizer(target_latency=0.5, size=1000)
+    sizer.record(0.1)
+    assert sizer.size == 1000 + MIN_BATCH_SIZE
+    sizer.record(1.0)
+    assert sizer.size == 550
+    sizer.back_off()
+    assert sizer.size == 275
+    for _ in range(3):
+        sizer.back_off()
+    assert sizer.size == MIN_BATCH_SIZE
+
+
+def test_write_to_rds__lock_error_retry() -> None:
+    with mock.patch(
+        "file_parser_lambda.file_parser_lambda.pymysql.connect"
+    ) as mock_connect, mock.patch("file_parser_lambda.file_parser_lambda.time.sleep"):
+        mock_cur = mock.MagicMock(name="cursor")
+        mock_cur.rowcount = 100
+        mock_cur.executemany.side_effect = [
+            pymysql.err.OperationalError(1213, "Deadlock found"),
+            None,
+            None,
+            None,
+        ]
+        mock_conn = mock.MagicMock(name="connection")
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cur
+        mock_connect.return_value.__enter__.return_value = mock_conn
+
+        data = [
+            IotData(
+                device_id="device_001",
+                timestamp=datetime.fromtimestamp(1690326000 + i),
+                temperature=20.1,
+                humidity=50.5,
+                hvac_status=True,
+            )
+            for i in range(300)
+        ]
+        BATCH_SIZERS["retry_host"] = BatchSizer(target_latency=60, size=200)
+        write_to_rds(data, "retry_host", "database", "user", "password", "table")
+
+        assert mock_conn.rollback.call_count == 1
+        assert mock_conn.commit.call_count == 1
+        # The retry is written in batches of half the size, which grow again
+        batch_sizes = [len(c.args[1]) for c in mock_cur.executemany.call_args_list]
+        assert batch_sizes == [200, 100, 200]
+
+
+def test_write_to_rds__writer_slots() -> None:
+    with mock.patch(
+        "file_parser_lambda.file_parser_lambda.pymysql.connect"
+    ) as mock_connect:
+        mock_cur = mock.MagicMock(name="cursor")
+        mock_cur.rowcount = 1
+        mock_cur.fetchone.side_effect = [(0,), (1,), (1,)]
+        mock_cur.fetchall.return_value = []
+        mock_conn = mock.MagicMock(name="connection")
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cur
+        mock_connect.return_value.__enter__.return_value = mock_conn
+
+        iot_data = IotData(
+            device_id="device_001",
+            timestamp=datetime.fromtimestamp(1690326000),
+            temperature=20.1,
+            humidity=50.5,
+            hvac_status=True,
+        )
+        # The names would exceed the 64 character limit of MySQL lock names
+        write_to_rds(
+            [iot_data], "host", "d" * 64, "user", "password", "t" * 50, writer_slots=2
+        )
+
+        lock_calls = [
+            c.args for c in mock_cur.execute.call_args_list if "_LOCK" in c.args[0]
+        ]
+        assert [statement for statement, _ in lock_calls] == [
+            "SELECT GET_LOCK(%s, 0)",
+            "SELECT GET_LOCK(%s, 0)",
+            "SELECT RELEASE_LOCK(%s)",
+        ]
+        # The slot that was taken is released
+        assert lock_calls[1][1] == lock_calls[2][1]
+        assert lock_calls[0][1] != lock_calls[1][1]
+        assert all(len(lock_name) <= 64 for _, (lock_name,) in lock_calls)
+        assert mock_conn.commit.call_count == 1
+
+
+def test_write_to_rds__writer_slots_busy() -> None:
+    with mock.patch(
+        "file_parser_lambda.file_parser_lambda.pymysql.connect"
+    ) as mock_connect, mock.patch(
+        "file_parser_lambda.file_parser_lambda.time.sleep"
+    ), mock.patch(
+        "file_parser_lambda.file_parser_lambda.time.monotonic",
+        side_effect=[0, 5, 11],
+    ):
+        mock_cur = mock.MagicMock(name="cursor")
+        mock_cur.fetchone.return_value = (0,)
+        mock_conn = mock.MagicMock(name="connection")
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cur
+        mock_connect.return_value.__enter__.return_value = mock_conn
+
+        iot_data = IotData(
+            device_id="device_001",
+            timestamp=datetime.fromtimestamp(1690326000),
+            temperature=20.1,
+            humidity=50.5,
+            hvac_status=True,
+        )
+        with pytest.raises(LambdaError) as e:
+            write_to_rds(
+                [iot_data],
+                "host",
+                "database",
+                "user",
+                "password",
+                "table",
+                writer_slots=1,
+            )
+        assert str(e.value) == (
+            "No writer slot of 'database.table' was free within 10 seconds"
+        )
+        mock_cur.executemany.assert_not_called()
+
+
+def test_bump_data_versions() -> None:
+    mock_cur = mock.MagicMock(name="cursor")
+    data = [
+        IotData(
+            device_id=device_id,
+            timestamp=datetime.now(),
+            temperature=20.1,
+            humidity=50.5,
+            hvac_status=True,
+        )
+        for device_id in ["device_002", "device_001", "device_002"]
+    ]
+
+    bump_data_versions(mock_cur, data, "table")
+    assert mock_cur.execute.call_args.args == (
+        (
+            "INSERT INTO table_versions (device_id,version) VALUES (%s,1),(%s,1) "
+            "ON DUPLICATE KEY UPDATE version = version + 1"
+        ),
+        (1, 2),
+    )
+
+
+def test_update_latest_readings() -> None:
+    mock_cur = mock.MagicMock(name="cursor")
+    data = [
+        IotData(
+            device_id=device_id,
+            timestamp=datetime.fromtimestamp(timestamp),
+            temperature=temperature,
+            humidity=50.5,
+            hvac_status=True,
+        )
+        for device_id, timestamp, temperature in [
+            ("device_002", 1690326000, 20.1),
+            ("device_001", 1690322400, 20.2),
+            ("device_002", 1690329600, 20.3),
+            ("device_002", 1690322400, 20.4),
+        ]
+    ]
+
+    update_latest_readings(mock_cur, data, "table")
+    statement, values = mock_cur.execute.call_args.args
+    assert statement.startswith(
+        "INSERT INTO table_latest "
+        "(device_id,timestamp,temperature,humidity,hvac_status) "
+        "VALUES (%s,%s,%s,%s,%s),(%s,%s,%s,%s,%s) ON DUPLICATE KEY UPDATE "
+    )
+    assert values == (
+        1,
+        1690322400,
+        20.2,
+        50.5,
+        True,
+        2,
+        1690329600,
+        20.3,
+        50.5,
+        True,
+    )
+
+
+def test_get_bucket_ranges() -> None:
+    data = [
+        IotData(
+            device_id=device_id,
+            timestamp=datetime.fromtimestamp(timestamp),
+            temperature=20.1,
+            humidity=50.5,
+            hvac_status=True,
+        )
+        for device_id, timestamp in [
+            ("device_001", 1690326000),
+            ("device_002", 1690329599),
+            ("device_001", 1690336800),
+            ("device_001", 1690322400),
+        ]
+    ]
+
+    assert get_bucket_ranges(data, 3600) == {
+        1: (1690322400, 1690340400),
+        2: (1690326000, 1690329600),
+    }
+    assert get_bucket_ranges(data, 86400) == {
+        1: (1690243200, 1690416000),
+        2: (1690243200, 1690329600),
+    }
+
+
+def test_write_blocks__merges_late_data() -> None:
+    mock_cur = mock.MagicMock(name="cursor")
+    stored = [(1, 1690326000, 20.0, 50.0, False), (1, 1690326060, 20.5, 50.0, True)]
+    mock_cur.fetchall.return_value = [(1690326000, encode_block(stored))]
+    data = [
+        IotData(
+            device_id="device_001",
+            timestamp=datetime.fromtimestamp(timestamp),
+            temperature=temperature,
+            humidity=50.0,
+            hvac_status=True,
+        )
+        for timestamp, temperature in [(1690326030, 21.0), (1690326060, 22.0)]
+    ]
+
+    assert write_blocks(mock_cur, data, "table") == 2
+    assert mock_cur.execute.call_args.args == (
+        (
+            "SELECT timestamp, data FROM table_blocks WHERE device_id = %s "
+            "AND timestamp IN (%s) FOR UPDATE"
+        ),
+        (1, 1690326000),
+    )
+    (blocks_call, rollups_call) = mock_cur.executemany.call_args_list
+    ((device_id, timestamp, sample_count, block),) = blocks_call.args[1]
+    assert (device_id, timestamp, sample_count) == (1, 1690326000, 3)
+    assert decode_block(1, 1690326000, block) == [
+        (1, 1690326000, 20.0, 50.0, False),
+        (1, 1690326030, 21.0, 50.0, True),
+        (1, 1690326060, 22.0, 50.0, True),
+    ]
+    assert rollups_call.args[1] == [
+        (1, 1690326000, 3, 63.0, 20.0, 22.0, 1325.0, 150.0, 50.0, 50.0, 7500.0, 2)
+    ]
+
+
+def test_update_rollup_sketches() -> None:
+    mock_cur = mock.MagicMock(name="cursor")
+    hourly = QuantileSketch()
+    hourly.update(20.0)
+    mock_cur.fetchall.side_effect = [
+        [(1690326000, 20.5, 50.0), (1690326060, 21.5, 51.0)],
+        [
+            (1690326000, hourly.to_bytes(), hourly.to_bytes()),
+            (1690322400, hourly.to_bytes(), hourly.to_bytes()),
+            (1690243200 + 86400 * 2, None, None),
+        ],
+    ]
+    data = [
+        IotData(
+            device_id="device_001",
+            timestamp=datetime.fromtimestamp(timestamp),
+            temperature=20.5,
+            humidity=50.0,
+            hvac_status=True,
+        )
+        for timestamp in [1690326000, 1690416000]
+    ]
+
+    update_rollup_sketches(mock_cur, data, "table")
+    hourly_call, daily_call = mock_cur.executemany.call_args_list
+    assert hourly_call.args[0] == (
+        "UPDATE table_hourly SET temperature_sketch = %s, humidity_sketch = %s "
+        "WHERE device_id = %s AND timestamp = %s"
+    )
+    ((temperature, humidity, device_id, timestamp),) = hourly_call.args[1]
+    assert (device_id, timestamp) == (1, 1690326000)
+    assert QuantileSketch.from_bytes(temperature).levels == [[20.5, 21.5]]
+    assert QuantileSketch.from_bytes(humidity).levels == [[50.0, 51.0]]
+
+    # The second day has an hour without a sketch, so its sketches are cleared
+    first_day, second_day = daily_call.args[1]
+    assert QuantileSketch.from_bytes(first_day[0]).count == 2
+    assert first_day[2:] == (1, 1690243200)
+    assert second_day == (None, None, 1, 1690416000)
+
+
+def test_write_to_shards() -> None:
+    data = [
+        IotData(
+            device_id=f"device_00{device_id}",
+            timestamp=datetime.fromtimestamp(1690326000),
+            temperature=20.1,
+            humidity=50.5,
+            hvac_status=True,
+        )
+        for device_id in [1, 2, 3, 5]
+    ]
+    with mock.patch(
+        "file_parser_lambda.file_parser_lambda.write_to_rds"
+    ) as mock_write_to_rds:
+        write_to_shards(
+            data, ["host-0", "host-1", "host-2"], "database", "user", "password", "t"
+        )
+
+    written = {
+        c.args[1]: [d.device_id for d in c.args[0]]
+        for c in mock_write_to_rds.call_args_list
+    }
+    assert written == {"host-0": [3], "host-1": [1], "host-2": [2, 5]}
+
+
+def test_register_device_ids() -> None:
+    with mock.patch("pymysql.connect") as mock_connect, mock.patch.dict(
+        DEVICE_IDS, {"sensor-a": 1000}, clear=True
+    ):
+        mock_cur = mock.MagicMock(name="cursor")
+        # The lookup finds sensor-b, and the read back finds the registered devices
+        mock_cur.fetchall.side_effect = [
+            [("sensor-b", 1001)],
+            [("device_007", 7), ("sensor-c", 1002)],
+        ]
+        mock_conn = mock.MagicMock(name="connection")
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cur
+        mock_connect.return_value.__enter__.return_value = mock_conn
+
+        external_ids = {"sensor-a", "sensor-b", "sensor-c", "device_007", "bad id"}
+        register_device_ids(external_ids, "host", "database", "user", "password", "t")
+        assert DEVICE_IDS == {
+            "sensor-a": 1000,
+            "sensor-b": 1001,
+            "sensor-c": 1002,
+            "device_007": 7,
+        }
+        assert mock_cur.execute.call_args_list == [
+            mock.call(
+                "SELECT external_id, device_id FROM t_devices "
+                "WHERE external_id IN (%s,%s,%s)",
+                ("device_007", "sensor-b", "sensor-c"),
+            ),
+            mock.call(
+                "SELECT external_id, device_id FROM t_devices "
+                "WHERE external_id IN (%s,%s)",
+                ("device_007", "sensor-c"),
+            ),
+        ]
+        mock_cur.executemany.assert_called_once_with(
+            "INSERT IGNORE INTO t_devices (device_id,external_id) VALUES (%s,%s)",
+            [(7, "device_007"), (None, "sensor-c")],
+        )
+        mock_conn.commit.assert_called_once()
+
+        # Every device is cached now, so the database isn't queried again
+        mock_connect.reset_mock()
+        register_device_ids(external_ids, "host", "database", "user", "password", "t")
+        mock_connect.assert_not_called()
+
+
+def test_import_is_lazy() -> None:
+    # Modules loaded when importing the handler module, on every cold start
+    module = "file_parser_lambda.file_parser_lambda"
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            (
+                f"import sys, {module}; "
+                "print(sorted({'boto3', 'aws_lambda_powertools'} & set(sys.modules)))"
+            ),
+        ],
+        cwd=Path(__file__).parents[2],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
 
+    # Heavy modules are only imported on the code paths that need them
+    assert result.stdout.strip() == "[]"
@@ -14,11 +14,15 @@ resource "aws_lambda_function" "file_parser_lambda" {
   layers           = ["arn:aws:lambda:us-west-1:017000801446:layer:AWSLambdaPowertoolsPythonV2:43"]
   environment {
     variables = {
-      SECRET_MANAGER_ID = var.SECRET_MANAGER_ID
-      REGION            = var.REGION
-      MYSQL_ID          = var.DATA_MYSQL_ID
-      MYSQL_DATABASE    = var.DATA_MYSQL_DATABASE
-      MYSQL_TABLE       = var.DATA_MYSQL_TABLE
+      SECRET_MANAGER_ID   = var.SECRET_MANAGER_ID
+      REGION              = var.REGION
+      MYSQL_ID            = join(",", concat([var.DATA_MYSQL_ID], var.DATA_MYSQL_SHARD_IDS))
+      MYSQL_DATABASE      = var.DATA_MYSQL_DATABASE
+      MYSQL_TABLE         = var.DATA_MYSQL_TABLE
+      STORAGE_MODE        = var.DATA_STORAGE_MODE
+      PROFILE_SAMPLE_RATE = var.LAMBDA_PROFILE_SAMPLE_RATE
+      WRITER_SLOTS        = var.DATA_WRITER_SLOTS
+      CLEANING_ACTION     = var.DATA_CLEANING_ACTION
     }
   }
 }
@@ -15,6 +15,19 @@ resource "aws_db_instance" "data_mysql" {
   vpc_security_group_ids = [aws_security_group.data_mysql_sec_group.id]
   skip_final_snapshot    = true
   publicly_accessible    = true
+  # Read replicas require automated backups on their source instance
+  backup_retention_period = var.DATA_MYSQL_READ_REPLICAS > 0 ? 1 : 0
+}
+
+resource "aws_db_instance" "data_mysql_replica" {
+  count                  = var.DATA_MYSQL_READ_REPLICAS
+  identifier             = "${var.DATA_MYSQL_ID}-replica-${count.index + 1}"
+  replicate_source_db    = aws_db_instance.data_mysql.identifier
+  instance_class         = "db.t2.micro"
+  parameter_group_name   = "default.mysql5.7"
+  vpc_security_group_ids = [aws_security_group.data_mysql_sec_group.id]
+  skip_final_snapshot    = true
+  publicly_accessible    = true
 }
 
 
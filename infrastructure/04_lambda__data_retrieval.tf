@@ -10,15 +10,20 @@ resource "aws_lambda_function" "data_retrieval_lambda" {
   role             = aws_iam_role.data_retrieval_lambda_role.arn
   handler          = "data_retrieval_lambda.handler"
   runtime          = "python3.10"
-  timeout          = 15
+  # Exports run asynchronously in the same function, API Gateway still times out requests after 30s
+  timeout          = 900
   layers           = ["arn:aws:lambda:us-west-1:017000801446:layer:AWSLambdaPowertoolsPythonV2:43"]
   environment {
     variables = {
-      SECRET_MANAGER_ID = var.SECRET_MANAGER_ID
-      REGION            = var.REGION
-      MYSQL_ID          = var.DATA_MYSQL_ID
-      MYSQL_DATABASE    = var.DATA_MYSQL_DATABASE
-      MYSQL_TABLE       = var.DATA_MYSQL_TABLE
+      SECRET_MANAGER_ID       = var.SECRET_MANAGER_ID
+      REGION                  = var.REGION
+      MYSQL_ID                = join(",", concat([var.DATA_MYSQL_ID], var.DATA_MYSQL_SHARD_IDS))
+      MYSQL_DATABASE          = var.DATA_MYSQL_DATABASE
+      MYSQL_TABLE             = var.DATA_MYSQL_TABLE
+      STORAGE_MODE            = var.DATA_STORAGE_MODE
+      MAX_REPLICA_LAG_SECONDS = var.DATA_MAX_REPLICA_LAG_SECONDS
+      PROFILE_SAMPLE_RATE     = var.LAMBDA_PROFILE_SAMPLE_RATE
+      EXPORT_BUCKET           = aws_s3_bucket.export_bucket.id
     }
   }
 }
@@ -67,7 +72,8 @@ resource "aws_iam_policy" "data_retrieval_lambda_policy" {
       {
         Effect = "Allow",
         Action = [
-          "rds:DescribeDBInstances"
+          "rds:DescribeDBInstances",
+          "cloudwatch:GetMetricData"
         ],
         Resource = "*"
       },
@@ -77,6 +83,30 @@ resource "aws_iam_policy" "data_retrieval_lambda_policy" {
           "secretsmanager:GetSecretValue"
         ],
         Resource = data.aws_secretsmanager_secret.acme_secrets.arn
+      },
+      {
+        Effect = "Allow",
+        Action = [
+          "s3:PutObject",
+          "s3:GetObject",
+          "s3:AbortMultipartUpload"
+        ],
+        Resource = "${aws_s3_bucket.export_bucket.arn}/*"
+      },
+      {
+        # Without it, S3 answers AccessDenied instead of NoSuchKey for unknown jobs
+        Effect = "Allow",
+        Action = [
+          "s3:ListBucket"
+        ],
+        Resource = aws_s3_bucket.export_bucket.arn
+      },
+      {
+        Effect = "Allow",
+        Action = [
+          "lambda:InvokeFunction"
+        ],
+        Resource = aws_lambda_function.data_retrieval_lambda.arn
       }
     ]
   })
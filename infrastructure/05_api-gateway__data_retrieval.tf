@@ -48,6 +48,36 @@ resource "aws_apigatewayv2_route" "data_retrieval_api_get_data_route" {
   target    = "integrations/${aws_apigatewayv2_integration.data_retrieval_api_integration.id}"
 }
 
+resource "aws_apigatewayv2_route" "data_retrieval_api_post_data_batch_route" {
+  api_id    = aws_apigatewayv2_api.data_retrieval_api.id
+  route_key = "POST /data/batch"
+  target    = "integrations/${aws_apigatewayv2_integration.data_retrieval_api_integration.id}"
+}
+
+resource "aws_apigatewayv2_route" "data_retrieval_api_get_data_latest_route" {
+  api_id    = aws_apigatewayv2_api.data_retrieval_api.id
+  route_key = "GET /data/latest"
+  target    = "integrations/${aws_apigatewayv2_integration.data_retrieval_api_integration.id}"
+}
+
+resource "aws_apigatewayv2_route" "data_retrieval_api_get_data_statistics_route" {
+  api_id    = aws_apigatewayv2_api.data_retrieval_api.id
+  route_key = "GET /data/statistics"
+  target    = "integrations/${aws_apigatewayv2_integration.data_retrieval_api_integration.id}"
+}
+
+resource "aws_apigatewayv2_route" "data_retrieval_api_post_data_export_route" {
+  api_id    = aws_apigatewayv2_api.data_retrieval_api.id
+  route_key = "POST /data/export"
+  target    = "integrations/${aws_apigatewayv2_integration.data_retrieval_api_integration.id}"
+}
+
+resource "aws_apigatewayv2_route" "data_retrieval_api_get_data_export_status_route" {
+  api_id    = aws_apigatewayv2_api.data_retrieval_api.id
+  route_key = "GET /data/export/status"
+  target    = "integrations/${aws_apigatewayv2_integration.data_retrieval_api_integration.id}"
+}
+
 resource "aws_lambda_permission" "data_retrieval_api_lambda_perm" {
   statement_id  = "AllowExecutionFromAPIGateway"
   action        = "lambda:InvokeFunction"
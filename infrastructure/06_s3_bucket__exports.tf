@@ -0,0 +1,33 @@
+################################################################################
+# S3 Bucket where bulk exports of the Iot data get written to
+################################################################################
+
+resource "aws_s3_bucket" "export_bucket" {
+  bucket        = "acme-iot-export-bucket"
+  force_destroy = true
+}
+
+resource "aws_s3_bucket_public_access_block" "export_bucket_block" {
+  bucket                  = aws_s3_bucket.export_bucket.id
+  block_public_acls       = true
+  block_public_policy     = true
+  ignore_public_acls      = true
+  restrict_public_buckets = true
+}
+
+resource "aws_s3_bucket_lifecycle_configuration" "export_bucket_lifecycle" {
+  bucket = aws_s3_bucket.export_bucket.id
+  rule {
+    id     = "expire-exports"
+    status = "Enabled"
+    filter {
+      prefix = "exports/"
+    }
+    expiration {
+      days = var.DATA_EXPORT_RETENTION_DAYS
+    }
+    abort_incomplete_multipart_upload {
+      days_after_initiation = 1
+    }
+  }
+}
@@ -26,3 +26,51 @@ variable "DATA_MYSQL_TABLE" {
   description = "Table name within the MySQL RDS instance that stores the Iot data."
   type        = string
 }
+
+variable "DATA_STORAGE_MODE" {
+  description = "Storage layout of the Iot data, either one row per reading (rows) or compressed device-hour blocks (blocks)."
+  type        = string
+  default     = "rows"
+}
+
+variable "DATA_MYSQL_READ_REPLICAS" {
+  description = "Number of read replicas of the MySQL RDS instance, which serve the data retrieval queries."
+  type        = number
+  default     = 0
+}
+
+variable "DATA_MAX_REPLICA_LAG_SECONDS" {
+  description = "Maximum replication lag of a read replica before data retrieval queries fall back to the primary instance."
+  type        = number
+  default     = 30
+}
+
+variable "DATA_MYSQL_SHARD_IDS" {
+  description = "IDs of additional MySQL RDS instances that the Iot data is sharded across, by device ID."
+  type        = list(string)
+  default     = []
+}
+
+variable "DATA_CLEANING_ACTION" {
+  description = "What the file parser does with bad temperature and humidity values: off, flag, drop or interpolate."
+  type        = string
+  default     = "flag"
+}
+
+variable "DATA_WRITER_SLOTS" {
+  description = "Maximum number of file parser invocations that write to an RDS instance at the same time, or 0 for no limit."
+  type        = number
+  default     = 0
+}
+
+variable "DATA_EXPORT_RETENTION_DAYS" {
+  description = "Number of days that bulk exports of the Iot data are kept in the export bucket."
+  type        = number
+  default     = 7
+}
+
+variable "LAMBDA_PROFILE_SAMPLE_RATE" {
+  description = "Fraction of the Lambda invocations that are profiled with cProfile and tracemalloc."
+  type        = number
+  default     = 0
+}
@@ -0,0 +1,53 @@
+"""
+Cached boto3 clients, shared by the Lambda functions and the setup scripts.
+
+This module:
+ - Creates a client per service and region on first use, and reuses it for as
+   long as the process (or warm Lambda container) lives.
+ - Configures the clients with keep-alive, adaptive retries and short timeouts.
+ - Imports boto3 lazily, as importing it is a large part of a cold start.
+"""
+
+import threading
+from typing import Any
+
+# Maximum number of shards accessed in parallel, which also sizes the connection
+# pools of the boto3 clients
+MAX_WORKERS = 16
+
+# Connection settings of the boto3 clients: keep-alive, adaptive retries that back
+# off when throttled, and timeouts well within the Lambda timeout
+CLIENT_CONFIG = {
+    "tcp_keepalive": True,
+    "retries": {"max_attempts": 5, "mode": "adaptive"},
+    "connect_timeout": 2,
+    "read_timeout": 10,
+}
+
+# boto3 clients by service and region, reused across invocations (see get_client)
+BOTO3_CLIENTS: dict[tuple[str, str | None], Any] = {}
+BOTO3_CLIENTS_LOCK = threading.Lock()
+
+
+def get_client(service: str, region: str | None = None) -> Any:
+    """
+    Returns the boto3 client of the service, creating it on first use.
+
+    Clients are cached per service and region, so warm invocations reuse their
+    loaded service models and open connections. boto3 is imported on first use to
+    keep cold starts fast.
+    """
+    key = (service, region)
+    with BOTO3_CLIENTS_LOCK:
+        if key not in BOTO3_CLIENTS:
+            import boto3  # pylint: disable=import-outside-toplevel
+            from botocore.config import (  # pylint: disable=import-outside-toplevel
+                Config,
+            )
+
+            BOTO3_CLIENTS[key] = boto3.client(
+                service,
+                region_name=region,
+                config=Config(max_pool_connections=MAX_WORKERS, **CLIENT_CONFIG),
+            )
+        return BOTO3_CLIENTS[key]
@@ -0,0 +1,180 @@
+"""
+Codec of the compressed device-hour blocks, the "blocks" storage layout.
+
+The file parser encodes the readings of a device-hour into a block, and both
+Lambdas decode blocks back into rows.
+"""
+
+import math
+import struct
+from typing import Any
+
+from .errors import LambdaError
+
+# Time span covered by a single block, aligned with the hourly rollup buckets
+BLOCK_SIZE = 3600
+
+# Format version written as the first byte of every block
+BLOCK_FORMAT_VERSION = 1
+
+# Marker used instead of a decimal scale for XOR compressed float columns
+BLOCK_XOR_ENCODING = 0xFF
+
+
+def encode_block(rows: list[tuple[Any, ...]]) -> bytes:
+    """
+    Encode the rows of a device-hour, sorted by timestamp, into a compact block.
+
+    Timestamps are stored as the offset of the first reading from the block
+    start followed by zigzag delta-of-deltas, so regular intervals cost one byte
+    per reading. Float columns are stored as scaled integer deltas when every
+    value has at most three decimals, and XOR compressed float32 bits otherwise.
+    The HVAC status is stored as a bitmap.
+    """
+    out = bytearray([BLOCK_FORMAT_VERSION])
+    encode_varint(len(rows), out)
+    previous, delta = rows[0][1] - rows[0][1] % BLOCK_SIZE, 0
+    for row in rows:
+        encode_varint(zigzag(row[1] - previous - delta), out)
+        previous, delta = row[1], row[1] - previous
+    for index in (2, 3):
+        encode_float_column([row[index] for row in rows], out)
+    bitmap = bytearray((len(rows) + 7) // 8)
+    for i, row in enumerate(rows):
+        if row[4]:
+            bitmap[i // 8] |= 1 << i % 8
+    out += bitmap
+    return bytes(out)
+
+
+def decode_block(
+    device_id: int, block_start: int, data: bytes
+) -> list[tuple[Any, ...]]:
+    """
+    Decode a block into rows, in the column order of the raw table.
+
+    The HVAC status is decoded as 0 or 1, as MySQL returns it from the row layout.
+    """
+    if data[0] != BLOCK_FORMAT_VERSION:
+        raise LambdaError(f"Unsupported block format version: {data[0]}")
+    count, pos = decode_varint(data, 1)
+    timestamps = []
+    previous, delta = block_start, 0
+    for _ in range(count):
+        value, pos = decode_varint(data, pos)
+        delta += unzigzag(value)
+        previous += delta
+        timestamps.append(previous)
+    temperatures, pos = decode_float_column(data, pos, count)
+    humidities, pos = decode_float_column(data, pos, count)
+    return [
+        (
+            device_id,
+            timestamps[i],
+            temperatures[i],
+            humidities[i],
+            data[pos + i // 8] >> i % 8 & 1,
+        )
+        for i in range(count)
+    ]
+
+
+def encode_float_column(values: list[float], out: bytearray) -> None:
+    """Append a float column, as scaled integer deltas or XOR compressed bits"""
+    scale = get_decimal_scale(values)
+    if scale is None:
+        out.append(BLOCK_XOR_ENCODING)
+        previous = 0
+        for value in values:
+            bits = struct.unpack("<I", struct.pack("<f", value))[0]
+            xor = bits ^ previous
+            # Strip trailing zeros, storing their count in the lowest 5 bits
+            trailing = (xor & -xor).bit_length() - 1 if xor else 0
+            encode_varint((xor >> trailing) << 5 | trailing if xor else 0, out)
+            previous = bits
+    else:
+        out.append(scale)
+        previous = 0
+        for value in values:
+            scaled = round(value * 10**scale)
+            encode_varint(zigzag(scaled - previous), out)
+            previous = scaled
+
+
+def decode_float_column(data: bytes, pos: int, count: int) -> tuple[list[float], int]:
+    """Returns the decoded float column and the position after it"""
+    scale = data[pos]
+    pos += 1
+    values = []
+    previous = 0
+    for _ in range(count):
+        value, pos = decode_varint(data, pos)
+        if scale == BLOCK_XOR_ENCODING:
+            previous ^= (value >> 5) << (value & 0x1F)
+            values.append(get_float32(previous))
+        else:
+            previous += unzigzag(value)
+            values.append(previous / 10**scale)
+    return values, pos
+
+
+def get_float32_value(value: float) -> float:
+    """Returns the shortest float that round trips to the same float32 value"""
+    return get_float32(struct.unpack("<I", struct.pack("<f", value))[0])
+
+
+def get_float32(bits: int) -> float:
+    """
+    Returns the shortest float that round trips to the float32 bits.
+
+    This matches the values MySQL returns for FLOAT columns, so decoded blocks
+    read the same as the row layout.
+    """
+    value = struct.unpack("<f", struct.pack("<I", bits))[0]
+    if not math.isfinite(value):
+        return value
+    for precision in range(6, 9):
+        shortest = float(f"{value:.{precision}g}")
+        if struct.pack("<f", shortest) == struct.pack("<I", bits):
+            return shortest
+    return value
+
+
+def get_decimal_scale(values: list[float]) -> int | None:
+    """Returns the smallest number of decimals (up to 3) representing all values"""
+    if not all(math.isfinite(value) for value in values):
+        return None
+    for scale in range(4):
+        if all(round(value * 10**scale) / 10**scale == value for value in values):
+            return scale
+    return None
+
+
+def encode_varint(value: int, out: bytearray) -> None:
+    """Append an unsigned integer as a little endian base 128 varint"""
+    while value >= 0x80:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_varint(data: bytes, pos: int) -> tuple[int, int]:
+    """Returns the varint at the position and the position after it"""
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def zigzag(value: int) -> int:
+    """Map a signed integer to an unsigned one, keeping small magnitudes small"""
+    return value << 1 if value >= 0 else (-value << 1) - 1
+
+
+def unzigzag(value: int) -> int:
+    """Inverse of zigzag"""
+    return (value >> 1) ^ -(value & 1)
@@ -0,0 +1,24 @@
+"""
+Device IDs, and the shards that store the devices' data.
+"""
+
+import re
+
+# Format of the external device IDs, and of the legacy IDs, which keep their number
+# as surrogate ID
+DEVICE_ID_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.:-]{0,63}$")
+LEGACY_DEVICE_ID_PATTERN = re.compile(r"^device_([0-9]{3})$")
+
+# Surrogate ID from which registered devices are numbered, above the legacy IDs
+FIRST_DEVICE_ID = 1000
+
+
+def get_legacy_device_id(external_id: str) -> int | None:
+    """Returns the number of a legacy device ID ("device_NNN"), or None"""
+    match_obj = LEGACY_DEVICE_ID_PATTERN.match(external_id)
+    return int(match_obj.group(1)) if match_obj else None
+
+
+def get_shard(device_id: int, shard_count: int) -> int:
+    """Returns the index of the shard that stores the device's data"""
+    return device_id % shard_count
@@ -0,0 +1,12 @@
+"""
+Errors shared by the Lambda functions.
+
+The handlers catch LambdaError to report a failed invocation, so the shared code
+raises it as well.
+"""
+
+
+class LambdaError(Exception):
+    def __init__(self, message: str) -> None:
+        self.message = message
+        super().__init__(self.message)
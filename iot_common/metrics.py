@@ -0,0 +1,73 @@
+"""
+Per-stage metrics of the Lambda functions, in CloudWatch Embedded Metric Format.
+"""
+
+import json
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+
+
+class Metrics:
+    """
+    Per-stage timers and counters, emitted in CloudWatch Embedded Metric Format.
+
+    Values are summed per stage during an invocation, then flushed as one EMF log
+    line per stage with the function and stage as dimensions. CloudWatch extracts
+    the metrics from the logs, so no API calls are made.
+    """
+
+    def __init__(self, namespace: str, function_name: str) -> None:
+        self.namespace = namespace
+        self.function_name = function_name
+        self._stages: dict[str, dict[str, tuple[float, str]]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, name: str, value: float, unit: str = "Count") -> None:
+        """Adds the value to the named metric of the stage"""
+        with self._lock:
+            metrics = self._stages.setdefault(stage, {})
+            total, _ = metrics.get(name, (0, unit))
+            metrics[name] = (total + value, unit)
+
+    @contextmanager
+    def timer(self, stage: str) -> Iterator[None]:
+        """Adds the duration of the context to the "Time" metric of the stage"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            self.add(stage, "Time", elapsed, "Milliseconds")
+
+    def flush(self) -> None:
+        """Prints the metrics of each stage as an EMF log line, then resets them"""
+        with self._lock:
+            stages, self._stages = self._stages, {}
+        timestamp = int(time.time() * 1000)
+        for stage, metrics in stages.items():
+            emf = {
+                "Timestamp": timestamp,
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": self.namespace,
+                        "Dimensions": [["FunctionName", "Stage"]],
+                        "Metrics": [
+                            {"Name": name, "Unit": unit}
+                            for name, (_, unit) in metrics.items()
+                        ],
+                    }
+                ],
+            }
+            values = {name: round(value, 3) for name, (value, _) in metrics.items()}
+            print(
+                json.dumps(
+                    {
+                        "_aws": emf,
+                        "FunctionName": self.function_name,
+                        "Stage": stage,
+                        **values,
+                    }
+                )
+            )
@@ -0,0 +1,94 @@
+"""
+Sampled profiling of the Lambda invocations, with cProfile and tracemalloc.
+"""
+
+import cProfile
+import json
+import marshal
+import os
+import random
+import time
+import tracemalloc
+from collections.abc import Iterator
+from contextlib import contextmanager
+from typing import Any
+
+from botocore.exceptions import ClientError
+
+from .aws import get_client
+
+# Number of functions and allocating lines listed in the summaries of profiled
+# invocations (see profile_invocation)
+PROFILE_TOP_N = 20
+
+
+@contextmanager
+def profile_invocation(event: Any, function_name: str) -> Iterator[None]:
+    """
+    Profiles the invocation with cProfile and tracemalloc, when it's sampled.
+
+    A PROFILE_SAMPLE_RATE fraction of the invocations is profiled, as well as
+    direct invocations whose event has a truthy "profile" key. A summary of the
+    slowest functions and largest allocations is logged, and the pstats dump is
+    uploaded to PROFILE_S3_PREFIX ("s3://<bucket>/<prefix>") when it's set.
+    """
+    sample_rate = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+    requested = isinstance(event, dict) and bool(event.get("profile"))
+    if not requested and (sample_rate <= 0 or random.random() >= sample_rate):
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        profiler.create_stats()
+        print(json.dumps({"profile": get_profile_summary(profiler, snapshot, peak)}))
+        s3_prefix = os.environ.get("PROFILE_S3_PREFIX")
+        if s3_prefix:
+            upload_profile(profiler, s3_prefix, function_name)
+
+
+def get_profile_summary(profiler: Any, snapshot: Any, peak: int) -> dict[str, Any]:
+    """Summarizes the top functions by cumulative time and lines by allocated size"""
+    functions = sorted(profiler.stats.items(), key=lambda item: -item[1][3])
+    return {
+        "peak_memory_bytes": peak,
+        "functions": [
+            {
+                "function": f"{file}:{line}({name})",
+                "calls": calls,
+                "total_ms": round(total_time * 1000, 3),
+                "cumulative_ms": round(cumulative_time * 1000, 3),
+            }
+            for (file, line, name), (_, calls, total_time, cumulative_time, _) in (
+                functions[:PROFILE_TOP_N]
+            )
+        ],
+        "allocations": [
+            {
+                "line": str(stat.traceback[0]),
+                "size_bytes": stat.size,
+                "count": stat.count,
+            }
+            for stat in snapshot.statistics("lineno")[:PROFILE_TOP_N]
+        ],
+    }
+
+
+def upload_profile(profiler: Any, s3_prefix: str, function_name: str) -> None:
+    """Uploads the pstats dump of the profiler, which can be loaded with pstats"""
+    bucket, _, prefix = s3_prefix.removeprefix("s3://").partition("/")
+    key = f"{prefix.rstrip('/')}/{function_name}/{time.time_ns()}.pstats"
+    try:
+        get_client("s3", os.environ.get("REGION")).put_object(
+            Bucket=bucket, Key=key.lstrip("/"), Body=marshal.dumps(profiler.stats)
+        )
+    except ClientError as e:
+        print(f"Failed to upload profile to '{bucket}' bucket: {e}")
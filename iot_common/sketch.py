@@ -0,0 +1,112 @@
+"""
+Mergeable quantile sketches, stored in the rollup tables.
+
+The file parser sketches the temperature and humidity of each rollup bucket, and
+the data retrieval Lambda merges the sketches into approximate percentiles.
+"""
+
+import math
+import random
+import struct
+
+from .blocks import get_float32_value
+
+# Accuracy parameter of the quantile sketches, see QuantileSketch
+SKETCH_K = 200
+
+# Normalized rank error of approximate percentiles, with 99% confidence for SKETCH_K
+SKETCH_RANK_ERROR = 0.0165
+
+
+class QuantileSketch:
+    """
+    KLL quantile sketch, which summarizes a stream of values in bounded memory.
+
+    Values are added to the lowest level. A full level is compacted by sorting it
+    and promoting every other value, from a random offset, to the next level,
+    where each value stands for twice as many values. Sketches are mergeable, so
+    the sketches of the hourly buckets are combined into the daily sketches. The
+    rank of a returned quantile is within SKETCH_RANK_ERROR of the requested rank,
+    with 99% confidence, no matter how many values were added or merged.
+    """
+
+    def __init__(self, k: int = SKETCH_K) -> None:
+        self.k = k
+        self.count = 0
+        self.levels: list[list[float]] = [[]]
+
+    def update(self, value: float) -> None:
+        """Add a value to the sketch"""
+        self.levels[0].append(value)
+        self.count += 1
+        if len(self.levels[0]) >= self.get_capacity(0):
+            self.compress()
+
+    def merge(self, other: "QuantileSketch") -> None:
+        """Add the values summarized by another sketch to the sketch"""
+        while len(self.levels) < len(other.levels):
+            self.levels.append([])
+        for level, values in zip(self.levels, other.levels):
+            level.extend(values)
+        self.count += other.count
+        self.compress()
+
+    def get_capacity(self, height: int) -> int:
+        """Returns the capacity of a level, which shrinks towards the lower levels"""
+        depth = len(self.levels) - height - 1
+        return max(8, math.ceil(self.k * (2 / 3) ** depth))
+
+    def compress(self) -> None:
+        """Compact every level that reached its capacity"""
+        height = 0
+        while height < len(self.levels):
+            level = self.levels[height]
+            if len(level) >= self.get_capacity(height):
+                if height + 1 == len(self.levels):
+                    self.levels.append([])
+                level.sort()
+                kept = [level.pop()] if len(level) % 2 else []
+                self.levels[height + 1].extend(level[random.randint(0, 1) :: 2])
+                self.levels[height] = kept
+            height += 1
+
+    def get_quantiles(self, ranks: list[float]) -> list[float | None]:
+        """Returns the values at the normalized ranks, or None for an empty sketch"""
+        values = sorted(
+            (value, 1 << height)
+            for height, level in enumerate(self.levels)
+            for value in level
+        )
+        quantiles: list[float | None] = []
+        for rank in ranks:
+            cumulative = 0
+            quantile = values[-1][0] if values else None
+            for value, weight in values:
+                cumulative += weight
+                if cumulative >= rank * self.count:
+                    quantile = value
+                    break
+            quantiles.append(quantile)
+        return quantiles
+
+    def to_bytes(self) -> bytes:
+        """Serialize the sketch, storing the values as float32 like the raw data"""
+        data = struct.pack("<HQB", self.k, self.count, len(self.levels))
+        for level in self.levels:
+            data += struct.pack(f"<I{len(level)}f", len(level), *level)
+        return data
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "QuantileSketch":
+        """Deserialize a sketch, reading the values as MySQL reads FLOAT columns"""
+        k, count, height = struct.unpack_from("<HQB", data)
+        sketch = cls(k)
+        sketch.count = count
+        sketch.levels = []
+        pos = struct.calcsize("<HQB")
+        for _ in range(height):
+            (length,) = struct.unpack_from("<I", data, pos)
+            level = struct.unpack_from(f"<{length}f", data, pos + 4)
+            sketch.levels.append([get_float32_value(value) for value in level])
+            pos += 4 + 4 * length
+        return sketch
@@ -0,0 +1,7 @@
+#!/bin/bash
+
+cd "$(dirname "$0")/.."
+
+# The shared code runs in both Lambdas, so it's tested with the dependencies of one
+poetry --directory data_retrieval_lambda run coverage run --source=iot_common --omit=*/tests/* -m pytest iot_common/tests -vv
+poetry --directory data_retrieval_lambda run coverage report --show-missing --skip-empty
@@ -0,0 +1,11 @@
+from ..aws import MAX_WORKERS, get_client
+
+
+def test_get_client() -> None:
+    client = get_client("secretsmanager", "eu-west-1")
+
+    assert get_client("secretsmanager", "eu-west-1") is client
+    assert get_client("secretsmanager", "eu-west-2") is not client
+    assert client.meta.config.tcp_keepalive
+    assert client.meta.config.max_pool_connections == MAX_WORKERS
+    assert client.meta.config.retries["mode"] == "adaptive"
@@ -0,0 +1,32 @@
+import pytest
+
+from ..blocks import decode_block, encode_block
+from ..errors import LambdaError
+
+
+def test_encode_block__decimal_values() -> None:
+    rows = [
+        (1, 1690326000 + offset, round(20.1 + offset / 100, 2), 50.55, offset % 20 == 0)
+        for offset in range(5, 3600, 10)
+    ]
+
+    block = encode_block(rows)
+    assert decode_block(1, 1690326000, block) == rows
+    # One byte per timestamp and value, plus the HVAC bitmap and headers
+    assert len(block) < 4 * len(rows)
+
+
+def test_encode_block__xor_values() -> None:
+    rows = [
+        (1, 1690326000, 20.1234, 50.5, False),
+        (1, 1690326001, 20.1236, 50.25, True),
+        (1, 1690326300, -3.5e-7, 50.125, True),
+    ]
+
+    assert decode_block(1, 1690326000, encode_block(rows)) == rows
+
+
+def test_decode_block__unsupported_version() -> None:
+    with pytest.raises(LambdaError) as e:
+        decode_block(1, 1690326000, b"\x02\x00")
+    assert str(e.value) == "Unsupported block format version: 2"
@@ -0,0 +1,11 @@
+from ..devices import get_legacy_device_id, get_shard
+
+
+def test_get_legacy_device_id() -> None:
+    assert get_legacy_device_id("device_007") == 7
+    assert get_legacy_device_id("device_1000") is None
+    assert get_legacy_device_id("sensor-a") is None
+
+
+def test_get_shard() -> None:
+    assert [get_shard(device_id, 3) for device_id in range(1, 5)] == [1, 2, 0, 1]
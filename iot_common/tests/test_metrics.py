@@ -0,0 +1,32 @@
+import json
+
+import pytest
+
+from ..metrics import Metrics
+
+
+def test_metrics(capsys: pytest.CaptureFixture[str]) -> None:
+    metrics = Metrics(namespace="IotData", function_name="function")
+    with metrics.timer("insert"):
+        metrics.add("insert", "RowsInserted", 2)
+    metrics.add("insert", "RowsInserted", 3)
+    metrics.flush()
+    metrics.flush()
+
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 1
+    emf = json.loads(lines[0])
+    assert emf["_aws"]["CloudWatchMetrics"] == [
+        {
+            "Namespace": "IotData",
+            "Dimensions": [["FunctionName", "Stage"]],
+            "Metrics": [
+                {"Name": "RowsInserted", "Unit": "Count"},
+                {"Name": "Time", "Unit": "Milliseconds"},
+            ],
+        }
+    ]
+    assert emf["FunctionName"] == "function"
+    assert emf["Stage"] == "insert"
+    assert emf["RowsInserted"] == 5
+    assert emf["Time"] >= 0
@@ -0,0 +1,51 @@
+import json
+import os
+from unittest import mock
+
+import boto3
+import pytest
+from moto import mock_s3
+
+from ..profiling import PROFILE_TOP_N, profile_invocation
+
+
+def test_profile_invocation__sampled(capsys: pytest.CaptureFixture[str]) -> None:
+    with mock.patch.dict(os.environ, {"PROFILE_SAMPLE_RATE": "1"}), profile_invocation(
+        {}, "function"
+    ):
+        sorted(range(1000), key=str)
+
+    summary = json.loads(capsys.readouterr().out)["profile"]
+    assert len(summary["functions"]) <= PROFILE_TOP_N
+    assert any("sorted" in f["function"] for f in summary["functions"])
+    assert len(summary["allocations"]) <= PROFILE_TOP_N
+
+
+@mock_s3
+def test_profile_invocation(capsys: pytest.CaptureFixture[str]) -> None:
+    s3_client = boto3.client("s3", region_name="us-east-1")
+    s3_client.create_bucket(Bucket="profiles")
+
+    env = {"PROFILE_S3_PREFIX": "s3://profiles/dumps", "REGION": "us-east-1"}
+    with mock.patch.dict(os.environ, env), profile_invocation(
+        {"profile": True}, "file_parser_lambda"
+    ):
+        sorted(range(1000), key=str)
+
+    summary = json.loads(capsys.readouterr().out)["profile"]
+    assert summary["peak_memory_bytes"] > 0
+    assert summary["functions"]
+    assert summary["allocations"]
+    objects = s3_client.list_objects_v2(Bucket="profiles")["Contents"]
+    assert len(objects) == 1
+    assert objects[0]["Key"].startswith("dumps/file_parser_lambda/")
+    assert objects[0]["Key"].endswith(".pstats")
+
+
+def test_profile_invocation__not_sampled(capsys: pytest.CaptureFixture[str]) -> None:
+    with mock.patch.dict(os.environ, {"PROFILE_SAMPLE_RATE": "0"}), profile_invocation(
+        {"Records": []}, "function"
+    ):
+        pass
+
+    assert capsys.readouterr().out == ""
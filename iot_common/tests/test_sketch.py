@@ -0,0 +1,36 @@
+import random
+
+from ..sketch import SKETCH_RANK_ERROR, QuantileSketch
+
+
+def test_quantile_sketch__rank_error() -> None:
+    random.seed(0)
+    values = [random.gauss(20, 5) for _ in range(100000)]
+    sketch = QuantileSketch()
+    for start in range(0, len(values), 1000):
+        part = QuantileSketch()
+        for value in values[start : start + 1000]:
+            part.update(value)
+        sketch.merge(part)
+
+    assert sketch.count == len(values)
+    assert sum(len(level) for level in sketch.levels) < 1000
+    values.sort()
+    ranks = [0.01, 0.25, 0.5, 0.75, 0.99]
+    for rank, quantile in zip(ranks, sketch.get_quantiles(ranks)):
+        assert quantile is not None
+        assert abs(values.index(quantile) / len(values) - rank) < SKETCH_RANK_ERROR
+    assert QuantileSketch().get_quantiles([0.5]) == [None]
+
+
+def test_quantile_sketch__serialization() -> None:
+    sketch = QuantileSketch()
+    for value in range(1000):
+        sketch.update(value / 4)
+
+    restored = QuantileSketch.from_bytes(sketch.to_bytes())
+    assert restored.k == sketch.k
+    assert restored.count == 1000
+    assert restored.levels == sketch.levels
+    # Compaction keeps the total weight of the retained values
+    assert sum(len(level) << h for h, level in enumerate(sketch.levels)) == 1000
@@ -1,60 +1,546 @@
+"""
+Python script that sets up the schema of the MySQL RDS instance.
+
+This script:
+ - Creates the database and applies the pending schema migrations, which create
+   the Iot data table, its supporting tables and indexes.
+ - Creates the devices dimension table, which maps external device IDs to the
+   surrogate IDs stored in the other tables.
+ - Optionally partitions the Iot data table by month and uses compact types.
+ - Maintains the monthly partitions, by pre-creating future partitions and
+   dropping expired ones, when called with the "maintain-partitions" command.
+"""
+
+import argparse
 import json
 import os
+import time
+from collections.abc import Callable
+from datetime import UTC, date, datetime
+from typing import Any, NamedTuple
 
-import boto3
 import pymysql
 
+from iot_common.aws import get_client
+from iot_common.devices import FIRST_DEVICE_ID
+
+# Aggregates stored in the rollup tables, computed from the raw and rollup rows
+ROLLUP_AGGREGATES = {
+    "sample_count": ("COUNT(*)", "SUM(sample_count)"),
+    "temperature_sum": ("SUM(temperature)", "SUM(temperature_sum)"),
+    "temperature_min": ("MIN(temperature)", "MIN(temperature_min)"),
+    "temperature_max": ("MAX(temperature)", "MAX(temperature_max)"),
+    "temperature_sum_sq": (
+        "SUM(temperature * temperature)",
+        "SUM(temperature_sum_sq)",
+    ),
+    "humidity_sum": ("SUM(humidity)", "SUM(humidity_sum)"),
+    "humidity_min": ("MIN(humidity)", "MIN(humidity_min)"),
+    "humidity_max": ("MAX(humidity)", "MAX(humidity_max)"),
+    "humidity_sum_sq": ("SUM(humidity * humidity)", "SUM(humidity_sum_sq)"),
+    "hvac_on_count": ("SUM(hvac_status)", "SUM(hvac_on_count)"),
+}
+
+
+class SchemaOptions(NamedTuple):
+    """Options that the schema is created with"""
+
+    table: str
+    partitioned: bool = False
+    compact_types: bool = False
+    months_ahead: int = 3
+
+
+class Migration(NamedTuple):
+    """Versioned step that migrates the schema"""
+
+    version: int
+    name: str
+    get_statements: Callable[[SchemaOptions], list[str]]
+
 
 def get_host(mysql_id: str, region: str) -> str:
     print("Retrieving RDS endpoint")
-    rds_client = boto3.client("rds", region_name=region)
+    rds_client = get_client("rds", region)
     response = rds_client.describe_db_instances(DBInstanceIdentifier=mysql_id)
     return response["DBInstances"][0]["Endpoint"]["Address"]
 
 
 def get_db_credentials(secret_manager_id: str, region: str) -> tuple[str, str]:
     print("Retrieving RDS credentials")
-    secret_client = boto3.client("secretsmanager", region_name=region)
+    secret_client = get_client("secretsmanager", region)
     resp = secret_client.get_secret_value(SecretId=secret_manager_id)
     secrets = json.loads(resp["SecretString"])
     return (secrets["mysql_user"], secrets["mysql_password"])
 
 
-REGION = os.environ["TF_VAR_REGION"]
-SECRET_MANAGER_ID = os.environ["TF_VAR_SECRET_MANAGER_ID"]
-MYSQL_ID = os.environ["TF_VAR_DATA_MYSQL_ID"]
-MYSQL_HOST = get_host(MYSQL_ID, REGION)
-MYSQL_USER, MYSQL_PASSWORD = get_db_credentials(SECRET_MANAGER_ID, REGION)
-MYSQL_DATABASE = os.environ["TF_VAR_DATA_MYSQL_DATABASE"]
-MYSQL_TABLE = os.environ["TF_VAR_DATA_MYSQL_TABLE"]
-
-
-print(f"Connecting to: {MYSQL_HOST}")
-conn = pymysql.connect(
-    host=MYSQL_HOST, user=MYSQL_USER, password=MYSQL_PASSWORD, charset="utf8mb4"
-)
-cur = conn.cursor()
-print(f"Creating '{MYSQL_DATABASE}' database if it doesn't exist")
-cur.execute(f"CREATE DATABASE IF NOT EXISTS {MYSQL_DATABASE}")
-
-conn = pymysql.connect(
-    host=MYSQL_HOST,
-    user=MYSQL_USER,
-    password=MYSQL_PASSWORD,
-    database=MYSQL_DATABASE,
-    charset="utf8mb4",
-)
-cur = conn.cursor()
-print(f"Creating '{MYSQL_TABLE}' table if it doesn't exist")
-cur.execute(
-    f"""
-    CREATE TABLE IF NOT EXISTS {MYSQL_TABLE} (
-        device_id int,
-        timestamp int,
-        temperature float,
-        humidity float,
-        hvac_status boolean,
-        PRIMARY KEY (device_id, timestamp)
-    );
-    """
-)
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "command",
+        nargs="?",
+        default="migrate",
+        choices=["migrate", "maintain-partitions"],
+        help="migrate the schema (default) or maintain the monthly partitions",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only print the statements of the pending migrations",
+    )
+    parser.add_argument(
+        "--partitioned",
+        action="store_true",
+        help="partition the Iot data table by month, when it is created",
+    )
+    parser.add_argument(
+        "--compact-types",
+        action="store_true",
+        help="use compact column types for the Iot data table, when it is created",
+    )
+    parser.add_argument(
+        "--months-ahead",
+        type=int,
+        default=3,
+        help="number of future monthly partitions to keep available",
+    )
+    parser.add_argument(
+        "--retention-months",
+        type=int,
+        default=12,
+        help="number of past months of raw data to keep when maintaining",
+    )
+    return parser.parse_args()
+
+
+def add_months(month: date, months: int) -> date:
+    """Returns the first day of the month that is a number of months later"""
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def get_month_start(value: datetime) -> date:
+    return date(value.year, value.month, 1)
+
+
+def get_timestamp(month: date) -> int:
+    return int(datetime(month.year, month.month, 1, tzinfo=UTC).timestamp())
+
+
+def get_partition_definition(month: date) -> str:
+    """Returns the definition of the partition that holds the month's data"""
+    return (
+        f"PARTITION p{month:%Y%m} "
+        f"VALUES LESS THAN ({get_timestamp(add_months(month, 1))})"
+    )
+
+
+def get_partitioning(now: datetime, months_ahead: int) -> str:
+    """
+    Returns the partitioning clause of the Iot data table.
+
+    The first partition also holds all data from before the current month, and
+    the catch-all partition ensures inserts never fail when maintenance lags.
+    """
+    month = get_month_start(now)
+    partitions = [
+        get_partition_definition(add_months(month, i)) for i in range(months_ahead + 1)
+    ]
+    partitions.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+    return f"PARTITION BY RANGE (timestamp) ({', '.join(partitions)})"
+
+
+def get_table_definition(
+    table: str,
+    partitioned: bool,
+    compact_types: bool,
+    now: datetime,
+    months_ahead: int = 3,
+) -> str:
+    if compact_types:
+        columns = (
+            "device_id smallint unsigned NOT NULL, "
+            "timestamp int unsigned NOT NULL, "
+            "temperature float NOT NULL, "
+            "humidity float NOT NULL, "
+            "hvac_status boolean NOT NULL"
+        )
+    else:
+        columns = (
+            "device_id int, "
+            "timestamp int, "
+            "temperature float, "
+            "humidity float, "
+            "hvac_status boolean"
+        )
+    definition = (
+        f"CREATE TABLE IF NOT EXISTS {table} "
+        f"({columns}, PRIMARY KEY (device_id, timestamp))"
+    )
+    if partitioned:
+        definition += f" {get_partitioning(now, months_ahead)}"
+    return definition
+
+
+def get_partition_maintenance(
+    table: str,
+    partitions: list[tuple[str, str]],
+    now: datetime,
+    months_ahead: int,
+    retention_months: int,
+) -> list[str]:
+    """
+    Returns the statements that keep the monthly partitions up to date.
+
+    Future partitions are split off the empty catch-all partition and expired
+    partitions are dropped as a whole, instead of deleting their rows.
+    """
+    bounds = {name: int(bound) for name, bound in partitions if bound != "MAXVALUE"}
+    month = get_month_start(now)
+    missing = [
+        add_months(month, i)
+        for i in range(months_ahead + 1)
+        if get_timestamp(add_months(month, i + 1)) > max(bounds.values(), default=0)
+    ]
+    cutoff = get_timestamp(add_months(month, -retention_months))
+    expired = sorted(name for name, bound in bounds.items() if bound <= cutoff)
+
+    statements = []
+    if missing:
+        definitions = [get_partition_definition(m) for m in missing]
+        definitions.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+        statements.append(
+            f"ALTER TABLE {table} REORGANIZE PARTITION pmax "
+            f"INTO ({', '.join(definitions)})"
+        )
+    if expired:
+        statements.append(f"ALTER TABLE {table} DROP PARTITION {', '.join(expired)}")
+    return statements
+
+
+def get_partitions(cur: Any, database: str, table: str) -> list[tuple[str, str]]:
+    cur.execute(
+        "SELECT PARTITION_NAME, PARTITION_DESCRIPTION "
+        "FROM information_schema.PARTITIONS "
+        "WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s "
+        "AND PARTITION_NAME IS NOT NULL",
+        (database, table),
+    )
+    return list(cur.fetchall())
+
+
+def create_iot_data_table(options: SchemaOptions) -> list[str]:
+    return [
+        get_table_definition(
+            options.table,
+            options.partitioned,
+            options.compact_types,
+            datetime.now(UTC),
+            options.months_ahead,
+        )
+    ]
+
+
+def create_rollup_tables(options: SchemaOptions) -> list[str]:
+    return [
+        f"CREATE TABLE IF NOT EXISTS {options.table}_{rollup} ("
+        "device_id int, "
+        "timestamp int, "
+        "sample_count int, "
+        "temperature_sum double, "
+        "temperature_min float, "
+        "temperature_max float, "
+        "temperature_sum_sq double, "
+        "humidity_sum double, "
+        "humidity_min float, "
+        "humidity_max float, "
+        "humidity_sum_sq double, "
+        "hvac_on_count int, "
+        "PRIMARY KEY (device_id, timestamp))"
+        for rollup in ["hourly", "daily"]
+    ]
+
+
+def create_versions_table(options: SchemaOptions) -> list[str]:
+    return [
+        (
+            f"CREATE TABLE IF NOT EXISTS {options.table}_versions ("
+            "device_id int, "
+            "version bigint unsigned NOT NULL DEFAULT 0, "
+            "PRIMARY KEY (device_id))"
+        )
+    ]
+
+
+def backfill_rollups(options: SchemaOptions) -> list[str]:
+    """Fill the rollup tables with the data that was ingested before them"""
+    statements = []
+    for suffix, bucket_size, source in [
+        ("hourly", 3600, ""),
+        ("daily", 86400, "_hourly"),
+    ]:
+        aggregates = [
+            rollup if source else raw for raw, rollup in ROLLUP_AGGREGATES.values()
+        ]
+        updates = [f"{column} = VALUES({column})" for column in ROLLUP_AGGREGATES]
+        bucket = f"timestamp DIV {bucket_size} * {bucket_size}"
+        statements.append(
+            f"INSERT INTO {options.table}_{suffix} "
+            f"(device_id, timestamp, {', '.join(ROLLUP_AGGREGATES)}) "
+            f"SELECT device_id, {bucket}, {', '.join(aggregates)} "
+            f"FROM {options.table}{source} GROUP BY device_id, {bucket} "
+            f"ON DUPLICATE KEY UPDATE {', '.join(updates)}"
+        )
+    return statements
+
+
+def add_index(table: str, name: str, columns: list[str]) -> str:
+    """
+    Returns the online DDL statement that adds an index to a table.
+
+    The index is built in place without locking the table, so the Lambda
+    functions can keep reading and writing while it is being built.
+    """
+    return (
+        f"ALTER TABLE {table} ADD INDEX {name} ({', '.join(columns)}), "
+        "ALGORITHM=INPLACE, LOCK=NONE"
+    )
+
+
+def add_timestamp_index(options: SchemaOptions) -> list[str]:
+    """Support cross-device time window queries, which aren't keyed on device_id"""
+    return [
+        add_index(options.table, "idx_timestamp_device_id", ["timestamp", "device_id"])
+    ]
+
+
+def create_latest_table(options: SchemaOptions) -> list[str]:
+    """Create the table of each device's latest reading, filled from the raw data"""
+    table = options.table
+    return [
+        (
+            f"CREATE TABLE IF NOT EXISTS {table}_latest ("
+            "device_id int, "
+            "timestamp int, "
+            "temperature float, "
+            "humidity float, "
+            "hvac_status boolean, "
+            "PRIMARY KEY (device_id))"
+        ),
+        (
+            f"INSERT IGNORE INTO {table}_latest "
+            "SELECT data.device_id, data.timestamp, data.temperature, "
+            "data.humidity, data.hvac_status "
+            f"FROM {table} AS data JOIN (SELECT device_id, MAX(timestamp) AS timestamp "
+            f"FROM {table} GROUP BY device_id) AS latest "
+            "ON data.device_id = latest.device_id AND data.timestamp = latest.timestamp"
+        ),
+    ]
+
+
+def create_blocks_table(options: SchemaOptions) -> list[str]:
+    """Create the table of compressed device-hour blocks, used by block storage"""
+    return [
+        (
+            f"CREATE TABLE IF NOT EXISTS {options.table}_blocks ("
+            "device_id int, "
+            "timestamp int, "
+            "sample_count int, "
+            "data blob, "
+            "PRIMARY KEY (device_id, timestamp), "
+            "INDEX idx_timestamp_device_id (timestamp, device_id))"
+        )
+    ]
+
+
+def add_rollup_sketches(options: SchemaOptions) -> list[str]:
+    """
+    Add the quantile sketch columns to the rollup tables.
+
+    The sketches of existing buckets stay empty until the bucket is written
+    again, and readers fall back to the raw data for buckets without a sketch.
+    """
+    return [
+        f"ALTER TABLE {options.table}_{rollup} "
+        "ADD COLUMN temperature_sketch blob, ADD COLUMN humidity_sketch blob, "
+        "ALGORITHM=INPLACE, LOCK=NONE"
+        for rollup in ["hourly", "daily"]
+    ]
+
+
+def create_devices_table(options: SchemaOptions) -> list[str]:
+    """
+    Create the dimension table mapping external device IDs to surrogate IDs.
+
+    The other tables store the compact surrogate IDs. Legacy IDs ("device_NNN")
+    keep their number, so the existing data is registered as is, while new
+    devices are numbered from FIRST_DEVICE_ID.
+    """
+    table = options.table
+    return [
+        (
+            f"CREATE TABLE IF NOT EXISTS {table}_devices ("
+            "device_id int NOT NULL AUTO_INCREMENT, "
+            "external_id varchar(64) CHARACTER SET ascii COLLATE ascii_bin NOT NULL, "
+            "PRIMARY KEY (device_id), "
+            "UNIQUE INDEX idx_external_id (external_id)) "
+            f"AUTO_INCREMENT = {FIRST_DEVICE_ID}"
+        ),
+        (
+            f"INSERT IGNORE INTO {table}_devices (device_id, external_id) "
+            "SELECT device_id, CONCAT('device_', LPAD(device_id, 3, '0')) "
+            f"FROM {table}_latest WHERE device_id < {FIRST_DEVICE_ID}"
+        ),
+    ]
+
+
+def widen_compact_device_ids(options: SchemaOptions) -> list[str]:
+    """
+    Widen the device_id of a table created with compact types to 3 bytes.
+
+    Registered devices are numbered from FIRST_DEVICE_ID without an upper bound,
+    which overflowed the smallint column after 65535 devices. Registration is
+    capped at the same range, so it fails instead of storing IDs that don't fit.
+    Both tables are rebuilt, which blocks writes while the statements run.
+    """
+    if not options.compact_types:
+        return []
+    table = options.table
+    return [
+        f"ALTER TABLE {table} MODIFY device_id mediumint unsigned NOT NULL",
+        (
+            f"ALTER TABLE {table}_devices "
+            "MODIFY device_id mediumint unsigned NOT NULL AUTO_INCREMENT"
+        ),
+    ]
+
+
+# Ordered schema migrations, which are each applied once and never changed
+MIGRATIONS = [
+    Migration(1, "create_iot_data_table", create_iot_data_table),
+    Migration(2, "create_rollup_tables", create_rollup_tables),
+    Migration(3, "create_versions_table", create_versions_table),
+    Migration(4, "backfill_rollups", backfill_rollups),
+    Migration(5, "add_timestamp_index", add_timestamp_index),
+    Migration(6, "create_latest_table", create_latest_table),
+    Migration(7, "create_blocks_table", create_blocks_table),
+    Migration(8, "add_rollup_sketches", add_rollup_sketches),
+    Migration(9, "create_devices_table", create_devices_table),
+    Migration(10, "widen_compact_device_ids", widen_compact_device_ids),
+]
+
+
+def get_applied_versions(cur: Any) -> set[int]:
+    cur.execute("SHOW TABLES LIKE 'schema_migrations'")
+    if not cur.fetchall():
+        return set()
+    cur.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cur.fetchall()}
+
+
+def migrate(conn: Any, options: SchemaOptions, dry_run: bool = False) -> list[int]:
+    """
+    Apply the pending migrations in order and record them in the version table.
+
+    In dry run mode the statements of the pending migrations are only printed.
+    Returns the versions of the (to be) applied migrations.
+    """
+    with conn.cursor() as cur:
+        applied = get_applied_versions(cur)
+        pending = [m for m in MIGRATIONS if m.version not in applied]
+        if not pending:
+            print("The schema is up to date")
+            return []
+        if not dry_run:
+            cur.execute(
+                "CREATE TABLE IF NOT EXISTS schema_migrations ("
+                "version int, "
+                "name varchar(255) NOT NULL, "
+                "applied_at int NOT NULL, "
+                "PRIMARY KEY (version))"
+            )
+
+        for migration in pending:
+            prefix = "Would apply" if dry_run else "Applying"
+            print(f"{prefix} migration {migration.version}: {migration.name}")
+            for statement in migration.get_statements(options):
+                print(f"  {statement}")
+                if not dry_run:
+                    cur.execute(statement)
+            if not dry_run:
+                cur.execute(
+                    "INSERT INTO schema_migrations (version, name, applied_at) "
+                    "VALUES (%s, %s, %s)",
+                    (migration.version, migration.name, int(time.time())),
+                )
+                conn.commit()
+    return [migration.version for migration in pending]
+
+
+def maintain_partitions(
+    cur: Any, database: str, table: str, months_ahead: int, retention_months: int
+) -> None:
+    partitions = get_partitions(cur, database, table)
+    if not partitions:
+        print(f"The '{table}' table isn't partitioned")
+        return
+    statements = get_partition_maintenance(
+        table, partitions, datetime.now(UTC), months_ahead, retention_months
+    )
+    for statement in statements:
+        print(f"Executing: {statement}")
+        cur.execute(statement)
+    if not statements:
+        print(f"The partitions of '{table}' are up to date")
+
+
+def main() -> None:
+    args = parse_args()
+    region = os.environ["TF_VAR_REGION"]
+    secret_manager_id = os.environ["TF_VAR_SECRET_MANAGER_ID"]
+    # The data can be sharded across additional instances, given as a JSON list
+    mysql_ids = [os.environ["TF_VAR_DATA_MYSQL_ID"]] + json.loads(
+        os.environ.get("TF_VAR_DATA_MYSQL_SHARD_IDS", "[]")
+    )
+    mysql_user, mysql_password = get_db_credentials(secret_manager_id, region)
+    mysql_database = os.environ["TF_VAR_DATA_MYSQL_DATABASE"]
+    mysql_table = os.environ["TF_VAR_DATA_MYSQL_TABLE"]
+
+    for mysql_id in mysql_ids:
+        mysql_host = get_host(mysql_id, region)
+        print(f"Connecting to: {mysql_host}")
+        conn = pymysql.connect(
+            host=mysql_host,
+            user=mysql_user,
+            password=mysql_password,
+            charset="utf8mb4",
+        )
+        cur = conn.cursor()
+        print(f"Creating '{mysql_database}' database if it doesn't exist")
+        cur.execute(f"CREATE DATABASE IF NOT EXISTS {mysql_database}")
+
+        conn = pymysql.connect(
+            host=mysql_host,
+            user=mysql_user,
+            password=mysql_password,
+            database=mysql_database,
+            charset="utf8mb4",
+        )
+        cur = conn.cursor()
+        if args.command == "maintain-partitions":
+            maintain_partitions(
+                cur,
+                mysql_database,
+                mysql_table,
+                args.months_ahead,
+                args.retention_months,
+            )
+        else:
+            options = SchemaOptions(
+                mysql_table, args.partitioned, args.compact_types, args.months_ahead
+            )
+            migrate(conn, options, args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
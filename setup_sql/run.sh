@@ -2,4 +2,5 @@
 
 cd "$(dirname "$0")"
 
-poetry run python -m create_mysql_schema
+# The shared iot_common package lives next to this directory
+PYTHONPATH=.. poetry run python -m create_mysql_schema "$@"
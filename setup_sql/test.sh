@@ -0,0 +1,6 @@
+#!/bin/bash
+
+cd "$(dirname "$0")"
+
+poetry run coverage run --source=create_mysql_schema --omit=*/tests/* -m pytest tests -vv
+poetry run coverage report --show-missing --skip-empty
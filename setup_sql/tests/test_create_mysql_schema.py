@@ -0,0 +1,147 @@
+import os
+from datetime import UTC, datetime
+from unittest import mock
+
+import pymysql
+import pytest
+
+from ..create_mysql_schema import (
+    MIGRATIONS,
+    SchemaOptions,
+    add_index,
+    get_partition_maintenance,
+    get_table_definition,
+    migrate,
+    widen_compact_device_ids,
+)
+
+MYSQL_TEST_HOST = os.environ.get("MYSQL_TEST_HOST")
+
+
+def create_mock_connection(fetchall_results: list[list[tuple]]) -> mock.MagicMock:
+    mock_cur = mock.MagicMock(name="cursor")
+    mock_cur.fetchall.side_effect = fetchall_results
+    mock_conn = mock.MagicMock(name="connection")
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cur
+    return mock_conn
+
+
+def test_get_table_definition__partitioned() -> None:
+    now = datetime(2023, 11, 15, tzinfo=UTC)
+    assert get_table_definition("table", True, True, now, 1) == (
+        "CREATE TABLE IF NOT EXISTS table (device_id smallint unsigned NOT NULL, "
+        "timestamp int unsigned NOT NULL, temperature float NOT NULL, "
+        "humidity float NOT NULL, hvac_status boolean NOT NULL, "
+        "PRIMARY KEY (device_id, timestamp)) PARTITION BY RANGE (timestamp) "
+        "(PARTITION p202311 VALUES LESS THAN (1701388800), "
+        "PARTITION p202312 VALUES LESS THAN (1704067200), "
+        "PARTITION pmax VALUES LESS THAN MAXVALUE)"
+    )
+
+
+def test_get_partition_maintenance() -> None:
+    partitions = [
+        ("p202311", "1701388800"),
+        ("p202312", "1704067200"),
+        ("pmax", "MAXVALUE"),
+    ]
+
+    now = datetime(2023, 11, 15, tzinfo=UTC)
+    assert get_partition_maintenance("table", partitions, now, 1, 12) == []
+
+    now = datetime(2024, 12, 3, tzinfo=UTC)
+    assert get_partition_maintenance("table", partitions, now, 1, 12) == [
+        (
+            "ALTER TABLE table REORGANIZE PARTITION pmax INTO ("
+            "PARTITION p202412 VALUES LESS THAN (1735689600), "
+            "PARTITION p202501 VALUES LESS THAN (1738368000), "
+            "PARTITION pmax VALUES LESS THAN MAXVALUE)"
+        ),
+        "ALTER TABLE table DROP PARTITION p202311",
+    ]
+
+
+def test_add_index() -> None:
+    assert add_index("table", "idx_test", ["timestamp", "device_id"]) == (
+        "ALTER TABLE table ADD INDEX idx_test (timestamp, device_id), "
+        "ALGORITHM=INPLACE, LOCK=NONE"
+    )
+
+
+def test_widen_compact_device_ids() -> None:
+    assert widen_compact_device_ids(SchemaOptions("table")) == []
+    assert widen_compact_device_ids(SchemaOptions("table", compact_types=True)) == [
+        "ALTER TABLE table MODIFY device_id mediumint unsigned NOT NULL",
+        (
+            "ALTER TABLE table_devices "
+            "MODIFY device_id mediumint unsigned NOT NULL AUTO_INCREMENT"
+        ),
+    ]
+
+
+def test_migrate__dry_run() -> None:
+    mock_conn = create_mock_connection([[]])
+    mock_cur = mock_conn.cursor.return_value.__enter__.return_value
+
+    versions = migrate(mock_conn, SchemaOptions("table"), dry_run=True)
+    assert versions == [m.version for m in MIGRATIONS]
+    assert mock_cur.execute.call_args_list == [
+        mock.call("SHOW TABLES LIKE 'schema_migrations'")
+    ]
+    assert mock_conn.commit.call_count == 0
+
+
+def test_migrate__pending() -> None:
+    applied = [(m.version,) for m in MIGRATIONS[:-1]]
+    mock_conn = create_mock_connection([[("schema_migrations",)], applied])
+    mock_cur = mock_conn.cursor.return_value.__enter__.return_value
+
+    with mock.patch("setup_sql.create_mysql_schema.time.time", return_value=10):
+        versions = migrate(mock_conn, SchemaOptions("table"))
+    assert versions == [MIGRATIONS[-1].version]
+    assert mock_cur.execute.call_args == mock.call(
+        "INSERT INTO schema_migrations (version, name, applied_at) "
+        "VALUES (%s, %s, %s)",
+        (MIGRATIONS[-1].version, MIGRATIONS[-1].name, 10),
+    )
+    assert mock_conn.commit.call_count == 1
+
+
+def test_migrate__up_to_date() -> None:
+    applied = [(m.version,) for m in MIGRATIONS]
+    mock_conn = create_mock_connection([[("schema_migrations",)], applied])
+
+    assert migrate(mock_conn, SchemaOptions("table")) == []
+    assert mock_conn.commit.call_count == 0
+
+
+@pytest.mark.skipif(not MYSQL_TEST_HOST, reason="MYSQL_TEST_HOST is not set")
+def test_migrate__local_mysql() -> None:
+    settings = {
+        "host": MYSQL_TEST_HOST,
+        "port": int(os.environ.get("MYSQL_TEST_PORT", "3306")),
+        "user": os.environ.get("MYSQL_TEST_USER", "root"),
+        "password": os.environ.get("MYSQL_TEST_PASSWORD", ""),
+    }
+    database = "ignite_test_migrations"
+    with pymysql.connect(**settings) as conn, conn.cursor() as cur:
+        cur.execute(f"DROP DATABASE IF EXISTS {database}")
+        cur.execute(f"CREATE DATABASE {database}")
+
+    try:
+        with pymysql.connect(database=database, **settings) as conn:
+            options = SchemaOptions("IotData", partitioned=True, compact_types=True)
+            assert migrate(conn, options) == [m.version for m in MIGRATIONS]
+            assert migrate(conn, options) == []
+
+            with conn.cursor() as cur:
+                cur.execute("SELECT version FROM schema_migrations ORDER BY version")
+                assert [row[0] for row in cur.fetchall()] == [
+                    m.version for m in MIGRATIONS
+                ]
+                cur.execute("SHOW TABLES")
+                tables = {row[0] for row in cur.fetchall()}
+                assert {"IotData", "IotData_hourly", "IotData_daily"} <= tables
+    finally:
+        with pymysql.connect(**settings) as conn, conn.cursor() as cur:
+            cur.execute(f"DROP DATABASE IF EXISTS {database}")